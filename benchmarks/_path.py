@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+def fix():
+    p = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')
+    if p not in sys.path:
+        sys.path.insert(0, p)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Drives campfire.Api directly: N pollers wait for messages sent by M senders.
+Measures throughput, delivery latency (from Api.recv() call to poller
+callback) and memory used by attached pollers
+"""
+
+##
+# python stdlib
+import sys
+import time
+import logging
+import argparse
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+import campfire
+from common import STACKS, Report, cleanup, rss
+
+
+class Poller(object):
+    """
+    Simulated client. One-shot poller attaches again with cursor of the
+    last received message (as long-polling client does), subscription
+    stays attached
+    """
+
+    def __init__(self, api, user, report, persistent):
+        """
+        Object initialization
+        """
+        self.api = api
+        self.user = user
+        self.report = report
+        self.persistent = persistent
+        self.cursor = None
+        self.closed = False
+
+    def attach(self):
+        """
+        Starts waiting for messages
+        """
+        if self.persistent:
+            self.api.subscribe(self.user, self.respond, self.cursor)
+        else:
+            self.api.attach_poller(self.user, self.respond, self.cursor)
+
+    def respond(self, messages):
+        """
+        Records received messages
+        """
+        for message in messages:
+            if message['id'] is not None:
+                self.cursor = message['id']
+            if 'sent' in message['args']:
+                self.report.delivered(message['args']['sent'])
+        if not self.persistent and not self.closed:
+            self.attach()
+
+
+def user(i):
+    """
+    Returns profile of i-th simulated user
+    """
+    return {'id': i, 'name': 'user%u' % i, 'ip': '10.0.%u.%u' % \
+        (i // 256 % 256, i % 256), 'logged': True, 'hasAccount': False, \
+        'system': False}
+
+
+def run(args):
+    """
+    Runs benchmark and returns report
+    """
+    log = logging.getLogger('campfire.bench')
+    dispatcher = Dispatcher()
+    tmp = STACKS[args.stack](dispatcher)
+    campfire.Api.group_pollers = args.group_pollers
+    api = campfire.Api(log, dispatcher).init()
+    report = Report('api; stack=%s; pollers=%u; senders=%u; mode=%s' % \
+        (args.stack, args.pollers, args.senders, \
+        'subscribe' if args.subscribe else 'poll'))
+    # attach pollers
+    before = rss()
+    pollers = [Poller(api, user(i), report, args.subscribe) \
+        for i in xrange(args.pollers)]
+    for poller in pollers:
+        poller.attach()
+    if before is not None and args.pollers:
+        report.memory = (rss() - before) / args.pollers
+    # send messages (senders take turns)
+    senders = [user(args.pollers + i) for i in xrange(args.senders)]
+    report.start()
+    for i in xrange(args.messages):
+        api.recv('message %u' % i, senders[i % len(senders)], \
+            {'sent': time.time()})
+        report.sent += 1
+    report.stop()
+    for poller in pollers:
+        poller.closed = True
+    api.shutdown()
+    cleanup(tmp)
+    return report
+
+
+def arg_parser():
+    """
+    Returns parser of command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pollers', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--stack', choices=sorted(STACKS), default='example')
+    parser.add_argument('--subscribe', action='store_true', \
+        help='attach pollers as subscriptions')
+    parser.add_argument('--group_pollers', action='store_true', \
+        help='filter messages once per audience class')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    run(arg_parser().parse_args()).write(sys.stdout)
+
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import os
+import time
+import shutil
+import tempfile
+
+##
+# campfire modules
+import campfire.plugins as plugins
+
+
+def bare_stack(dispatcher):
+    """
+    Registers only plugins required to run chat
+    """
+    plugins.NoAuth().register(dispatcher)
+    return None
+
+
+def example_stack(dispatcher):
+    """
+    Registers plugins used by example server (tests/tornado_example.py).
+    AntiFlood does not trip and archive is written to temporary directory,
+    which is returned (see cleanup)
+    """
+    plugins.AntiFlood(count=10 ** 9).register(dispatcher)
+    tmp = tempfile.mkdtemp(prefix='campfire-bench-')
+    path = os.path.join(tmp, 'archive.%Y%m%d.csv')
+    plugins.Archive(path, lambda data: [data['date'], data['text']]).register(\
+        dispatcher)
+    plugins.Ban({}).register(dispatcher)
+    plugins.Colors({}).register(dispatcher)
+    plugins.Console().register(dispatcher)
+    plugins.Dice().register(dispatcher)
+    plugins.Direct().register(dispatcher)
+    plugins.Me().register(dispatcher)
+    plugins.Nap([]).register(dispatcher)
+    plugins.NoAuth().register(dispatcher)
+    plugins.Puppet({}).register(dispatcher)
+    plugins.Quotations([]).register(dispatcher)
+    plugins.Tidy().register(dispatcher)
+    plugins.Typing().register(dispatcher)
+    plugins.ValidateLogin([]).register(dispatcher)
+    plugins.Voices({}).register(dispatcher)
+    plugins.Whoami().register(dispatcher)
+    return tmp
+
+
+def cleanup(tmp):
+    """
+    Removes temporary directory returned by plugin stack
+    (call it after chat is shut down)
+    """
+    if tmp is not None:
+        shutil.rmtree(tmp, True)
+
+
+# plugin stacks selectable from command line; stack registers plugins
+# and returns temporary directory it uses (None - no directory)
+STACKS = {'bare': bare_stack, 'example': example_stack}
+
+
+def rss(pid=None):
+    """
+    Returns resident set size (bytes) of given process
+    (None - not supported on this platform)
+    """
+    try:
+        with open('/proc/%s/statm' % (pid or 'self')) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def percentile(values, p):
+    """
+    Returns p-th percentile of given sorted values (nearest rank)
+    """
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Report(object):
+    """
+    Collects delivery latencies and prints summary
+    """
+
+    def __init__(self, name):
+        """
+        Object initialization
+        """
+        self.name = name
+        self.latencies = [] # seconds
+        self.sent = 0
+        self.memory = None  # bytes per connection
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        """
+        Marks beginning of measured period
+        """
+        self.started = time.time()
+
+    def stop(self):
+        """
+        Marks end of measured period
+        """
+        self.finished = time.time()
+
+    def delivered(self, sent):
+        """
+        Records delivery of message sent at given time
+        """
+        self.latencies.append(time.time() - sent)
+
+    def summary(self):
+        """
+        Returns list of (name, value) pairs
+        """
+        elapsed = max(self.finished - self.started, 1e-9)
+        latencies = sorted(self.latencies)
+        out = [('messages', self.sent), ('deliveries', len(latencies)), \
+            ('elapsed_s', elapsed), ('messages_per_s', self.sent / elapsed), \
+            ('deliveries_per_s', len(latencies) / elapsed)]
+        for p in (50, 99):
+            value = percentile(latencies, p)
+            if value is not None:
+                value *= 1000
+            out.append(('latency_p%u_ms' % p, value))
+        out.append(('memory_per_connection_b', self.memory))
+        return out
+
+    def write(self, stream):
+        """
+        Prints summary
+        """
+        stream.write('benchmark=%s\n' % self.name)
+        for (name, value) in self.summary():
+            if isinstance(value, float):
+                value = '%.3f' % value
+            stream.write('%s=%s\n' % (name, value))
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs chat server (tornado platform) in child process and drives it over
+local HTTP long-poll or WebSocket connections: N pollers wait for messages
+sent by M senders. Measures throughput, delivery latency (from sending
+the message to receiving it by poller) and server memory per connection
+"""
+
+##
+# python stdlib
+import os
+import sys
+import time
+import signal
+import urllib
+import logging
+import argparse
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# tornado modules
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+from tornado.escape import json_decode
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+import campfire
+import campfire.platform.tornadoweb as chat
+from campfire.utils import AuthHelper
+from common import STACKS, Report, cleanup, rss
+
+
+def server(sockets, args):
+    """
+    Runs chat server on given sockets (in child process)
+    """
+    log = logging.getLogger('campfire.bench')
+    dispatcher = Dispatcher()
+    tmp = STACKS[args.stack](dispatcher)
+    campfire.Api.group_pollers = args.group_pollers
+    campfire.Api.batch_window = args.batch_window
+    api = campfire.Api(log, dispatcher)
+    auth = AuthHelper(api, dispatcher, log)
+    handler_args = {'log': log, 'api': api, 'auth': auth}
+    application = tornado.web.Application([
+        (r"/chat/login", chat.AuthHandler, handler_args),
+        (r"/chat/reply", chat.HttpHandler, handler_args),
+        (r"/chat/poll", chat.HttpHandler, handler_args),
+        (r"/chat/socket", chat.SocketHandler, handler_args),
+    ], cookie_secret='benchmark')
+    try:
+        chat.serve(application, api, sockets, no_keep_alive=True)
+    finally:
+        cleanup(tmp)
+
+
+def login(prefix, i):
+    """
+    Returns i-th login with given prefix (ValidateLogin accepts
+    capitalized words of letters only)
+    """
+    letters = ''
+    while True:
+        letters = chr(ord('a') + i % 26) + letters
+        i //= 26
+        if 0 == i and len(letters) > 1:
+            break
+    return '%s %s' % (prefix, letters.capitalize())
+
+
+class Client(object):
+    """
+    Simulated chat client
+    """
+
+    def __init__(self, bench, name):
+        """
+        Object initialization
+        """
+        self.bench = bench
+        self.name = name
+        self.cookie = None
+        self.cursor = None
+        self.received = 0
+        self.warm = False
+
+    def login(self, callback):
+        """
+        Logs client in
+        """
+        def _done(response):
+            response.rethrow()
+            self.cookie = '; '.join(c.split(';')[0] \
+                for c in response.headers.get_list('Set-Cookie'))
+            callback()
+        self.bench.http.fetch(self.bench.url('/chat/login'), _done, \
+            method='POST', body=urllib.urlencode({'login': self.name}))
+
+    def send(self, text, callback, **kwargs):
+        """
+        Posts message
+        """
+        kwargs['message'] = text
+        def _done(response):
+            response.rethrow()
+            callback()
+        self.bench.http.fetch(self.bench.url('/chat/reply'), _done, \
+            method='POST', body=urllib.urlencode(kwargs), \
+            headers={'Cookie': self.cookie})
+
+    def receive(self, messages):
+        """
+        Records received messages
+        """
+        for message in messages:
+            self.warm = True
+            if message['id'] is not None:
+                self.cursor = message['id']
+            if 'sent' in message['args']:
+                self.bench.report.delivered(float(message['args']['sent'][0]))
+                self.received += 1
+        self.bench.check()
+
+
+class PollClient(Client):
+    """
+    Client waiting for messages with HTTP long-polling
+    """
+
+    def connect(self):
+        """
+        Starts polling
+        """
+        query = ''
+        if self.cursor is not None:
+            query = '?' + urllib.urlencode({'cursor': self.cursor})
+        self.bench.http.fetch(HTTPRequest(self.bench.url('/chat/poll' + \
+            query), headers={'Cookie': self.cookie}, request_timeout=3600), \
+            self._respond)
+
+    def _respond(self, response):
+        """
+        Handles response and polls again
+        """
+        if self.bench.done:
+            return
+        response.rethrow()
+        self.receive(json_decode(response.body)['messages'])
+        self.connect()
+
+
+class SocketClient(Client):
+    """
+    Client waiting for messages on WebSocket
+    """
+
+    def connect(self):
+        """
+        Opens WebSocket
+        """
+        request = HTTPRequest(self.bench.url('/chat/socket', 'ws'), \
+            headers={'Cookie': self.cookie})
+        tornado.websocket.websocket_connect(request, \
+            callback=self._connected)
+
+    def _connected(self, future):
+        """
+        Starts reading messages
+        """
+        self.connection = future.result()
+        self.connection.read_message(self._respond)
+
+    def _respond(self, future):
+        """
+        Handles message and waits for next one
+        """
+        message = future.result()
+        if message is None or self.bench.done:
+            return
+        self.receive(json_decode(message))
+        self.connection.read_message(self._respond)
+
+
+class Benchmark(object):
+    """
+    Drives clients: logs them in, connects pollers, warms them up
+    (every poller receives one message) and sends measured messages
+    """
+
+    def __init__(self, port, pid, args):
+        """
+        Object initialization
+        """
+        self.port = port
+        self.pid = pid
+        self.args = args
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        AsyncHTTPClient.configure(None, \
+            max_clients=args.pollers + args.senders + 1)
+        self.http = AsyncHTTPClient()
+        factory = {'poll': PollClient, 'socket': SocketClient}[args.transport]
+        self.pollers = [factory(self, login('Poller', i)) \
+            for i in xrange(args.pollers)]
+        self.senders = [Client(self, login('Sender', i)) \
+            for i in xrange(args.senders)]
+        self.report = Report('http; stack=%s; pollers=%u; senders=%u; ' \
+            'transport=%s; batch_window=%u' % (args.stack, args.pollers, \
+            args.senders, args.transport, args.batch_window))
+        self.baseline = None
+        self.warm = False
+        self.done = False
+        self.server_status = None # exit status of server that has exited
+
+    def url(self, path, scheme='http'):
+        """
+        Returns URL of given path
+        """
+        return '%s://127.0.0.1:%u%s' % (scheme, self.port, path)
+
+    def run(self):
+        """
+        Runs benchmark and returns report
+        """
+        clients = self.pollers + self.senders
+        pending = [len(clients)]
+        def _logged():
+            pending[0] -= 1
+            if 0 == pending[0]:
+                self._connect()
+        for client in clients:
+            client.login(_logged)
+        self.io_loop.add_timeout(time.time() + self.args.timeout, \
+            self._finish)
+        watchdog = tornado.ioloop.PeriodicCallback(self._watch, 500)
+        watchdog.start()
+        self.io_loop.start()
+        watchdog.stop()
+        return self.report
+
+    def _watch(self):
+        """
+        Stops benchmark when server process has exited
+        """
+        (pid, status) = os.waitpid(self.pid, os.WNOHANG)
+        if pid:
+            self.server_status = status
+            self._finish()
+
+    def _connect(self):
+        """
+        Connects pollers and sends warm-up message
+        """
+        self.baseline = rss(self.pid)
+        for poller in self.pollers:
+            poller.connect()
+        # let pollers attach before warm-up message is sent
+        self.io_loop.add_timeout(time.time() + 1, \
+            lambda: self.senders[0].send('warm-up', lambda: None))
+
+    def _start(self):
+        """
+        Sends measured messages (each sender waits for its previous one)
+        """
+        if self.baseline is not None and self.pollers:
+            self.report.memory = (rss(self.pid) - self.baseline) / \
+                len(self.pollers)
+        self.report.start()
+        for sender in self.senders:
+            self._send(sender)
+
+    def _send(self, sender):
+        """
+        Sends next message
+        """
+        if self.report.sent == self.args.messages:
+            return
+        self.report.sent += 1
+        sender.send('message %u' % self.report.sent, \
+            lambda: self._send(sender), sent=repr(time.time()))
+
+    def check(self):
+        """
+        Checks progress of benchmark
+        """
+        if not self.warm:
+            if all(poller.warm for poller in self.pollers):
+                self.warm = True
+                self._start()
+            return
+        if all(poller.received == self.args.messages \
+                for poller in self.pollers):
+            self._finish()
+
+    def _finish(self):
+        """
+        Stops benchmark
+        """
+        if self.done:
+            return
+        self.done = True
+        if self.report.started is None:
+            self.report.start()
+        self.report.stop()
+        self.io_loop.stop()
+
+
+def arg_parser():
+    """
+    Returns parser of command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pollers', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--stack', choices=sorted(STACKS), default='example')
+    parser.add_argument('--transport', choices=['poll', 'socket'], \
+        default='poll')
+    parser.add_argument('--group_pollers', action='store_true', \
+        help='filter messages once per audience class')
+    parser.add_argument('--batch_window', type=int, default=0, \
+        help='batch window of chat (milliseconds)')
+    parser.add_argument('--timeout', type=float, default=60, \
+        help='seconds after benchmark is stopped')
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = arg_parser().parse_args()
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    pid = os.fork()
+    if 0 == pid:
+        try:
+            server(sockets, args)
+        except:
+            logging.exception('msg=server failed')
+            os._exit(1)
+        os._exit(0)
+    for sock in sockets:
+        sock.close()
+    status = None
+    try:
+        benchmark = Benchmark(port, pid, args)
+        report = benchmark.run()
+        status = benchmark.server_status
+    finally:
+        if status is None:
+            os.kill(pid, signal.SIGTERM)
+            status = os.waitpid(pid, 0)[1]
+    report.write(sys.stdout)
+    if 0 != status:
+        sys.stderr.write('server exited abnormally; status=%u\n' % status)
+        sys.exit(1)
+
+
+if "__main__" == __name__:
+    main()
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import uuid
-from itertools import takewhile, imap
-from collections import deque
+import logging
+from itertools import takewhile, imap, count
 from functools import partial
+from collections import OrderedDict
 from event import Event
+from message import freeze, Batch
+from cache import order_key
+from pollers import user_keys, poller_id
+from rooms import Room, RoomRegistry
+from bus import LocalBus
+from journal import Journal
+from metrics import Registry
+from utils import LazyRepr
 import time
-import copy
 
 
 class UninitializedChatError(RuntimeError):
@@ -20,6 +28,14 @@ class AuthError(RuntimeError):
     pass
 
 
+class InvalidCursorError(ValueError):
+    pass
+
+
+class InvalidLimitError(ValueError):
+    pass
+
+
 class Api(object):
     """
     Main chat class
@@ -31,6 +47,30 @@ class Api(object):
     system_user_struct = {'id': -1, 'name': 'System', 'ip': '127.0.0.1', \
         'logged': False, 'hasAccount': False, 'system': True}
 
+    # filter each message once per audience class instead of once per poller.
+    # Requires every 'message.read.*' listener to be a Plugin that declares
+    # its audience (see campfire.utils.Plugin.audience)
+    group_pollers = False
+
+    # max number of messages returned by single fetch_history() call
+    max_history = 200
+
+    # idle rooms above that number are evicted (least recently used first).
+    # Messages of evicted room are restored from journal when room is
+    # needed again, so rooms are not evicted when journal is not persistent
+    max_rooms = 1000
+
+    # messages delivered within that window are sent to each poller
+    # as one batch (0 - send each message right away). Requires
+    # call_later to be provided by platform
+    batch_window = 0 # milliseconds
+
+    # debug records of hot paths (notifying and attaching pollers) are
+    # logged for every n-th operation even when DEBUG level is disabled
+    # (0 - never). Sampled records are logged at INFO level; notification
+    # is logged as one summary record then (not one record per poller)
+    debug_sample = 0
+
     def __init__(self, log, dispatcher, cache_size=120):
         """
         Instance initialization
@@ -40,17 +80,104 @@ class Api(object):
         #
         self.log = log
         self.dispatcher = dispatcher
+        self.bus = LocalBus() # replace before init() to share chat with others
+        self.journal = Journal() # replace before init() to keep messages
+                                 # between restarts
+        self.call_later = None # callable(delay, callback) running callback
+                               # after delay (seconds) in chat thread
+        self.origin = uuid.uuid4().hex[:12] # prefix of IDs of messages
+                                            # accepted by this instance
+        self._counter = count(1) # sequence number of messages of origin
 
         ##
         # some important values
         #
         self._initialized = False
-        self._cache = deque([], cache_size)
-        self.pollers = []
+        self._cache_size = cache_size
+        self.rooms = RoomRegistry(self._create_room, self.max_rooms)
+        self.rooms.get(None) # default room
+        self._audience = [] # audience key functions declared by plugins
+        self._pipeline = [] # 'message.received' listeners declared by plugins
+        self._max_variants = 8 # variants of filtered message kept on broadcast
         self._time_treshold = 15 # minutes after message will become unaccessible
+        self._pending = OrderedDict() # map room ID to (room, [(seq, message,
+                                      # readers)]) waiting for batch window
+        self.metrics = Registry()
+        self._init_metrics()
+        self._operations = 0 # hot-path operations counted for sampling
 
         self.log.debug('msg=init new api instance; cache_size=%u', cache_size)
 
+    def _init_metrics(self):
+        """
+        Creates metrics of chat. Counters are kept as attributes, so hot
+        paths only increment them; gauges are computed when collected
+        """
+        m = self.metrics
+        self._received = m.counter('campfire_messages_received_total', \
+            'Messages passed to Api.recv()')
+        self._stored = m.counter('campfire_messages_stored_total', \
+            'Messages stored in rooms (received or accepted from bus)')
+        self._responses = m.counter('campfire_responses_total', \
+            'Responses sent to pollers')
+        self._sent = m.counter('campfire_messages_sent_total', \
+            'Messages sent to pollers')
+        self._attaches = m.counter('campfire_poller_attaches_total', \
+            'Pollers attached (or subscribed)')
+        self._releases = m.counter('campfire_poller_releases_total', \
+            'One-shot pollers detached when messages were sent to them')
+        self._fanout = m.histogram('campfire_fanout_seconds', \
+            'Time of sending message (or batch) to pollers of room')
+        m.gauge('campfire_pollers', 'Attached pollers', \
+            lambda: sum(len(room.pollers) for room in self.rooms))
+        m.gauge('campfire_rooms', 'Rooms', lambda: len(self.rooms))
+        m.gauge('campfire_cache_messages', 'Messages cached in rooms', \
+            lambda: sum(len(room.cache) for room in self.rooms))
+        m.gauge('campfire_cache_capacity', 'Capacity of caches of rooms', \
+            lambda: len(self.rooms) * self._cache_size)
+        m.gauge('campfire_pending_messages', \
+            'Messages waiting for batch window', lambda: sum(len(entries) \
+            for (room, entries) in self._pending.itervalues()))
+
+    def _debug_level(self):
+        """
+        Returns level debug records of hot-path operation should be logged
+        at (None - they should be skipped, so their arguments are not
+        even built)
+        """
+        if self.log.isEnabledFor(logging.DEBUG):
+            return logging.DEBUG
+        if self.debug_sample > 0:
+            self._operations += 1
+            if 0 == self._operations % self.debug_sample:
+                return logging.INFO
+        return None
+
+    @property
+    def pollers(self):
+        """
+        Pollers waiting in default room
+        """
+        return self.rooms.get(None).pollers
+
+    def _create_room(self, room_id):
+        """
+        Creates room with given ID
+        """
+        self.log.debug('msg=creating room; room=%s', room_id)
+        room = Room(room_id, self._cache_size)
+        if self._initialized:
+            self._restore(room)
+        return room
+
+    def _restore(self, room):
+        """
+        Restores recent messages of room from journal
+        """
+        room.cache.load(self.journal.recent(room.id))
+        self.log.debug('msg=restored room; room=%s; messages=%u', room.id, \
+            len(room.cache))
+
     def init(self):
         """
         Notify chat initialization
@@ -60,9 +187,35 @@ class Api(object):
         if self._initialized:
             raise ChatReinitializationForbiddenError()
         self._initialized = True
-        self.dispatcher.notify(Event(self, 'chat.init', {'log': self.log}))
+        if not self.journal.persistent:
+            self.rooms.max_rooms = None
+        # rooms created before initialization
+        for room in self.rooms:
+            self._restore(room)
+        self.bus.subscribe('message', self._on_bus_message)
+        # plugins registered from now on join pipeline on registration
+        self.dispatcher.attach('plugin.registered', self._on_plugin_registered)
+        self.dispatcher.notify(Event(self, 'chat.init', {'log': self.log, \
+            'audience': self._audience, 'pipeline': self._pipeline}))
+        # stable sort - listeners of equal priority are called in order
+        # of registration
+        self._pipeline.sort(key=lambda stage: stage[0])
         return self
 
+    def _on_plugin_registered(self, event):
+        """
+        Initializes plugin registered after chat has been initialized
+        (its 'message.received' listeners join compiled pipeline)
+        """
+        if not self._initialized:
+            return
+        plugin = event['plugin']
+        self.log.info('msg=initializing plugin registered after chat; ' + \
+            'plugin=%s', plugin.__class__.__name__)
+        plugin.init(Event(self, 'chat.init', {'log': self.log, \
+            'audience': self._audience, 'pipeline': self._pipeline}))
+        self._pipeline.sort(key=lambda stage: stage[0])
+
     def shutdown(self):
         """
         Notify chat shutdown
@@ -73,15 +226,17 @@ class Api(object):
             raise UninitializedChatError()
         self._initialized = False
         self.dispatcher.notify(Event(self, 'chat.shutdown'))
+        self._flush_pending()
         # close connections
         self.log.debug('msg=closing remaining connections')
-        pollers = copy.copy(self.pollers)
-        self.pollers = []
-        for (callback, user) in pollers:
-            self.log.debug('msg=closing connection; poller=%s', repr(callback))
-            self._respond([self._message('shutdown', self.system_user_struct, \
-                {})], callback)
-            self.log.debug('msg=closed connection; poller=%s', repr(callback))
+        batch = Batch([self._message('shutdown', self.system_user_struct, {})])
+        for room in self.rooms:
+            for (callback, user) in room.pollers.clear():
+                self.log.debug('msg=closing connection; poller=%s', \
+                    LazyRepr(callback))
+                self._respond(batch, callback)
+                self.log.debug('msg=closed connection; poller=%s', \
+                    LazyRepr(callback))
         self.log.debug('msg=closed remaining connections')
         self.log.info('msg=shutdown chat')
         return self
@@ -93,21 +248,32 @@ class Api(object):
         self.log.debug('msg=periodic notification')
         self.dispatcher.notify(Event(self, 'chat.periodic'))
 
-    def recv(self, message, user, args):
+    def recv(self, message, user, args, room=None):
         """
         Entry point for new massages
         """
-        self.log.debug('msg=received message; message=%s; user=%s; args=%s', \
-            message, user, args)
+        self.log.debug('msg=received message; message=%s; user=%s; ' + \
+            'args=%s; room=%s', message, user, args, room)
         if not self._initialized:
             raise UninitializedChatError()
+        self._received.inc()
+        # identify sender before plugins change message
+        sender = user_keys(user)
         # prepare message
-        (msg, response) = self._prepare_message(message, user, args)
+        (msg, response, audience) = self._prepare_message(message, user, \
+            args, room)
         if msg:
+            # stored message is shared by all readers - make it read-only
+            msg = freeze(msg)
             self.log.info('msg=stored message; message=%s; user=%s; args=%s', \
                 msg['id'], user, args)
-            self._cache.appendleft(msg)
-            self._notify(msg)
+            # addressed message - can be read by recipients and sender only
+            readers = None
+            if audience:
+                readers = set(str(k) for k in audience) | sender | \
+                    user_keys(msg['from'])
+            self._deliver(self.rooms.get(room), msg, readers)
+            self._publish(room, msg, readers)
         else:
             msg = {'id': None}
             self.log.debug('msg=message NOT stored; message=%s; user=%s; ' + \
@@ -115,6 +281,61 @@ class Api(object):
         # prepare response to request
         return self._prepare_response(msg, response)
 
+    def _deliver(self, room, message, readers=None):
+        """
+        Stores message in room and notifies pollers
+        """
+        message = room.cache.stamp(message)
+        seq = room.cache.append(message, readers)
+        self.journal.append(room.id, seq, message, readers)
+        self._stored.inc()
+        if self.batch_window <= 0 or self.call_later is None:
+            self._notify(room, message, readers)
+            return
+        # wait for other messages of batch
+        if not self._pending:
+            self.call_later(self.batch_window / 1000.0, self._flush_pending)
+        self._pending.setdefault(room.id, (room, []))[1].append(\
+            (seq, message, readers))
+
+    def _flush_pending(self):
+        """
+        Sends messages delivered within batch window
+        """
+        pending = self._pending
+        self._pending = OrderedDict()
+        for (room, entries) in pending.itervalues():
+            self.log.debug('msg=sending batch; room=%s; nummsg=%u', room.id, \
+                len(entries))
+            self._notify_batch(room, entries)
+
+    def _publish(self, room_id, message, readers=None):
+        """
+        Publishes message to other processes sharing the chat
+        """
+        if readers is not None:
+            readers = list(readers)
+        self.bus.publish('message', {'room': room_id, 'message': message, \
+            'readers': readers})
+
+    def _on_bus_message(self, data):
+        """
+        Handles message accepted by other process
+        """
+        if not self._initialized:
+            return
+        room = self.rooms.get(data['room'])
+        msg = freeze(data['message'])
+        # message delivered already
+        if room.cache.position(msg['id']) is not None:
+            return
+        self.log.debug('msg=received message from bus; message=%s; room=%s', \
+            msg['id'], room.id)
+        readers = data['readers']
+        if readers is not None:
+            readers = set(readers)
+        self._deliver(room, msg, readers)
+
     def _auth_user(self, user):
         """
         Checks authentication for given user
@@ -128,23 +349,49 @@ class Api(object):
             user, e.return_value)
         return user
 
-    def _message(self, message, user, args):
+    def _message(self, message, user, args, room=None):
         """
         Prepares message object
         """
-        return {'id': str(uuid.uuid4()), 'text': message, \
+        msg = {'id': '%s.%u' % (self.origin, next(self._counter)), \
+            'text': message, \
             'from': user, 'args': args, 'date': int(time.time())}
+        if room is not None:
+            msg['room'] = room
+        return msg
 
-    def _prepare_message(self, message, user, args):
+    def _prepare_message(self, message, user, args, room=None):
         """
-        Prepares message data
+        Prepares message data.
+
+        Listeners may address message by adding identifiers (id, ip or name)
+        of recipients to 'audience' set
         """
+        audience = set()
+        event = Event(self, 'message.received', {'response': {}, \
+            'audience': audience, 'room': room})
         # filter message and prepare final message structure
-        e = self.dispatcher.filter(Event(self, 'message.received', \
-            {'response': {}}), self._message(message, self._auth_user(user), \
-            args))
+        msg = self._run_pipeline(event, self._message(message, \
+            self._auth_user(user), args, room))
+        e = self.dispatcher.filter(event, msg)
         response = e['response']
-        return (e.return_value, response)
+        return (e.return_value, response, audience)
+
+    def _run_pipeline(self, event, message):
+        """
+        Passes message through 'message.received' listeners of plugins.
+
+        Listener is skipped when its trigger does not match message text
+        (text is checked just before listener is called, because previous
+        listeners may change it). Pipeline stops when message is rejected
+        """
+        for (priority, listener, match) in self._pipeline:
+            if match is not None and not match(message['text']):
+                continue
+            message = listener(event, message)
+            if message is None:
+                break
+        return message
     
     def _prepare_response(self, message, response):
         """
@@ -156,15 +403,20 @@ class Api(object):
             'message=%s; result=%s', message['id'], e.return_value)
         return e.return_value
 
-    def _filter_output(self, user, message, poller):
+    def _filter_output(self, user, message, poller, room=None):
         """
-        Filters messages before the will be send to user
+        Filters messages before the will be send to user.
+        Poller is printable identity of poller (e.g. LazyRepr of callback)
+
+        Stored message is read-only. Listeners of 'message.read.filter'
+        receive shallow copy of it, so they can change top-level keys only
+        (nested values must be replaced, not modified)
         """
         # prevent from returning message to user,
         # that should not read it
         e = self.dispatcher.notify_until(\
             Event(self, 'message.read.prevent', {'user': user, \
-                'poller': poller, 'message': copy.deepcopy(message)}))
+                'poller': poller, 'message': message, 'room': room}))
         if e.processed:
             self.log.debug('msg=message can not be send to user, skipping; ' + \
             'message=%s; user=%s; poller=%s; result=%s', message['id'], user, \
@@ -173,91 +425,373 @@ class Api(object):
         # filter message
         msg = self.dispatcher.filter(\
             Event(self, 'message.read.filter', {'user': user, \
-                'poller': poller}), copy.deepcopy(message)).return_value
+                'poller': poller, 'room': room}), dict(message)).return_value
         return msg
 
-    def _notify(self, message):
+    def _audience_key(self, user, message):
         """
-        Sends response to all pollers
+        Calculates key of audience class given user belongs to.
+        Users with equal keys see message in the same way.
+        None is returned when user can not be classified
         """
-        pollers = copy.copy(self.pollers)
-        self.pollers = []
-        for (callback, user) in pollers:
-            tmp = self._filter_output(user, message, repr(callback))
-            # prevent from forgetting connection when message should be not send
+        key = tuple(f(user, message) for f in self._audience)
+        if None in key:
+            return None
+        return key
+
+    def _group_pollers(self, pollers, message):
+        """
+        Groups pollers by audience class (preserving order of pollers)
+        """
+        groups = OrderedDict()
+        for (idx, (callback, user)) in enumerate(pollers):
+            key = None
+            if self.group_pollers:
+                key = self._audience_key(user, message)
+            # poller can not be grouped - use separate group
+            if key is None:
+                key = ('poller', idx)
+            groups.setdefault(key, []).append((callback, user))
+        return groups.itervalues()
+
+    def _notify(self, room, message, readers=None):
+        """
+        Sends response to all pollers in given room
+        (or to pollers of given readers only when message is addressed)
+        """
+        start = time.time()
+        level = self._debug_level()
+        debug = logging.DEBUG == level
+        sent = 0
+        # callbacks may attach pollers again, so iterate over a snapshot
+        if readers is None:
+            pollers = list(room.pollers)
+        else:
+            pollers = room.pollers.by_user(readers)
+        if room.pollers.ahead():
+            pollers = [(callback, user) for (callback, user) in pollers \
+                if not room.pollers.seen(callback, message)]
+        variants = []
+        for group in self._group_pollers(pollers, message):
+            # message is filtered once for whole group
+            (callback, user) = group[0]
+            tmp = self._filter_output(user, message, LazyRepr(callback), \
+                room.id)
+            # poller stays attached when message should be not send
             if tmp is None:
-                self.log.debug('msg=reattaching poller; ' + \
-                    'user=%s; poller=%s', user, repr(callback))
-                self.pollers.append((callback, user))
+                if debug:
+                    self.log.debug('msg=keeping pollers attached; ' + \
+                        'user=%s; poller=%s; numpollers=%u', user, \
+                        LazyRepr(callback), len(group))
+                continue
             # send message
+            batch = self._variant(variants, tmp)
+            sent += len(group)
+            for (callback, user) in group:
+                if debug:
+                    self.log.debug('msg=sending message to poller; ' + \
+                        'user=%s; poller=%s; message=%s', user, \
+                        LazyRepr(callback), tmp['id'])
+                # subscriptions stay attached
+                if room.pollers.persistent(callback):
+                    room.pollers.advance(callback, tmp['id'])
+                else:
+                    room.pollers.remove(callback)
+                    self._releases.inc()
+                self._respond(batch, callback)
+        elapsed = time.time() - start
+        self._fanout.observe(elapsed)
+        if level is not None:
+            self.log.log(level, 'msg=message sent to pollers; message=%s; ' + \
+                'room=%s; numpollers=%u; time=%.6f', message['id'], room.id, \
+                sent, elapsed)
+
+    def _notify_batch(self, room, entries):
+        """
+        Sends batch of (seq, message, readers) to pollers in given room.
+        Each poller receives all messages it can read in one response;
+        pollers that see messages in the same way share one batch.
+        Pollers attached after message has been cached got it already
+        """
+        start = time.time()
+        level = self._debug_level()
+        received = OrderedDict() # map poller ID to (callback, [variants])
+        variants = []
+        for (seq, message, readers) in entries:
+            if readers is None:
+                pollers = list(room.pollers)
             else:
-                self.log.debug('msg=sending message to poller; user=%s; ' + \
-                    'poller=%s; message=%s', user, repr(callback), tmp['id'])
-                self._respond([tmp], callback)
+                pollers = room.pollers.by_user(readers)
+            pollers = [(callback, user) for (callback, user) in pollers \
+                if room.pollers.seq(callback) < seq and \
+                not room.pollers.seen(callback, message)]
+            for group in self._group_pollers(pollers, message):
+                (callback, user) = group[0]
+                tmp = self._filter_output(user, message, LazyRepr(callback), \
+                    room.id)
+                if tmp is None:
+                    continue
+                variant = self._variant(variants, tmp)
+                for (callback, user) in group:
+                    received.setdefault(poller_id(callback), \
+                        (callback, []))[1].append(variant)
+        batches = {}
+        for (callback, messages) in received.itervalues():
+            key = tuple(id(variant) for variant in messages)
+            if key not in batches:
+                batches[key] = Batch(variant[0] for variant in messages)
+            batch = batches[key]
+            if logging.DEBUG == level:
+                self.log.debug('msg=sending batch to poller; ' + \
+                    'poller=%s; nummsg=%u', LazyRepr(callback), len(batch))
+            # subscriptions stay attached
+            if room.pollers.persistent(callback):
+                room.pollers.advance(callback, batch[-1]['id'])
+            else:
+                room.pollers.remove(callback)
+                self._releases.inc()
+            self._respond(batch, callback)
+        elapsed = time.time() - start
+        self._fanout.observe(elapsed)
+        if level is not None:
+            self.log.log(level, 'msg=batch sent to pollers; room=%s; ' + \
+                'nummsg=%u; numpollers=%u; time=%.6f', room.id, len(entries), \
+                len(received), elapsed)
+
+    def _variant(self, variants, message):
+        """
+        Returns batch for given variant of filtered message.
+        Pollers that see message in the same way share one batch
+        (and its serialized form)
+        """
+        for batch in variants:
+            if batch[0] == message:
+                return batch
+        batch = Batch([message])
+        # check only few recent variants
+        variants.insert(0, batch)
+        del variants[self._max_variants:]
+        return batch
 
     def _respond(self, message, callback):
         """
         Sends response to given callback about new messages
         """
+        if not isinstance(message, Batch):
+            message = Batch(message)
+        self._responses.inc()
+        self._sent.inc(len(message))
         callback(message)
 
-    def attach_poller(self, user, callback, cursor=None):
+    def attach_poller(self, user, callback, cursor=None, room=None):
         """
         Attaches poller to list of pollers waiting for message
         """
         if not self._initialized:
             raise UninitializedChatError()
-        self.log.debug('msg=processing new poller; ' + \
-            'user=%s; cursor=%s; poller=%s', user, cursor, repr(callback))
-        tmp = self._fetch_cached_messages(user, cursor, repr(callback))
+        self._attaches.inc()
+        level = self._debug_level()
+        poller = LazyRepr(callback)
+        if level is not None:
+            self.log.log(level, 'msg=processing new poller; ' + \
+                'user=%s; cursor=%s; poller=%s; room=%s', user, cursor, \
+                poller, room)
+        room = self.rooms.get(room)
+        tmp = self._fetch_cached_messages(user, cursor, poller, room)
         if tmp:
-            self.log.debug('msg=found messages newer than given cursor; ' + \
-                'user=%s; cursor=%s; poller=%s; nummsg=%u', user, cursor, \
-                repr(callback), len(tmp))
+            if level is not None:
+                self.log.log(level, 'msg=found messages newer than ' + \
+                    'given cursor; user=%s; cursor=%s; poller=%s; ' + \
+                    'nummsg=%u', user, cursor, poller, len(tmp))
             self._respond(tmp, callback)
             return
-        self.log.debug('msg=new messages not found, attaching new poller; ' + \
-            'user=%s; poller=%s', user, repr(callback))
-        self.pollers.append((callback, user))
+        if level is not None:
+            self.log.log(level, 'msg=new messages not found, attaching ' + \
+                'new poller; user=%s; poller=%s', user, poller)
+        room.pollers.add(callback, user, seq=room.cache.seq, \
+            ahead=room.cache.ahead(cursor))
+        return self
+
+    def subscribe(self, user, callback, cursor=None, room=None):
+        """
+        Attaches poller that stays attached when messages are sent to it
+        (e.g. WebSocket connection). Messages newer than cursor are sent
+        right away
+        """
+        if not self._initialized:
+            raise UninitializedChatError()
+        self._attaches.inc()
+        level = self._debug_level()
+        poller = LazyRepr(callback)
+        if level is not None:
+            self.log.log(level, 'msg=processing new subscription; ' + \
+                'user=%s; cursor=%s; poller=%s; room=%s', user, cursor, \
+                poller, room)
+        room = self.rooms.get(room)
+        ahead = room.cache.ahead(cursor)
+        tmp = self._fetch_cached_messages(user, cursor, poller, room)
+        for msg in reversed(tmp):
+            if msg['id'] is not None:
+                cursor = msg['id']
+                break
+        room.pollers.add(callback, user, True, cursor, room.cache.seq, ahead)
+        if tmp:
+            if level is not None:
+                self.log.log(level, 'msg=found messages newer than ' + \
+                    'given cursor; user=%s; cursor=%s; poller=%s; ' + \
+                    'nummsg=%u', user, cursor, poller, len(tmp))
+            self._respond(tmp, callback)
         return self
 
-    def _do_detach(self, item):
+    def subscribed(self, callback, room=None):
         """
-        Removed given item from pollers list
+        Checks whether given subscription is still attached
+        (subscriptions are detached when chat is shut down)
         """
-        self.log.debug('msg=detaching poller; user=%s; poller=%s', item[1], \
-            repr(item[0]))
-        self.pollers.remove(item)
+        room = self.rooms.find(room)
+        return room is not None and room.pollers.persistent(callback)
 
-    def detach_poller(self, callback):
+    def detach_poller(self, callback, room=None):
         """
         Detaches given poller from list of polles waiting for new messages
         """
         if not self._initialized:
             raise UninitializedChatError()
-        map(self._do_detach, (i for i in self.pollers if i[0] == callback))
+        room = self.rooms.find(room)
+        if room is None:
+            return self
+        cursor = room.pollers.cursor(callback)
+        user = room.pollers.remove(callback)
+        self.log.debug('msg=detaching poller; user=%s; poller=%s; ' + \
+            'cursor=%s', user, LazyRepr(callback), cursor)
         return self
 
-    def _fetch_cached_messages(self, user, cursor, callback_repr):
-        """
-        Fetches cached messages beginning from given cursor
+    def _fetch_cached_messages(self, user, cursor, callback_repr, room):
         """
-        time_treshold = time.time() - self._time_treshold * 60
+        Fetches messages cached in given room beginning from given cursor
+        (callback_repr is printable identity of poller, e.g. LazyRepr).
+
+        Cursor should be taken from 'cursor' key of the last message
+        received - it is valid in every process sharing the chat.
+        Message ID is accepted as cursor too, but messages from other
+        processes may be sent again then
+        """
+        if cursor is None:
+            time_treshold = time.time() - self._time_treshold * 60
+            messages = takewhile(lambda msg: msg['date'] >= time_treshold, \
+                room.cache)
+        else:
+            messages = room.cache.after(cursor)
+            # cursor points to message that is no longer cached
+            if messages is None:
+                self.log.debug('msg=cursor expired; user=%s; cursor=%s; ' + \
+                    'poller=%s', user, cursor, callback_repr)
+                return [self._resync_message(cursor)] + \
+                    self._fetch_cached_messages(user, None, callback_repr, room)
+        keys = user_keys(user)
         out = []
-        for (idx, msg) in enumerate(self._cache):
-            # cursor indicates current message - break
-            if cursor == msg['id']:
-                break
-            # cursor is None - check date or message index
-            elif cursor is None:
-                # message is too old
-                if msg['date'] < time_treshold:
-                    break
+        for msg in messages:
+            # message addressed to somebody else
+            readers = room.cache.readers(msg['id'])
+            if readers is not None and keys.isdisjoint(readers):
+                continue
             # prepare message
-            tmp = self._filter_output(user, msg, callback_repr)
+            tmp = self._filter_output(user, msg, callback_repr, room.id)
             # message returned is None - it can not be returned to user
             if tmp is None:
                 continue
             out.append(tmp)
         out.reverse()
         return out
+
+    def fetch_history(self, user, before=None, limit=50, room=None):
+        """
+        Returns (messages, cursor) with messages older than the one given
+        cursor points to (oldest first). Returned cursor points to the oldest
+        returned message and should be passed to get previous page
+        (None - there are no older messages).
+
+        Cached messages are returned first, older ones are fetched
+        by 'message.history' listeners (e.g. Archive plugin). Messages
+        are ordered by (date, ID) in the same way in every process
+        (see campfire.cache.order_key)
+        """
+        if not self._initialized:
+            raise UninitializedChatError()
+        self.log.debug('msg=fetching history; user=%s; before=%s; ' + \
+            'limit=%s; room=%s', user, before, limit, room)
+        try:
+            limit = max(1, min(int(limit), self.max_history))
+        except (TypeError, ValueError):
+            raise InvalidLimitError(limit)
+        room = self.rooms.get(room)
+        (date, cursor) = self._parse_history_cursor(before, room)
+        keys = user_keys(user)
+        out = []
+        # cached messages
+        messages = sorted(room.cache, key=order_key, reverse=True)
+        if cursor is not None:
+            key = order_key({'date': date, 'id': cursor})
+            messages = [msg for msg in messages if order_key(msg) < key]
+        for msg in messages:
+            (date, cursor) = (msg['date'], msg['id'])
+            readers = room.cache.readers(msg['id'])
+            if readers is not None and keys.isdisjoint(readers):
+                continue
+            tmp = self._filter_output(user, msg, None, room.id)
+            if tmp is None:
+                continue
+            out.append(tmp)
+            if len(out) == limit:
+                return (out[::-1], self._history_cursor(date, cursor))
+        # older messages
+        while len(out) < limit:
+            wanted = limit - len(out)
+            e = self.dispatcher.notify_until(Event(self, 'message.history', \
+                {'room': room.id, 'date': date, 'cursor': cursor, \
+                'limit': wanted}))
+            if not e.processed or not e.return_value:
+                return (out[::-1], None)
+            for msg in e.return_value:
+                (date, cursor) = (msg['date'], msg['id'])
+                tmp = self._filter_output(user, msg, None, room.id)
+                if tmp is not None:
+                    out.append(tmp)
+            if len(e.return_value) < wanted:
+                return (out[::-1], None)
+        return (out[::-1], self._history_cursor(date, cursor))
+
+    def _history_cursor(self, date, cursor):
+        """
+        Prepares history cursor pointing to given message
+        """
+        return '%u:%s' % (date, cursor)
+
+    def _parse_history_cursor(self, before, room):
+        """
+        Returns (date, message ID) history cursor points to.
+        Cursor is either "date:ID" or ID of cached message
+        """
+        if before is None:
+            return (int(time.time()), None)
+        (date, sep, cursor) = str(before).partition(':')
+        if sep:
+            try:
+                return (int(date), cursor)
+            except ValueError:
+                raise InvalidCursorError(before)
+        seq = room.cache.position(before)
+        if seq is None:
+            raise InvalidCursorError(before)
+        return (next(room.cache.older(seq + 1))['date'], before)
+
+    def _resync_message(self, cursor):
+        """
+        Prepares message informing poller that given cursor has expired
+        and whole state must be fetched again.
+        Message has no ID, so poller can continue polling without cursor
+        """
+        msg = self._message('resync', self.system_user_struct, \
+            {'cursor': cursor})
+        msg['id'] = None
+        return msg
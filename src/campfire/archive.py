@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import os
+import csv
+import glob
+import json
+import time
+import zlib
+import heapq
+import Queue
+import threading
+
+##
+# campfire modules
+from cache import order_key
+
+# marks end of queued records
+_STOP = object()
+
+
+class CsvBackend(object):
+    """
+    Archive backend that writes lines to CSV file.
+
+    File is kept open and rotated when its path (strftime pattern) changes
+    """
+
+    def __init__(self, path):
+        """
+        Object initialization
+        """
+        self.path = path
+        self._file = None
+        self._file_path = None
+
+    def write(self, records):
+        """
+        Writes given (date, user, line[, message]) records
+        """
+        f = self._open()
+        archiver = csv.writer(f, delimiter=' ', quoting=csv.QUOTE_MINIMAL)
+        archiver.writerows(record[2] for record in records)
+        f.flush()
+
+    def close(self):
+        """
+        Closes archive file
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._file_path = None
+
+    def _open(self):
+        """
+        Returns handle of current archive file (opens new file when path
+        has changed since last write)
+        """
+        path = time.strftime(self.path)
+        if path != self._file_path:
+            self.close()
+            self._file = open(path, 'a')
+            self._file_path = path
+        return self._file
+
+
+class BlockBackend(CsvBackend):
+    """
+    Archive backend that writes compressed blocks of messages.
+
+    Each block is zlib-compressed JSON list of [date, user, line, message]
+    records (message is optional).
+    Sidecar index (archive path + '.idx') holds one JSON line per block:
+    [offset, length, first date, last date, number of rows, users],
+    so readers can seek straight to blocks they need (see BlockReader).
+
+    Archives read may be given other path (strftime pattern that may
+    contain wildcards), so archives written by many processes
+    are merged when read
+    """
+
+    def __init__(self, path, block_size=100, level=6, read_path=None):
+        """
+        Object initialization
+        """
+        super(BlockBackend, self).__init__(path)
+        self.block_size = block_size
+        self.level = level
+        self.read_path = read_path or path
+        self._index = None
+
+    def write(self, records):
+        """
+        Writes given (date, user, line[, message]) records as blocks
+        of at most block_size records
+        """
+        f = self._open()
+        for i in xrange(0, len(records), self.block_size):
+            self._write_block(f, records[i:i + self.block_size])
+
+    def read(self, start, end, user=None, reverse=False):
+        """
+        Yields records written between start and end (timestamps, inclusive)
+        by given user (newest first when reverse is True)
+        """
+        return read_archive(self.read_path, start, end, user, reverse)
+
+    def close(self):
+        """
+        Closes archive and index files
+        """
+        super(BlockBackend, self).close()
+        if self._index is None:
+            return
+        self._index.close()
+        self._index = None
+
+    def _open(self):
+        """
+        Returns handle of current archive file (index is opened too)
+        """
+        path = time.strftime(self.path)
+        if path != self._file_path:
+            self.close()
+            self._file = open(path, 'ab')
+            self._file.seek(0, os.SEEK_END)
+            self._index = open(path + '.idx', 'a')
+            self._file_path = path
+        return self._file
+
+    def _write_block(self, f, records):
+        """
+        Writes single block and its index entry.
+        Block is written first, so index never points to missing data
+        """
+        data = zlib.compress(json.dumps(records), self.level)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        dates = [record[0] for record in records]
+        users = sorted(set(record[1] for record in records))
+        self._index.write(json.dumps([offset, len(data), min(dates), \
+            max(dates), len(records), users]) + '\n')
+        self._index.flush()
+
+
+class BlockReader(object):
+    """
+    Reads archive written by BlockBackend
+    """
+
+    def __init__(self, path):
+        """
+        Object initialization
+        """
+        self.path = path
+
+    def blocks(self, start=None, end=None, user=None):
+        """
+        Returns index entries of blocks that may contain messages
+        written between start and end (timestamps, inclusive) by given user
+        """
+        try:
+            index = open(self.path + '.idx')
+        except IOError:
+            return []
+        with index:
+            entries = [json.loads(line) for line in index \
+                if line.endswith('\n')]
+        return [e for e in entries if (start is None or e[3] >= start) \
+            and (end is None or e[2] <= end) and (user is None or user in e[5])]
+
+    def messages(self, start=None, end=None, user=None, reverse=False):
+        """
+        Yields records of messages written between start and end
+        (timestamps, inclusive) by given user. Blocks are read one by one
+        (newest first when reverse is True)
+        """
+        blocks = self.blocks(start, end, user)
+        if not blocks:
+            return
+        if reverse:
+            blocks.reverse()
+        with open(self.path, 'rb') as f:
+            for (offset, length, first, last, count, users) in blocks:
+                f.seek(offset)
+                rows = json.loads(zlib.decompress(f.read(length)))
+                if reverse:
+                    rows.reverse()
+                for row in rows:
+                    if start is not None and row[0] < start:
+                        continue
+                    if end is not None and row[0] > end:
+                        continue
+                    if user is not None and row[1] != user:
+                        continue
+                    yield row
+
+
+def record_key(record):
+    """
+    Returns key ordering archive records (see campfire.cache.order_key)
+    """
+    if len(record) < 4:
+        return (record[0], ('', 0))
+    return order_key(record[3])
+
+
+class _Reversed(object):
+    """
+    Key wrapper reversing order
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def merge_records(streams, reverse=False):
+    """
+    Merges streams of records sorted by record_key into one sorted stream
+    (streams and result are sorted newest first when reverse is True)
+    """
+    wrap = _Reversed if reverse else lambda key: key
+    heap = []
+    for stream in streams:
+        stream = iter(stream)
+        for record in stream:
+            heap.append((wrap(record_key(record)), len(heap), record, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        (key, idx, record, stream) = heap[0]
+        yield record
+        for record in stream:
+            heapq.heapreplace(heap, (wrap(record_key(record)), idx, record, \
+                stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def read_archive(path, start, end, user=None, reverse=False):
+    """
+    Yields records of messages written between start and end
+    (timestamps, inclusive) from archive files of given path
+    (strftime pattern, may contain wildcards) covering that period
+    (newest first when reverse is True). Records of files of the same
+    day are merged
+    """
+    paths = []
+    for day in xrange(int(start), int(end) + 86400, 86400):
+        path_of_day = time.strftime(path, time.localtime(min(day, end)))
+        if path_of_day not in paths:
+            paths.append(path_of_day)
+    if reverse:
+        paths.reverse()
+    for path_of_day in paths:
+        files = sorted(glob.glob(path_of_day))
+        for row in merge_records([BlockReader(f).messages(start, end, user, \
+                reverse) for f in files], reverse):
+            yield row
+
+
+class ArchiveWriter(threading.Thread):
+    """
+    Background thread that writes archive records using given backend.
+
+    Chat thread only queues records (without blocking), records are written
+    in batches when there is enough of them or when flush interval passes,
+    so disk latency does not affect chat
+    """
+
+    def __init__(self, backend, log, flush_size=100, flush_interval=5, \
+            queue_size=10000):
+        """
+        Object initialization
+        """
+        threading.Thread.__init__(self, name='campfire.archive')
+        self.daemon = True
+        self.backend = backend
+        self.log = log
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval # seconds
+        self.queue = Queue.Queue(queue_size)
+        self._records = []
+        # metrics
+        self.written = 0      # number of written records
+        self.flushes = 0      # number of flushes
+        self.rejected = 0     # number of times queue was full
+        self.flush_time = 0.0 # duration of last flush (seconds)
+
+    def submit(self, records):
+        """
+        Queues (date, user, line) records to be written. Returns number
+        of accepted records (when queue is full remaining ones should be
+        submitted later)
+        """
+        accepted = 0
+        for record in records:
+            try:
+                self.queue.put_nowait(record)
+            except Queue.Full:
+                self.rejected += 1
+                break
+            accepted += 1
+        return accepted
+
+    def stop(self):
+        """
+        Writes remaining records, closes backend and stops thread
+        """
+        self.queue.put(_STOP)
+        self.join()
+
+    def stats(self):
+        """
+        Returns writer metrics
+        """
+        return {'queued': self.queue.qsize(), 'written': self.written, \
+            'flushes': self.flushes, 'rejected': self.rejected, \
+            'flush_time': self.flush_time}
+
+    def run(self):
+        """
+        Collects queued records and flushes them
+        """
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                record = self.queue.get(True, max(deadline - time.time(), 0))
+            except Queue.Empty:
+                pass
+            else:
+                if record is _STOP:
+                    break
+                self._records.append(record)
+            if len(self._records) >= self.flush_size or time.time() >= deadline:
+                self.flush()
+                deadline = time.time() + self.flush_interval
+        self.flush()
+        self.backend.close()
+
+    def flush(self):
+        """
+        Writes collected records
+        """
+        if not self._records:
+            return
+        records = self._records
+        self._records = []
+        self.log.debug('msg=archiving messages; lines=%u', len(records))
+        start = time.time()
+        try:
+            self.backend.write(records)
+        except:
+            self.log.exception('msg=an error occurred while archiving ' + \
+                'messages; lines=%u', len(records))
+            return
+        self.flush_time = time.time() - start
+        self.written += len(records)
+        self.flushes += 1
+        self.log.info('msg=messages archived; lines=%u; time=%.3f', \
+            len(records), self.flush_time)
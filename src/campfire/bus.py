@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import os
+import json
+import time
+import errno
+import socket
+import logging
+from collections import defaultdict, deque
+
+
+class LocalBus(object):
+    """
+    Message bus of single process.
+
+    Data published on a channel is passed to handlers subscribed
+    to that channel in other processes. Local bus has no other processes,
+    so publishing does nothing
+    """
+
+    # how often (seconds) platform should call flush() (None - never)
+    retry_interval = None
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self._handlers = defaultdict(list)
+
+    def subscribe(self, channel, handler):
+        """
+        Subscribes handler to given channel.
+        Handler is called with published data
+        """
+        self._handlers[channel].append(handler)
+
+    def publish(self, channel, data):
+        """
+        Publishes data on given channel
+        """
+        pass
+
+    def flush(self):
+        """
+        Sends data that could not be sent when it was published
+        """
+        pass
+
+    def fileno(self):
+        """
+        Returns file descriptor that should be watched for incoming data
+        (None - there is nothing to watch)
+        """
+        return None
+
+    def receive(self):
+        """
+        Receives pending data and passes it to subscribed handlers
+        """
+        pass
+
+    def close(self):
+        """
+        Closes bus
+        """
+        pass
+
+    def _dispatch(self, channel, data):
+        """
+        Passes data to handlers subscribed to given channel
+        """
+        for handler in self._handlers[channel]:
+            handler(data)
+
+
+class UnixSocketBus(LocalBus):
+    """
+    Message bus of processes running on the same machine.
+
+    Each process binds datagram Unix socket inside given directory
+    and sends published data to sockets of all other processes
+    found there.
+
+    Datagram that does not fit into receive queue of other process is
+    queued and sent again by flush() (datagrams to that process are
+    queued behind it, so they are received in order of publishing)
+    """
+
+    # how often (seconds) directory is scanned for new processes
+    refresh_interval = 1
+
+    # how often (seconds) queued datagrams are sent again
+    retry_interval = 0.05
+
+    # max number of datagrams queued for single process
+    max_pending = 10000
+
+    # max size of single datagram (bytes)
+    max_size = 262144
+
+    def __init__(self, path, name=None, log=None):
+        """
+        Object initialization
+        """
+        super(UnixSocketBus, self).__init__()
+        self.log = log or logging.getLogger('campfire.bus')
+        self.path = path
+        if name is None:
+            name = os.getpid()
+        self.address = os.path.join(path, '%s.sock' % name)
+        self.dropped = 0 # number of datagrams that could not be sent
+        self._peers = []
+        self._pending = {} # map peer to deque of datagrams to send again
+        self._refreshed = 0
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.address)
+        self._socket.setblocking(0)
+
+    def peers(self):
+        """
+        Returns addresses of sockets of other processes
+        """
+        now = time.time()
+        if now - self._refreshed >= self.refresh_interval:
+            self._refreshed = now
+            self._peers = [os.path.join(self.path, f) for f in \
+                os.listdir(self.path) if f.endswith('.sock')]
+            self._peers = [p for p in self._peers if p != self.address]
+        return self._peers
+
+    def publish(self, channel, data):
+        """
+        Sends data to all other processes
+        """
+        payload = json.dumps([channel, data])
+        for peer in list(self.peers()):
+            if peer in self._pending:
+                self._queue(peer, payload)
+                self._send_pending(peer)
+            elif not self._send(peer, payload):
+                self._queue(peer, payload)
+
+    def flush(self):
+        """
+        Sends queued datagrams
+        """
+        for peer in self._pending.keys():
+            self._send_pending(peer)
+
+    def pending(self):
+        """
+        Returns number of queued datagrams
+        """
+        return sum(len(queue) for queue in self._pending.itervalues())
+
+    def fileno(self):
+        """
+        Returns file descriptor of bound socket
+        """
+        return self._socket.fileno()
+
+    def receive(self):
+        """
+        Receives all pending datagrams
+        """
+        while True:
+            try:
+                payload = self._socket.recv(self.max_size)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            try:
+                (channel, data) = json.loads(payload)
+            except ValueError:
+                self.log.warning('msg=malformed datagram; payload=%s', payload)
+                continue
+            self._dispatch(channel, data)
+
+    def close(self):
+        """
+        Closes and removes bound socket
+        """
+        if self._pending:
+            self.dropped += self.pending()
+            self.log.warning('msg=closing bus with queued datagrams; ' + \
+                'datagrams=%u', self.pending())
+            self._pending.clear()
+        self._socket.close()
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+    def _send(self, peer, payload):
+        """
+        Sends datagram to given peer. Returns False when datagram
+        should be sent again later (receive queue of peer is full)
+        """
+        try:
+            self._socket.sendto(payload, peer)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                return False
+            self.dropped += 1
+            # nobody listens on socket - forget stale peer
+            if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                self._forget(peer)
+            self.log.warning('msg=could not publish data; peer=%s; ' + \
+                'error=%s', peer, e)
+        return True
+
+    def _queue(self, peer, payload):
+        """
+        Queues datagram to be sent to given peer later
+        """
+        queue = self._pending.setdefault(peer, deque())
+        if len(queue) >= self.max_pending:
+            self.dropped += 1
+            self.log.error('msg=too many queued datagrams, dropping ' + \
+                'the oldest one; peer=%s', peer)
+            queue.popleft()
+        queue.append(payload)
+
+    def _send_pending(self, peer):
+        """
+        Sends datagrams queued for given peer (in order of publishing)
+        """
+        queue = self._pending[peer]
+        while queue and self._send(peer, queue[0]):
+            queue.popleft()
+        if not queue:
+            del self._pending[peer]
+
+    def _forget(self, peer):
+        """
+        Removes socket of process that does not exist anymore
+        """
+        dropped = self._pending.pop(peer, ())
+        self.dropped += len(dropped)
+        try:
+            self._peers.remove(peer)
+            os.unlink(peer)
+        except (ValueError, OSError):
+            pass
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+from collections import deque
+from itertools import islice
+
+##
+# campfire modules
+from message import freeze
+
+
+def parse_id(message_id):
+    """
+    Returns (origin, sequence number) pair of message with given ID
+    ("<origin>.<number>", see Api.origin) or None when ID has no origin
+    """
+    try:
+        (origin, sep, seq) = message_id.rpartition('.')
+        if sep:
+            return (origin, int(seq))
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+
+def order_key(message):
+    """
+    Returns key ordering messages by date (messages of the same second
+    by origin and sequence number). Key is the same in every process
+    """
+    return (message['date'], parse_id(message['id']) or (message['id'], 0))
+
+
+def parse_cursor(cursor):
+    """
+    Returns map of origin to sequence number of the newest message seen
+    from that origin. Cursor is comma separated list of message IDs
+    (a single message ID is valid cursor too).
+    None is returned when cursor is not built of IDs with origin
+    """
+    if cursor is None:
+        return None
+    vector = {}
+    for message_id in str(cursor).split(','):
+        parsed = parse_id(message_id)
+        if parsed is None:
+            return None
+        (origin, seq) = parsed
+        vector[origin] = max(vector.get(origin, 0), seq)
+    return vector
+
+
+class MessageCache(object):
+    """
+    Bounded ring buffer of recent messages.
+
+    Each stored message gets monotonically increasing sequence number
+    and message ID is mapped to that number, so cursor can be resolved
+    without scanning whole buffer.
+
+    Messages shared by many processes arrive in different order in each
+    of them, so local sequence numbers can not be compared between
+    processes. Message IDs carry origin (process that accepted message)
+    and sequence number of message within that origin, and each stored
+    message gets cursor - the newest message of every origin seen
+    so far. Such cursor means the same in every process.
+
+    Messages are also indexed by origin (messages of one origin arrive
+    in order of their sequence numbers), so messages newer than cursor
+    are found without scanning whole buffer
+    """
+
+    def __init__(self, size=120):
+        """
+        Object initialization
+        """
+        self._messages = deque([], size) # newest message first
+        self._positions = {}             # map message ID to sequence number
+        self._readers = {}               # map message ID to its readers
+        self._origins = {}               # map origin to [number of cached
+                                         # messages, the newest seq seen]
+        self._evicted = {}               # map origin to the newest seq
+                                         # of evicted messages
+        self._by_origin = {}             # map origin to deque of (seq,
+                                         # sequence number, message),
+                                         # oldest first
+        self.seq = 0                     # sequence number of newest message
+
+    def __len__(self):
+        """
+        Returns number of cached messages
+        """
+        return len(self._messages)
+
+    def __iter__(self):
+        """
+        Iterates over cached messages (newest first)
+        """
+        return iter(self._messages)
+
+    def append(self, message, readers=None):
+        """
+        Stores new message and returns its sequence number.
+        Addressed message should be given identifiers of its readers
+        """
+        if len(self._messages) == self._messages.maxlen:
+            evicted = self._messages.pop()['id']
+            del self._positions[evicted]
+            self._readers.pop(evicted, None)
+            parsed = parse_id(evicted)
+            if parsed is not None:
+                (origin, seq) = parsed
+                self._origins[origin][0] -= 1
+                self._evicted[origin] = max(self._evicted.get(origin, 0), seq)
+                messages = self._by_origin[origin]
+                messages.popleft()
+                if not messages:
+                    del self._by_origin[origin]
+        self.seq += 1
+        self._messages.appendleft(message)
+        self._positions[message['id']] = self.seq
+        parsed = parse_id(message['id'])
+        if parsed is not None:
+            (origin, seq) = parsed
+            stats = self._origins.setdefault(origin, [0, 0])
+            stats[0] += 1
+            stats[1] = max(stats[1], seq)
+            self._by_origin.setdefault(origin, deque()).append((seq, \
+                self.seq, message))
+        if readers is not None:
+            self._readers[message['id']] = frozenset(readers)
+        return self.seq
+
+    def load(self, records):
+        """
+        Restores messages saved earlier. Records are (seq, message, readers)
+        tuples (oldest first), sequence number of the last one is restored
+        """
+        if not records:
+            return
+        self.seq = records[-1][0] - len(records)
+        for (seq, message, readers) in records:
+            self.append(message, readers)
+
+    def position(self, cursor):
+        """
+        Returns sequence number of message with given ID
+        or None when message is not cached (anymore)
+        """
+        return self._positions.get(cursor)
+
+    def stamp(self, message):
+        """
+        Returns copy of given message with cursor of position it gets
+        when appended ('cursor' key). Cursor holds origins of cached
+        messages only, so origins of processes that are gone are dropped
+        """
+        parsed = parse_id(message['id'])
+        if parsed is None:
+            return message
+        vector = dict((origin, stats[1]) for (origin, stats) \
+            in self._origins.iteritems() if stats[0])
+        if len(self._messages) == self._messages.maxlen:
+            evicted = parse_id(self._messages[-1]['id'])
+            if evicted is not None and 1 == self._origins[evicted[0]][0]:
+                del vector[evicted[0]]
+        (origin, seq) = parsed
+        vector[origin] = max(vector.get(origin, 0), seq)
+        cursor = ','.join('%s.%u' % i for i in sorted(vector.iteritems()))
+        return freeze(dict(message, cursor=cursor))
+
+    def after(self, cursor):
+        """
+        Returns list of messages newer than given cursor (newest first)
+        or None when some of them are no longer cached.
+        Cursor is ID of cached message or cursor built by stamp();
+        messages of origins missing in cursor are newer than it
+        """
+        seq = self.position(cursor)
+        # all cached messages come from one origin (e.g. single process),
+        # so local order is the same as order of that origin
+        if seq is not None and len(self._by_origin) <= 1:
+            return list(self.newer(seq))
+        vector = parse_cursor(cursor)
+        if vector is None:
+            if seq is None:
+                return None
+            return list(self.newer(seq))
+        for (origin, seq) in vector.iteritems():
+            if self._evicted.get(origin, 0) > seq:
+                return None
+        out = []
+        for (origin, messages) in self._by_origin.iteritems():
+            last = vector.get(origin, 0)
+            for (seq, position, message) in reversed(messages):
+                if seq <= last:
+                    break
+                out.append((position, message))
+        out.sort(reverse=True)
+        return [message for (position, message) in out]
+
+    def ahead(self, cursor):
+        """
+        Returns part of given cursor that points to messages which have
+        not arrived yet (from other processes) or None when there is
+        no such part
+        """
+        vector = parse_cursor(cursor)
+        if vector is None:
+            return None
+        ahead = dict((origin, seq) for (origin, seq) in vector.iteritems() \
+            if seq > self._origins.get(origin, (0, 0))[1])
+        return ahead or None
+
+    def readers(self, cursor):
+        """
+        Returns identifiers of readers of message with given ID
+        or None when message is not addressed
+        """
+        return self._readers.get(cursor)
+
+    def newer(self, seq):
+        """
+        Returns iterator over messages newer than given sequence number
+        (newest first)
+        """
+        return islice(self._messages, 0, max(self.seq - seq, 0))
+
+    def older(self, seq):
+        """
+        Returns iterator over messages older than given sequence number
+        (newest first)
+        """
+        return islice(self._messages, max(self.seq - seq + 1, 0), None)
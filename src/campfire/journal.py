@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import os
+import json
+import mmap
+import Queue
+import struct
+import logging
+import threading
+from collections import defaultdict, deque
+
+##
+# campfire modules
+from message import freeze
+
+# record header: length of room ID and length of record payload
+_HEADER = struct.Struct('>II')
+
+# marks end of queued records
+_STOP = object()
+
+
+class Journal(object):
+    """
+    Journal of delivered messages.
+
+    Journal lets rooms restore recent messages after restart.
+    This one does not persist anything
+    """
+
+    # journal keeps messages of rooms that are no longer in memory
+    persistent = False
+
+    def append(self, room_id, seq, message, readers=None):
+        """
+        Saves message delivered to room (with its sequence number
+        and readers of addressed message)
+        """
+        pass
+
+    def recent(self, room_id):
+        """
+        Returns list of (seq, message, readers) saved for given room
+        (oldest first)
+        """
+        return []
+
+    def close(self):
+        """
+        Closes journal
+        """
+        pass
+
+
+class FileJournal(Journal):
+    """
+    Append-only file journal.
+
+    Each record consists of header, room ID (JSON) and JSON payload
+    [seq, message, readers]. On opening, the file is memory-mapped and
+    headers and room IDs are scanned to find offsets of the last 'keep'
+    records of each room (payloads are parsed only when room is restored).
+    Records appended later are also kept in memory (the last 'keep'
+    of each room), so rooms are restored without reading the file.
+
+    Chat thread only encodes and queues records, background thread writes
+    them in batches and compacts the file when it grows above max_size
+    (rewrites it with records that can still be restored), so disk latency
+    does not affect chat (see campfire.archive.ArchiveWriter)
+    """
+
+    # journal keeps messages of rooms that are no longer in memory
+    persistent = True
+
+    # file size (bytes) that triggers compaction
+    max_size = 16 * 1024 * 1024
+
+    # max number of records written at once
+    flush_size = 100
+
+    def __init__(self, path, keep=120, log=None, queue_size=10000):
+        """
+        Object initialization
+        """
+        self.log = log or logging.getLogger('campfire.journal')
+        self.path = path
+        self.keep = keep
+        self._offsets = defaultdict(self._offsets_factory) # map room ID to
+                                                           # record offsets
+        self._map = None
+        self._file = open(path, 'a+b')
+        self._size = self._scan()
+        self._limit = max(self.max_size, 2 * self._size)
+        # records scanned on opening (read by chat thread only, file is
+        # replaced by compaction, but its memory map stays valid)
+        self._restored = dict((room_id, list(offsets)) for (room_id, \
+            offsets) in self._offsets.iteritems())
+        self._recent = defaultdict(self._offsets_factory) # map room ID to
+                                                          # records appended
+        self.rejected = 0 # number of records not journaled
+        self._queue = Queue.Queue(queue_size)
+        self._writer = threading.Thread(target=self._run, \
+            name='campfire.journal')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _offsets_factory(self):
+        """
+        Creates container for offsets (or records) of room
+        """
+        return deque([], self.keep)
+
+    def append(self, room_id, seq, message, readers=None):
+        """
+        Saves message delivered to room
+        """
+        if readers is not None:
+            readers = list(readers)
+        try:
+            room = json.dumps(room_id)
+            payload = json.dumps([seq, message, readers])
+        except (TypeError, ValueError), e:
+            # e.g. arguments that are not UTF-8
+            self.rejected += 1
+            self.log.warning('msg=message can not be journaled; room=%s; ' + \
+                'seq=%s; error=%s', room_id, seq, e)
+            return
+        try:
+            self._queue.put_nowait((room_id, _HEADER.pack(len(room), \
+                len(payload)) + room + payload))
+        except Queue.Full:
+            self.rejected += 1
+            self.log.warning('msg=journal queue is full; room=%s; seq=%s', \
+                room_id, seq)
+            return
+        if readers is not None:
+            readers = set(readers)
+        self._recent[room_id].append((seq, message, readers))
+
+    def recent(self, room_id):
+        """
+        Returns list of (seq, message, readers) saved for given room
+        (oldest first)
+        """
+        records = []
+        for offset in self._restored.get(room_id, ()):
+            (seq, message, readers) = json.loads(self._read(offset)[1])
+            if readers is not None:
+                readers = set(readers)
+            records.append((seq, freeze(message), readers))
+        records.extend(self._recent.get(room_id, ()))
+        return records[-self.keep:]
+
+    def compact(self):
+        """
+        Rewrites journal with records that can still be restored.
+        Called by writer thread
+        """
+        self.log.info('msg=compacting journal; path=%s; size=%u', self.path, \
+            self._size)
+        offsets = sorted(offset for room in self._offsets.itervalues() \
+            for offset in room)
+        tmp = self.path + '.tmp'
+        with open(self.path, 'rb') as source:
+            with open(tmp, 'wb') as f:
+                for offset in offsets:
+                    source.seek(offset)
+                    (room_length, length) = _HEADER.unpack(\
+                        source.read(_HEADER.size))
+                    f.write(_HEADER.pack(room_length, length) + \
+                        source.read(room_length + length))
+        os.rename(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, 'a+b')
+        self._offsets.clear()
+        self._size = self._scan(False)
+        # retained records may take most of max_size - do not compact
+        # again until journal doubles
+        self._limit = max(self.max_size, 2 * self._size)
+        self.log.info('msg=journal compacted; path=%s; size=%u', self.path, \
+            self._size)
+
+    def close(self):
+        """
+        Writes queued records and closes journal file
+        """
+        self._queue.put(_STOP)
+        self._writer.join()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _run(self):
+        """
+        Writes queued records in batches (writer thread)
+        """
+        while True:
+            records = [self._queue.get()]
+            while records[-1] is not _STOP and \
+                    len(records) < self.flush_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = records[-1] is _STOP
+            if stop:
+                records.pop()
+            try:
+                self._write(records)
+            except:
+                self.log.exception('msg=an error occurred while writing ' + \
+                    'journal; path=%s; records=%u', self.path, len(records))
+            if stop:
+                return
+
+    def _write(self, records):
+        """
+        Writes (room ID, record) pairs and compacts journal when necessary
+        """
+        if not records:
+            return
+        for (room_id, record) in records:
+            self._offsets[room_id].append(self._size)
+            self._size += len(record)
+        self._file.write(''.join(record for (room_id, record) in records))
+        self._file.flush()
+        if self._size > self._limit:
+            self.compact()
+
+    def _scan(self, restore=True):
+        """
+        Finds offsets of records and returns size of journal.
+        Incomplete record at the end (e.g. after crash) is truncated.
+        File is memory-mapped when records are going to be restored
+        """
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        if 0 == size:
+            return 0
+        data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        while offset + _HEADER.size <= size:
+            (room_length, length) = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            end = start + room_length + length
+            if end > size:
+                break
+            room_id = json.loads(data[start:start + room_length])
+            self._offsets[room_id].append(offset)
+            offset = end
+        if offset < size:
+            self.log.warning('msg=truncating incomplete journal record; ' + \
+                'path=%s; offset=%u', self.path, offset)
+            data.close()
+            self._file.truncate(offset)
+            if restore and offset > 0:
+                data = mmap.mmap(self._file.fileno(), 0, \
+                    access=mmap.ACCESS_READ)
+            else:
+                data = None
+        if restore:
+            self._map = data
+        elif data is not None:
+            data.close()
+        return offset
+
+    def _read(self, offset):
+        """
+        Returns (room ID, payload) of record at given offset (both encoded)
+        of the file scanned on opening
+        """
+        (room_length, length) = _HEADER.unpack_from(self._map, offset)
+        start = offset + _HEADER.size
+        middle = start + room_length
+        return (self._map[start:middle], self._map[middle:middle + length])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import copy
+
+
+class FrozenDict(dict):
+    """
+    Read-only dictionary.
+
+    Stored messages are shared by all readers, so none of them
+    is allowed to change it. Changes should be made on a copy
+    (dict(message) is cheap, because nested values are frozen too)
+    """
+
+    def _readonly(self, *args, **kwargs):
+        """
+        Prevents from modifying dictionary
+        """
+        raise TypeError("'%s' object is read-only" % self.__class__.__name__)
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __copy__(self):
+        """
+        Returns modifiable (shallow) copy
+        """
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        """
+        Returns modifiable (deep) copy
+        """
+        return dict((k, copy.deepcopy(v, memo)) for (k, v) in self.iteritems())
+
+    def __reduce__(self):
+        """
+        Allows pickling
+        """
+        return (self.__class__, (dict(self),))
+
+
+def freeze(value):
+    """
+    Returns read-only version of given value (dicts and lists are
+    converted recursively)
+    """
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for (k, v) in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class Batch(list):
+    """
+    List of messages sent to pollers.
+
+    The same batch is passed to every poller that should receive
+    the same messages, so serialized forms of it are cached
+    and computed only once
+    """
+
+    def __init__(self, messages=()):
+        """
+        Object initialization
+        """
+        list.__init__(self, messages)
+        self._encoded = {}
+
+    def encode(self, key, encoder):
+        """
+        Returns batch serialized by given encoder.
+        Result is cached under given key
+        """
+        try:
+            return self._encoded[key]
+        except KeyError:
+            self._encoded[key] = encoder(self)
+            return self._encoded[key]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+from bisect import bisect_left
+from collections import OrderedDict
+
+# default buckets of histograms (seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, \
+    0.25, 0.5, 1.0, 2.5)
+
+
+class Counter(object):
+    """
+    Value that only goes up
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        Increments value
+        """
+        self.value += amount
+
+    def samples(self, name, labels):
+        """
+        Returns list of (name, labels, value) samples
+        """
+        return [(name, labels, self.value)]
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down. Gauge given function reports its result
+    (it is called only when metrics are collected)
+    """
+    __slots__ = ('function',)
+
+    def __init__(self, function=None):
+        """
+        Object initialization
+        """
+        Counter.__init__(self)
+        self.function = function
+
+    def dec(self, amount=1):
+        """
+        Decrements value
+        """
+        self.value -= amount
+
+    def set(self, value):
+        """
+        Sets value
+        """
+        self.value = value
+
+    def samples(self, name, labels):
+        """
+        Returns list of (name, labels, value) samples
+        """
+        if self.function is not None:
+            return [(name, labels, self.function())]
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    """
+    Distribution of observed values (counts in buckets)
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Object initialization
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Records value
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """
+        Returns list of (name, labels, value) samples
+        (buckets are cumulative)
+        """
+        out = []
+        total = 0
+        for (bound, count) in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            out.append((name + '_bucket', labels + (('le', str(bound)),), \
+                total))
+        out.append((name + '_sum', labels, self.sum))
+        out.append((name + '_count', labels, self.count))
+        return out
+
+
+class Registry(object):
+    """
+    Registry of metrics rendered in Prometheus text format.
+
+    Metric is identified by name and labels; the same object is returned
+    for the same name and labels, so callers should keep it and update it
+    directly on hot paths
+    """
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self._metrics = OrderedDict() # map name to (type, help, map labels
+                                      # to metric)
+
+    def counter(self, name, help, **labels):
+        """
+        Returns counter
+        """
+        return self._get('counter', name, help, labels, Counter)
+
+    def gauge(self, name, help, function=None, **labels):
+        """
+        Returns gauge (reporting result of given function)
+        """
+        return self._get('gauge', name, help, labels, \
+            lambda: Gauge(function))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Returns histogram
+        """
+        return self._get('histogram', name, help, labels, \
+            lambda: Histogram(buckets))
+
+    def _get(self, kind, name, help, labels, factory):
+        """
+        Returns metric of given name and labels (creates it when needed)
+        """
+        if name not in self._metrics:
+            self._metrics[name] = (kind, help, OrderedDict())
+        elif kind != self._metrics[name][0]:
+            raise ValueError('Metric %s is a %s' % (name, \
+                self._metrics[name][0]))
+        metrics = self._metrics[name][2]
+        key = tuple(sorted(labels.iteritems()))
+        if key not in metrics:
+            metrics[key] = factory()
+        return metrics[key]
+
+    def collect(self):
+        """
+        Returns list of (name, labels, value) samples of all metrics
+        """
+        return [sample for (name, (kind, help, metrics)) \
+            in self._metrics.iteritems() \
+            for (labels, metric) in metrics.iteritems() \
+            for sample in metric.samples(name, labels)]
+
+    def render(self):
+        """
+        Returns metrics in Prometheus text format
+        """
+        lines = []
+        for (name, (kind, help, metrics)) in self._metrics.iteritems():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, metric) in metrics.iteritems():
+                for (sample, labels, value) in metric.samples(name, labels):
+                    lines.append('%s%s %s' % (sample, _labels(labels), \
+                        _value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """
+    Formats labels of sample
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\') \
+        .replace('"', '\\"').replace('\n', '\\n')) for (k, v) in labels)
+
+
+def _value(value):
+    """
+    Formats value of sample
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -19,12 +19,28 @@ import tornado.auth
 import tornado.escape
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 import tornado.websocket
 from tornado.escape import json_encode, json_decode
 
+import os
 import os.path
+import gzip
+import errno
+import random
+import signal
+from cStringIO import StringIO
+
+from campfire.message import Batch
+from campfire.api import UninitializedChatError, InvalidCursorError, \
+    InvalidLimitError
+
+
+# WebSocket messages can be compressed (permessage-deflate) by Tornado 4.0+
+WEBSOCKET_COMPRESSION = tornado.version_info >= (4, 0)
 
 
 class Response(dict):
@@ -38,11 +54,23 @@ class Response(dict):
         self.__setitem__('status', 1)
 
 
+def gzip_compress(data, level=6):
+    """
+    Compresses given data using gzip format
+    """
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=level)
+    f.write(tornado.escape.utf8(data))
+    f.close()
+    return buf.getvalue()
+
+
 class BaseHandler(tornado.web.RequestHandler):
     """
     Base class for chat handlers
     """
-    
+    transport = None # name connections of handler are counted under
+
     def initialize(self, log, api, auth):
         """
         Prepares instance
@@ -51,6 +79,26 @@ class BaseHandler(tornado.web.RequestHandler):
         self.api = api
         self.auth = auth
         self.cookie_name = 'chat_user'
+        self.ticket_cookie_name = 'chat_ticket'
+        self.room = None
+        self.connection = None # gauge of open connections of transport
+
+    def open_connection(self):
+        """
+        Counts open connection of handler transport
+        """
+        self.connection = self.api.metrics.gauge('campfire_connections', \
+            'Open connections waiting for messages', \
+            transport=self.transport)
+        self.connection.inc()
+
+    def close_connection(self):
+        """
+        Stops counting connection (it may be called many times)
+        """
+        if self.connection is not None:
+            self.connection.dec()
+            self.connection = None
     
     def prepare_response(self, response):
         """
@@ -58,6 +106,23 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         return json_encode(response)
 
+    def prepare_messages(self, messages):
+        """
+        Prepare response with messages ("stringify")
+        """
+        response = Response()
+        response['messages'] = messages
+        return self.prepare_response(response)
+
+    def encode_messages(self, messages, key, encoder):
+        """
+        Serializes messages using given encoder.
+        Batch of messages shared by many pollers is serialized only once
+        """
+        if isinstance(messages, Batch):
+            return messages.encode(key, encoder)
+        return encoder(messages)
+
     def get_error_html(self, status_code, exception=None, **kwargs):
         """
         Handles error response
@@ -87,32 +152,82 @@ class BaseHandler(tornado.web.RequestHandler):
         # prepare auxyliary arguments
         auxArgs = {}
         message = None
+        room = None
         for arg in arguments:
             if "message" == arg:
                 message = arguments.get(arg, [''])[0]
                 continue
+            if "room" == arg:
+                room = arguments.get(arg, [None])[0]
+                continue
             auxArgs[arg] = arguments.get(arg, None)
         if not message:
             raise tornado.web.HTTPError(400)
         # write message
         try:
-            return self.api.recv(message, self.current_user, auxArgs)
+            return self.api.recv(message, self.current_user, auxArgs, room)
         except RuntimeError, e:
             self.set_status(500)
             return self._get_error_response(500, e)
 
+    def fetch_history(self, arguments):
+        """
+        Fetches page of older messages
+        """
+        before = arguments.get('before', [None])[0]
+        if 'null' == before:
+            before = None
+        try:
+            (messages, cursor) = self.api.fetch_history(self.current_user, \
+                before, arguments.get('limit', [50])[0], \
+                arguments.get('room', [None])[0])
+        except InvalidCursorError:
+            self.set_status(400)
+            return self._get_error_response(400, 'Invalid cursor')
+        except InvalidLimitError:
+            self.set_status(400)
+            return self._get_error_response(400, 'Limit must be a number')
+        response = Response()
+        response['messages'] = messages
+        response['cursor'] = cursor
+        return response
+
     def get_current_user(self):
         """
-        Fetches current user
+        Fetches current user.
+        When signed tickets are enabled, user is taken from ticket
+        (new ticket is issued when it is missing or expired)
         """
+        if self.auth.signer is not None:
+            user = self.auth.get_ticket_user(\
+                self.get_cookie(self.ticket_cookie_name))
+            if user is not None:
+                return user
         cookie = self.get_secure_cookie(self.cookie_name)
-        return self.auth.get_current_user(cookie)
+        user = self.auth.get_current_user(cookie)
+        if user is not None and self.auth.signer is not None:
+            self.set_ticket(cookie)
+        return user
+
+    def set_ticket(self, token):
+        """
+        Sets cookie with signed ticket of session with given token
+        """
+        ticket = self.auth.ticket(token)
+        if ticket is not None and not self._headers_written:
+            self.set_cookie(self.ticket_cookie_name, ticket)
 
 
 class HttpHandler(BaseHandler):
     """
-    Handler that allows posting new messages and polling via HTTP
+    Handler that allows posting new messages and polling via HTTP.
+    Responses may be compressed (gzip) for clients accepting it;
+    batch shared by many pollers is compressed only once
     """
+    transport = 'poll'
+    compress = False # opt-in
+    compress_min_length = 1024 # bytes
+    compress_level = 6
 
     @tornado.web.authenticated
     def post(self):
@@ -131,7 +246,10 @@ class HttpHandler(BaseHandler):
         cursor = self.get_argument("cursor", None)
         if 'null' == cursor:
             cursor = None
-        self.api.attach_poller(self.current_user, self._respond, cursor)
+        self.room = self.get_argument("room", None)
+        self.open_connection()
+        self.api.attach_poller(self.current_user, self._respond, cursor, \
+            self.room)
 
     def _respond(self, messages):
         """
@@ -140,53 +258,95 @@ class HttpHandler(BaseHandler):
         # Closed client connection
         if self.request.connection.stream.closed():
             return
-        r = Response()
-        r['messages'] = messages
-        self.finish(self.prepare_response(r))
+        body = self.encode_messages(messages, 'http', self.prepare_messages)
+        if self.compress:
+            self.set_header('Vary', 'Accept-Encoding')
+            if len(body) >= self.compress_min_length and \
+                    'gzip' in self.request.headers.get('Accept-Encoding', ''):
+                body = self.encode_messages(messages, 'http.gz', \
+                    lambda batch: gzip_compress(body, self.compress_level))
+                self.set_header('Content-Encoding', 'gzip')
+        self.finish(body)
 
     def on_connection_close(self):
         """
         Cleanup async connections on close
         """
-        self.api.detach_poller(self._respond)
+        self.close_connection()
+        self.api.detach_poller(self._respond, self.room)
+
+    def on_finish(self):
+        """
+        Stops counting finished connection
+        """
+        self.close_connection()
 
 
 class SocketHandler(BaseHandler, tornado.websocket.WebSocketHandler):
     """
-    Handler that allows posting new messages and polling via WebSockets
+    Handler that allows posting new messages and polling via WebSockets.
+    Socket subscribes once and stays attached, cursor is tracked by chat
     """
+    transport = 'socket'
+    ping_interval = 30 # seconds
+    pinger = None
+    compress = False # opt-in permessage-deflate (see WEBSOCKET_COMPRESSION)
+    compress_level = 6
+
+    def get_compression_options(self):
+        """
+        Enables permessage-deflate extension (called by Tornado 4.0+ only,
+        older versions never compress WebSocket messages)
+        """
+        if not self.compress:
+            return None
+        return {'compression_level': self.compress_level}
 
-    def attach_poller(self):
+    def subscribe(self):
         """
-        Attaches poller
+        Subscribes to messages newer than cursor
         """
-        self.api.attach_poller(self.current_user, \
-            self._respond, self.get_argument("cursor", None))
+        self.room = self.get_argument("room", None)
+        self.api.subscribe(self.current_user, self._respond, \
+            self.get_argument("cursor", None), self.room)
 
     @tornado.web.asynchronous
     def open(self):
         """
         Open WebSocket
         """
-        self.attach_poller()
+        self.pinger = tornado.ioloop.PeriodicCallback(self._ping, \
+            self.ping_interval * 1000)
+        self.pinger.start()
+        self.open_connection()
+        self.subscribe()
 
     def on_message(self, message):
         """
-        Post new message
+        Post new message (or fetch history when "history" argument is given)
         """
-        self.write_message(self.post_message(json_decode(message)))
+        arguments = json_decode(message)
+        if 'history' in arguments:
+            self.write_message(self.prepare_response(\
+                self.fetch_history(arguments)))
+            return
+        self.write_message(self.post_message(arguments))
 
     def on_close(self):
         """
         Cleanup when socket gets closed
         """
-        pass
+        if self.pinger is not None:
+            self.pinger.stop()
+        self.close_connection()
+        if self.api.subscribed(self._respond, self.room):
+            self.api.detach_poller(self._respond, self.room)
 
     def allow_draft76(self):
         """
-        Allow old version of WS protocol
+        Allow old version of WS protocol (Tornado < 4.0)
         """
-        return true
+        return True
 
     def _respond(self, response):
         """
@@ -195,8 +355,163 @@ class SocketHandler(BaseHandler, tornado.websocket.WebSocketHandler):
         # Closed client connection
         if self.request.connection.stream.closed():
             return
-        self.write_message(self.prepare_response(response))
-        self.attach_poller()
+        self.write_message(self.encode_messages(response, 'socket', \
+            self.prepare_response))
+        # subscription has ended (chat has been shut down)
+        if not self.api.subscribed(self._respond, self.room):
+            self.close()
+
+    def _ping(self):
+        """
+        Send ping frame
+        """
+        if self.request.connection.stream.closed():
+            return
+        self.ping('')
+
+
+class EventStreamHandler(BaseHandler):
+    """
+    Handler that pushes messages as Server-Sent Events over one
+    streaming response. Cursor of message is sent as event ID, so
+    reconnecting browser resumes from it (Last-Event-ID header), even
+    when it is connected to other process
+    """
+    transport = 'sse'
+    heartbeat_interval = 15 # seconds
+    heartbeat = None
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get(self):
+        """
+        Open stream of messages
+        """
+        self.room = self.get_argument("room", None)
+        cursor = self.request.headers.get("Last-Event-ID") or \
+            self.get_argument("cursor", None)
+        if 'null' == cursor:
+            cursor = None
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.flush()
+        # keep connection alive (proxies close idle connections)
+        self.heartbeat = tornado.ioloop.PeriodicCallback(self._heartbeat, \
+            self.heartbeat_interval * 1000)
+        self.heartbeat.start()
+        self.open_connection()
+        try:
+            self.api.subscribe(self.current_user, self._respond, cursor, \
+                self.room)
+        except UninitializedChatError:
+            # chat has been shut down
+            self.heartbeat.stop()
+            self.finish()
+
+    def prepare_events(self, messages):
+        """
+        Prepare events with messages ("stringify")
+        """
+        events = []
+        for message in messages:
+            if message['id'] is not None:
+                events.append('id: %s\n' % message.get('cursor', \
+                    message['id']))
+            events.append('data: %s\n\n' % json_encode(message))
+        return ''.join(events)
+
+    def _respond(self, messages):
+        """
+        Send events
+        """
+        # Closed client connection
+        if self.request.connection.stream.closed():
+            return
+        self.write(self.encode_messages(messages, 'sse', self.prepare_events))
+        self.flush()
+        # subscription has ended (chat has been shut down)
+        if not self.api.subscribed(self._respond, self.room):
+            self.heartbeat.stop()
+            self.finish()
+
+    def _heartbeat(self):
+        """
+        Send comment line
+        """
+        if self.request.connection.stream.closed():
+            return
+        self.write(': ping\n\n')
+        self.flush()
+
+    def on_connection_close(self):
+        """
+        Cleanup async connections on close
+        """
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        self.close_connection()
+        if self.api.subscribed(self._respond, self.room):
+            self.api.detach_poller(self._respond, self.room)
+
+    def on_finish(self):
+        """
+        Stops counting finished stream
+        """
+        self.close_connection()
+
+
+class HistoryHandler(BaseHandler):
+    """
+    Handler that allows fetching older messages page by page
+    """
+
+    @tornado.web.authenticated
+    def get(self):
+        """
+        Fetch messages older than given cursor
+        """
+        self.finish(self.prepare_response(\
+            self.fetch_history(self.request.arguments)))
+
+
+class StatsHandler(BaseHandler):
+    """
+    Handler that reports timing of plugin listeners.
+
+    Requests are not authenticated, so handler should be served only
+    on internal port (see fork_server)
+    """
+
+    def initialize(self, log, api, auth, stats):
+        """
+        Prepares instance
+        """
+        BaseHandler.initialize(self, log, api, auth)
+        self.stats = stats
+
+    def get(self):
+        """
+        Returns stats (slowest listeners first)
+        """
+        response = Response()
+        response['plugins'] = self.stats.snapshot()
+        self.finish(self.prepare_response(response))
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Handler that reports metrics of chat (Prometheus text format).
+
+    Requests are not authenticated, so handler should be served only
+    on internal port (see fork_server)
+    """
+
+    def get(self):
+        """
+        Returns metrics
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(self.api.metrics.render())
 
 
 class AuthHandler(BaseHandler):
@@ -243,6 +558,175 @@ class AuthHandler(BaseHandler):
         self.auth.logout(cookie)
         # remove cookie
         self.set_secure_cookie(self.cookie_name, '', -1)
+        self.clear_cookie(self.ticket_cookie_name)
         response = Response()
         response["auth"] = "You are now logged out"
         self.finish(self.prepare_response(response))
+
+
+def watch_bus(bus, io_loop=None):
+    """
+    Makes IOLoop receive data that other processes publish on given bus
+    (and send data that could not be sent right away).
+    Receive queue of other process is not reflected by writability
+    of (unconnected) datagram socket, so queued data is sent on timer
+    """
+    if bus.fileno() is None:
+        return
+    io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+    io_loop.add_handler(bus.fileno(), lambda fd, events: bus.receive(), \
+        io_loop.READ)
+    if bus.retry_interval is not None:
+        tornado.ioloop.PeriodicCallback(bus.flush, \
+            bus.retry_interval * 1000, io_loop).start()
+
+
+def serve(application, api, sockets, periodic_interval=60, io_loop=None, \
+        internal=None, **kwargs):
+    """
+    Runs chat application on given (already bound) sockets until
+    SIGTERM or SIGINT is received. Internal is optional (application,
+    sockets) pair served next to chat (e.g. metrics on loopback
+    interface). Remaining keyword arguments are passed to HTTPServer
+    """
+    io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+    server = tornado.httpserver.HTTPServer(application, io_loop=io_loop, \
+        **kwargs)
+    server.add_sockets(sockets)
+    servers = [server]
+    if internal is not None:
+        servers.append(tornado.httpserver.HTTPServer(internal[0], \
+            io_loop=io_loop))
+        servers[-1].add_sockets(internal[1])
+    watch_bus(api.bus, io_loop)
+    # timer used by batch window (see Api.batch_window)
+    api.call_later = lambda delay, callback: \
+        io_loop.add_timeout(io_loop.time() + delay, callback)
+    api.init()
+
+    # periodic callback (each process runs its own)
+    periodic = tornado.ioloop.PeriodicCallback(api.periodic_notification, \
+        periodic_interval * 1000, io_loop)
+    periodic.start()
+
+    def _stop():
+        periodic.stop()
+        for tmp in servers:
+            tmp.stop()
+        api.shutdown()
+        api.bus.close()
+        api.journal.close()
+        # let responses sent on shutdown be written
+        io_loop.add_callback(io_loop.stop)
+
+    def _shutdown(signum, stack_frame):
+        io_loop.add_callback(_stop)
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    io_loop.start()
+
+
+def fork_workers(num_processes=None, max_restarts=100):
+    """
+    Forks worker processes. Returns ID of worker (0 .. num_processes - 1)
+    in each worker and None in parent process, once all workers have
+    exited. Workers that exit abnormally are restarted with the same ID.
+
+    Parent process keeps PIDs of its workers and passes SIGTERM and SIGINT
+    to them only (other processes of its group, e.g. shell running it,
+    are not signalled); workers are not restarted after that
+    """
+    if num_processes is None or num_processes <= 0:
+        num_processes = tornado.process.cpu_count()
+    children = {} # map PID to worker ID
+    stopping = []
+
+    def _start(worker_id):
+        pid = os.fork()
+        if 0 == pid:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            return worker_id
+        children[pid] = worker_id
+        return None
+
+    def _forward(signum, stack_frame):
+        stopping.append(signum)
+        for pid in children.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if errno.ESRCH != e.errno:
+                    raise
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for i in xrange(0, num_processes):
+        if _start(i) is not None:
+            return i
+    restarts = 0
+    while children:
+        try:
+            (pid, status) = os.wait()
+        except OSError, e:
+            if errno.EINTR == e.errno:
+                continue
+            raise
+        if pid not in children:
+            continue
+        worker_id = children.pop(pid)
+        if stopping or (os.WIFEXITED(status) and \
+                0 == os.WEXITSTATUS(status)):
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('Too many worker restarts')
+        if _start(worker_id) is not None:
+            return worker_id
+    return None
+
+
+def fork_server(factory, port, num_processes=None, address=None, \
+        periodic_interval=60, internal_port=None, \
+        internal_address='127.0.0.1', **kwargs):
+    """
+    Runs chat in many processes sharing one listening socket.
+
+    Socket is bound before processes are forked (num_processes=None
+    means one process per CPU, 1 means no forking at all). Factory is called
+    in each process with ID of that process (0 .. num_processes - 1)
+    and should return (application, api) pair. Api instances should use
+    bus shared by all processes (e.g. campfire.bus.UnixSocketBus),
+    otherwise messages and sessions are not shared. Clients may switch
+    between processes, as long as they resume from 'cursor' of the last
+    message received (see campfire.cache.MessageCache).
+    Signals received by parent process are passed to workers
+    (see fork_workers).
+
+    When internal_port is given, factory should return (application, api,
+    internal_application) triple. Internal application is served
+    on internal_address (loopback interface by default) and should
+    contain handlers that are not authenticated (MetricsHandler,
+    StatsHandler). Metrics are kept by each process, so each worker
+    binds its own internal port (internal_port + worker ID) and every
+    such port should be scraped
+    """
+    sockets = tornado.netutil.bind_sockets(port, address)
+    worker_id = 0
+    if 1 != num_processes:
+        worker_id = fork_workers(num_processes)
+        # all workers have exited
+        if worker_id is None:
+            return
+    internal = None
+    if not internal_port:
+        (application, api) = factory(worker_id)
+    else:
+        (application, api, internal_application) = factory(worker_id)
+        internal = (internal_application, tornado.netutil.bind_sockets(\
+            internal_port + worker_id, internal_address))
+    serve(application, api, sockets, periodic_interval, internal=internal, \
+        **kwargs)
@@ -17,6 +17,7 @@ class AntiFlood(Plugin):
 
     Prevents user from flooding chat
     """
+    audience_attrs = ['id', 'ip', 'name', 'logged', 'hasAccount']
 
     def __init__(self, count=5, time=15):
         """
@@ -79,6 +80,14 @@ class AntiFlood(Plugin):
 
         return data
 
+    def audience(self, user, message):
+        """
+        Not flooded messages are visible for everyone
+        """
+        if not message.get('flood'):
+            return ()
+        return super(AntiFlood, self).audience(user, message)
+
     @synchronous
     def prevent(self, event):
         """
@@ -1,15 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-##
-# python stdlib
-import time
-import csv
-import copy
-
 ##
 # campfire.api
 from campfire.utils import Plugin
+from campfire.archive import ArchiveWriter, CsvBackend
+from campfire.cache import order_key
 from event import synchronous
 
 
@@ -17,29 +13,47 @@ class Archive(Plugin):
     """
     Archive plugin.
 
-    Writes messages to archive
+    Writes messages to archive (in background thread).
+    By default lines are appended to CSV file, other backends
+    (e.g. campfire.archive.BlockBackend) may be given. Backends that can
+    be read (have 'read' method) serve history of messages. When many
+    processes share the chat, each of them archives messages it has
+    accepted, so backend should read archives of all of them
+    (see BlockBackend read_path)
     """
 
-    def __init__(self, backup_path, formatter, treshold=100):
+    # how far back (days) history is searched
+    history_days = 30
+
+    def __init__(self, backup_path, formatter, treshold=100, \
+            flush_interval=5, queue_size=10000, backend=None):
         """
         Object initialization
         """
         self.backup_path = backup_path
+        self.backend = backend or CsvBackend(backup_path)
         self.formatter = formatter
         self.treshold = treshold
+        self.flush_interval = flush_interval # seconds
+        self.queue_size = queue_size
+        self.writer = None
 
     def _init(self, event):
         """
         Chat initialization
         """
-        self.lines = []
+        self.lines = [] # records not accepted by writer yet
+        self.writer = ArchiveWriter(self.backend, self.log, \
+            self.treshold, self.flush_interval, self.queue_size)
+        self.writer.start()
 
     def _mapping(self):
         """
         Returns information about event listeners mapping
         """
         return [('message.received', self.on_new_message, 1337), \
-            ('chat.periodic', self.periodic)]
+            ('chat.periodic', self.periodic), \
+            ('message.history', self.history)]
 
     @synchronous
     def periodic(self, event):
@@ -47,12 +61,21 @@ class Archive(Plugin):
         Handles periodic event
         """
         self.write()
+        self.log.info('msg=archive stats; %s', \
+            '; '.join('%s=%s' % i for i in sorted(self.stats().iteritems())))
 
     def _shutdown(self, event):
         """
         Chat shutdown
         """
         self.write()
+        if self.lines:
+            self.log.warning('msg=archive queue is full, blocking; lines=%u', \
+                len(self.lines))
+            for line in self.lines:
+                self.writer.queue.put(line)
+            self.lines = []
+        self.writer.stop()
 
     @synchronous
     def on_new_message(self, event, data):
@@ -61,34 +84,64 @@ class Archive(Plugin):
         """
         if data is None:
             return data
-        tmp = copy.deepcopy(data)
+        tmp = dict(data)
         tmp['text'] = tmp['text'].encode('utf-8')
         line = self.formatter(tmp)
         if line is None:
             return data
-        self.lines.append(line)
-        if len(self.lines) >= self.treshold:
-            self.write()
+        # snapshot of message (profile of sender may change later)
+        message = dict(data)
+        message['from'] = dict(data['from'])
+        self.lines.append((data['date'], data['from'].get('name'), line, \
+            message))
+        self.write()
         return data
 
     def write(self):
         """
-        Writes lines to backup file
-        """
-        lines = self.lines
-        self.lines = []
-        self.log.debug('msg=archiving messages; lines=%u', len(lines))
-        with open(self._path(), 'a+' ) as f:
-            archiver = csv.writer(f, delimiter = ' ', quoting=csv.QUOTE_MINIMAL)
-            try:
-                archiver.writerows(lines)
-            except:
-                self.log.exception('msg=an error occurred while archiving ' + \
-                    'messages')
-        self.log.info('msg=messages archived; lines=%u', len(lines))
+        Passes lines to writer (lines that writer can not accept now
+        are kept until next call)
+        """
+        accepted = self.writer.submit(self.lines)
+        del self.lines[:accepted]
 
-    def _path(self):
+    def stats(self):
         """
-        Prepares path to archive file
+        Returns archive metrics
         """
-        return time.strftime(self.backup_path)
+        stats = self.writer.stats()
+        stats['pending'] = len(self.lines)
+        return stats
+
+    @synchronous
+    def history(self, event):
+        """
+        Returns messages older than given one (newest first).
+        Event holds date and ID of that message, room and number
+        of messages to return
+        """
+        if not hasattr(self.backend, 'read'):
+            return False
+        (date, cursor) = (event['date'], event['cursor'])
+        # messages are ordered by (date, ID), so cursor does not have
+        # to be found (it may be not written yet)
+        before = None
+        if cursor is not None:
+            before = order_key({'date': date, 'id': cursor})
+        out = []
+        records = self.backend.read(date - self.history_days * 86400, date, \
+            reverse=True)
+        for record in records:
+            # message has not been saved
+            if len(record) < 4:
+                continue
+            message = record[3]
+            if message.get('room') != event['room']:
+                continue
+            if before is not None and order_key(message) >= before:
+                continue
+            out.append(message)
+            if len(out) == event['limit']:
+                break
+        event.return_value = out
+        return True
@@ -18,6 +18,7 @@ class Ban(Plugin):
 
     Handles banning users
     """
+    audience_attrs = Plugin.user_attrs
 
     def __init__(self, banned={}):
         """
@@ -30,7 +31,8 @@ class Ban(Plugin):
         Returns information about event listeners mapping
         """
         return [('message.received', self.on_new_message), \
-            ('message.read.prevent', self.prevent)]
+            ('message.read.prevent', self.prevent), \
+            ('message.read.filter', self.hide_ban_state)]
 
     def _init(self, event):
         """
@@ -60,6 +62,14 @@ class Ban(Plugin):
         data['banned'] = self.is_banned(data['from'])
         return data
 
+    def audience(self, user, message):
+        """
+        Messages from not banned users are visible for everyone
+        """
+        if not message.get('banned'):
+            return ()
+        return super(Ban, self).audience(user, message)
+
     @synchronous
     def prevent(self, event):
         """
@@ -70,17 +80,8 @@ class Ban(Plugin):
         Filters out messages from banned users for other people
         """
         data = event['message']
-        # no 'banned' property in message - show message
-        if not 'banned' in data:
-            return False
-        
-        # remove 'banned' property from message dict
-        # so noone could guess whether is he/she banned or not
-        banned = data['banned']
-        del data['banned']
-        
         # message not banned - show it to anybody
-        if not banned:
+        if not data.get('banned'):
             return False
         
         # message is banned, but user is banned too
@@ -91,6 +92,17 @@ class Ban(Plugin):
         # banned message, not banned user - hide message
         return True
 
+    @synchronous
+    def hide_ban_state(self, event, data):
+        """
+        Removes 'banned' property from message
+        so noone could guess whether is he/she banned or not
+        """
+        if data is None:
+            return data
+        data.pop('banned', None)
+        return data
+
     def is_banned(self, user):
         """
         Check whether user is banned.
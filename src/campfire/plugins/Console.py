@@ -10,7 +10,7 @@ from collections import defaultdict
 
 ##
 # campfire.api
-from campfire.utils import Plugin
+from campfire.utils import Plugin, trigger
 from event import synchronous
 
 class Console(Plugin):
@@ -38,9 +38,9 @@ class Console(Plugin):
         self.attach_command(plugin, 'allowed', self.cmd_allowed, \
             lambda p, a, u: True) # anyone can call that method
 
-    def mapping(self):
+    def _listeners(self):
         """
-        Returns list of listeners to be attached to dispatcher.
+        Returns list of all listeners of plugin
         [(event name, listener, priority), (event name, listener, priority)]
 
         It is overriden on purpose (in order to set priority for 'chat.init')
@@ -117,6 +117,7 @@ class Console(Plugin):
         except:
             return []
 
+    @trigger('$')
     @synchronous
     def on_new_message(self, event, data):
         """
@@ -3,7 +3,7 @@
 
 ##
 # campfire.api
-from campfire.utils import Plugin
+from campfire.utils import Plugin, trigger
 from event import synchronous
 
 class Direct(Plugin):
@@ -13,6 +13,7 @@ class Direct(Plugin):
     Handles messages posted directly to particular users
     ">recipient: blah"
     """
+    audience_attrs = Plugin.user_attrs + ['puppet']
 
     def _mapping(self):
         """
@@ -21,6 +22,7 @@ class Direct(Plugin):
         return [('message.received', self.on_new_message), \
             ('message.read.prevent', self.can_not_read)]
 
+    @trigger('>')
     @synchronous
     def on_new_message(self, event, data):
         """
@@ -45,8 +47,18 @@ class Direct(Plugin):
         data['to'] = data['text'].split( ':' )[0][1:]
         data['text'] = data['text'][len(data['to'])+2:]
         event['response']['direct'] = 'Message has been sent'
+        # deliver message to recipient (and sender) only
+        event['audience'].add(data['to'])
         return data
     
+    def audience(self, user, message):
+        """
+        Messages that are not direct are visible for everyone
+        """
+        if 'to' not in message:
+            return ()
+        return super(Direct, self).audience(user, message)
+
     @synchronous
     def can_not_read(self, event):
         """
@@ -6,7 +6,7 @@ import random
 
 ##
 # campfire.api
-from campfire.utils import Plugin
+from campfire.utils import Plugin, trigger
 from event import synchronous
 
 class Nap(Plugin):
@@ -28,6 +28,7 @@ class Nap(Plugin):
         """
         return [('message.received', self.on_new_message)]
 
+    @trigger('/nap')
     @synchronous
     def on_new_message(self, event, data):
         """
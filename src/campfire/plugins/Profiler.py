@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from campfire.utils import Plugin
+from event import Event
+
+
+class Profiler(Plugin):
+    """
+    Plugin that reports timing of plugin listeners (console commands).
+
+    Listeners are timed only when Plugin.listener_stats is set before plugins
+    are registered
+    """
+
+    def __init__(self, stats):
+        """
+        Object initialization
+        """
+        self.timings = stats
+
+    def cmd_stats(self, msg, limit=20):
+        """
+        Returns stats of the slowest listeners
+        """
+        return self.timings.snapshot()[:int(limit)]
+
+    def cmd_reset(self, msg):
+        """
+        Zeroes stats
+        """
+        self.timings.reset()
+        return 'Stats reset'
+
+    def _init(self, event):
+        """
+        Initializes plugin (registers console commands)
+        """
+        self.dispatcher.notify_until(Event(self, 'console.command.add', \
+            {'plugin': self.__class__.__name__, 'actions': {'stats': \
+                self.cmd_stats, 'reset': self.cmd_reset}}))
@@ -6,7 +6,7 @@ import random
 
 ##
 # campfire.api
-from campfire.utils import Plugin
+from campfire.utils import Plugin, trigger
 from event import synchronous
 
 
@@ -31,6 +31,7 @@ class Quotations(Plugin):
         """
         return [('message.received', self.on_new_message, 100)] # AFTER Voices!
 
+    @trigger(lambda text: not text.strip())
     @synchronous
     def on_new_message(self, event, data):
         """
@@ -3,7 +3,7 @@
 
 ##
 # campfire.api
-from campfire.utils import Plugin
+from campfire.utils import Plugin, trigger
 from event import synchronous
 
 
@@ -27,6 +27,7 @@ class Voices(Plugin):
         # BEFORE Quotations plugin!
         return [('message.received', self.on_new_message, 70)]
    
+    @trigger(' ')
     @synchronous
     def on_new_message(self, event, data):
         """
@@ -11,6 +11,7 @@ from Direct import Direct
 from Me import Me
 from Nap import Nap
 from NoAuth import NoAuth
+from Profiler import Profiler
 from Puppet import Puppet
 from Quotations import Quotations
 from Tidy import Tidy
@@ -20,5 +21,5 @@ from Voices import Voices
 from Whoami import Whoami
 
 __all__ = ['AntiFlood', 'Archive', 'Ban', 'Colors', 'Config', 'Console', \
-    'Dice', 'Direct', 'Me', 'Nap', 'NoAuth', 'Puppet', 'Quotations', 'Tidy', \
-    'Typing', 'ValidateLogin', 'Voices', 'Whoami']
+    'Dice', 'Direct', 'Me', 'Nap', 'NoAuth', 'Profiler', 'Puppet', \
+    'Quotations', 'Tidy', 'Typing', 'ValidateLogin', 'Voices', 'Whoami']
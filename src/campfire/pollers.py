@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+from collections import OrderedDict, defaultdict
+from types import MethodType
+
+##
+# campfire modules
+from cache import parse_id
+from utils import get_uid
+
+
+def user_keys(user):
+    """
+    Returns identifiers given user is addressed by: user ID (see get_uid;
+    guests share ID -1 and users behind NAT share IP address, so neither
+    of them identifies logged user) and name of logged user (messages
+    are addressed to names, see Direct plugin)
+    """
+    if not isinstance(user, dict):
+        return set()
+    keys = set()
+    uid = get_uid(user)
+    if uid is not None:
+        keys.add(str(uid))
+    if user.get('logged') and 'name' in user:
+        keys.add(str(user['name']))
+    return keys
+
+
+def poller_id(callback):
+    """
+    Returns identity of given callback
+    (bound methods of the same object and function are identical)
+    """
+    if isinstance(callback, MethodType):
+        return (id(callback.im_self), id(callback.im_func))
+    return id(callback)
+
+
+class PollerRegistry(object):
+    """
+    Registry of pollers waiting for new messages.
+
+    Pollers are keyed by callback identity (in order of attaching)
+    and indexed by user identifiers. One-shot pollers are detached when
+    messages are sent to them, subscriptions (persistent pollers) stay
+    attached and registry tracks cursor (ID of the last message sent)
+    of each of them. Sequence number of the newest cached message at time
+    of attaching is kept for each poller, so messages the poller has seen
+    already are not sent again by delayed (batched) notification
+    """
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self._pollers = OrderedDict()        # map poller ID to (callback, user)
+        self._keys = {}                      # map poller ID to user identifiers
+        self._by_user = defaultdict(set)     # map user identifier to poller IDs
+        self._cursors = {}                   # map subscription ID to cursor
+        self._seqs = {}                      # map poller ID to sequence number
+        self._ahead = {}                     # map poller ID to cursor ahead
+                                             # of cache (origin to seq)
+
+    def __len__(self):
+        """
+        Returns number of attached pollers
+        """
+        return len(self._pollers)
+
+    def __iter__(self):
+        """
+        Iterates over (callback, user) pairs
+        """
+        return self._pollers.itervalues()
+
+    def __contains__(self, callback):
+        """
+        Checks whether given callback is attached
+        """
+        return poller_id(callback) in self._pollers
+
+    def add(self, callback, user, persistent=False, cursor=None, seq=0, \
+            ahead=None):
+        """
+        Attaches poller (poller attached already is moved to the end)
+        """
+        self.remove(callback)
+        pid = poller_id(callback)
+        self._pollers[pid] = (callback, user)
+        self._keys[pid] = user_keys(user)
+        for key in self._keys[pid]:
+            self._by_user[key].add(pid)
+        self._seqs[pid] = seq
+        if persistent:
+            self._cursors[pid] = cursor
+        if ahead:
+            self._ahead[pid] = ahead
+
+    def remove(self, callback):
+        """
+        Detaches poller. Returns its user or None when poller was not attached
+        """
+        pid = poller_id(callback)
+        try:
+            (callback, user) = self._pollers.pop(pid)
+        except KeyError:
+            return None
+        self._cursors.pop(pid, None)
+        self._ahead.pop(pid, None)
+        del self._seqs[pid]
+        for key in self._keys.pop(pid):
+            self._by_user[key].discard(pid)
+            if not self._by_user[key]:
+                del self._by_user[key]
+        return user
+
+    def clear(self):
+        """
+        Detaches all pollers and returns list of (callback, user) pairs
+        """
+        pollers = self._pollers.values()
+        self._pollers = OrderedDict()
+        self._keys.clear()
+        self._by_user.clear()
+        self._cursors.clear()
+        self._seqs.clear()
+        self._ahead.clear()
+        return pollers
+
+    def seq(self, callback):
+        """
+        Returns sequence number of the newest message cached when given
+        poller has been attached
+        """
+        return self._seqs.get(poller_id(callback), 0)
+
+    def ahead(self):
+        """
+        Checks whether any poller has cursor ahead of cache
+        """
+        return bool(self._ahead)
+
+    def seen(self, callback, message):
+        """
+        Checks whether cursor of given poller is ahead of given message
+        (message arrived from other process after poller has seen it)
+        """
+        vector = self._ahead.get(poller_id(callback))
+        if vector is None:
+            return False
+        parsed = parse_id(message['id'])
+        return parsed is not None and parsed[1] <= vector.get(parsed[0], 0)
+
+    def persistent(self, callback):
+        """
+        Checks whether given callback is attached as subscription
+        """
+        return poller_id(callback) in self._cursors
+
+    def cursor(self, callback):
+        """
+        Returns ID of the last message sent to given subscription
+        """
+        return self._cursors.get(poller_id(callback))
+
+    def advance(self, callback, cursor):
+        """
+        Moves cursor of given subscription
+        """
+        pid = poller_id(callback)
+        if pid in self._cursors:
+            self._cursors[pid] = cursor
+
+    def by_user(self, keys):
+        """
+        Returns list of (callback, user) pairs of pollers that belong
+        to users matching any of given identifiers
+        """
+        pids = set()
+        for key in keys:
+            pids.update(self._by_user.get(str(key), ()))
+        return [self._pollers[pid] for pid in pids]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+from collections import OrderedDict
+
+##
+# campfire modules
+from cache import MessageCache
+from pollers import PollerRegistry
+
+
+class Room(object):
+    """
+    Single chat room: cache of recent messages and pollers waiting for new ones
+    """
+
+    def __init__(self, room_id, cache_size=120):
+        """
+        Object initialization
+        """
+        self.id = room_id
+        self.cache = MessageCache(cache_size)
+        self.pollers = PollerRegistry()
+
+    def idle(self):
+        """
+        Checks whether nobody waits for messages in room
+        """
+        return 0 == len(self.pollers)
+
+
+class RoomRegistry(object):
+    """
+    Registry of rooms.
+
+    Rooms are created on demand. When there are too many rooms,
+    least recently used idle ones are evicted (and created again
+    when needed, factory should restore their messages then)
+    """
+
+    def __init__(self, factory, max_rooms=None):
+        """
+        Object initialization.
+        Factory is called with room ID and should return new Room instance
+        """
+        self.factory = factory
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict() # least recently used room first
+
+    def __len__(self):
+        """
+        Returns number of rooms
+        """
+        return len(self._rooms)
+
+    def __iter__(self):
+        """
+        Iterates over rooms
+        """
+        return self._rooms.itervalues()
+
+    def find(self, room_id):
+        """
+        Returns room with given ID or None when room does not exist
+        """
+        return self._rooms.get(room_id)
+
+    def get(self, room_id):
+        """
+        Returns room with given ID (room is created when necessary)
+        """
+        try:
+            room = self._rooms.pop(room_id)
+        except KeyError:
+            room = self.factory(room_id)
+            self.evict(1)
+        self._rooms[room_id] = room
+        return room
+
+    def evict(self, reserve=0):
+        """
+        Evicts least recently used idle rooms, so there is space
+        for given number of new rooms. Returns list of evicted rooms
+        """
+        if self.max_rooms is None:
+            return []
+        excess = len(self._rooms) + reserve - self.max_rooms
+        if excess <= 0:
+            return []
+        evicted = []
+        for room in self._rooms.itervalues():
+            if len(evicted) == excess:
+                break
+            if room.idle():
+                evicted.append(room)
+        for room in evicted:
+            del self._rooms[room.id]
+        return evicted
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python stdlib
+import json
+import heapq
+import sqlite3
+
+
+class MemorySessionStore(object):
+    """
+    Sessions kept in memory of single process.
+
+    Sessions are also kept in heap ordered by lastvisit time, so expiring
+    checks only sessions that might have expired. Heap is updated lazily:
+    visited session is pushed again (with new lastvisit time) when its old
+    entry reaches top of the heap
+    """
+
+    # store is not visible to other processes
+    shared = False
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self._sessions = {} # map token to [profile, lastvisit]
+        self._users = {}    # map user name to token
+        self._expiry = []   # heap of (lastvisit, token)
+
+    def __len__(self):
+        """
+        Returns number of sessions
+        """
+        return len(self._sessions)
+
+    def get(self, token):
+        """
+        Returns (profile, lastvisit) of session with given token
+        or None when session does not exist
+        """
+        try:
+            return tuple(self._sessions[token])
+        except KeyError:
+            return None
+
+    def create(self, token, profile, lastvisit):
+        """
+        Creates session. Returns False when user name is used already
+        """
+        if profile['name'] in self._users:
+            return False
+        self._sessions[token] = [profile, lastvisit]
+        self._users[profile['name']] = token
+        heapq.heappush(self._expiry, (lastvisit, token))
+        return True
+
+    def touch(self, token, lastvisit):
+        """
+        Updates lastvisit time of session.
+        Returns False when session does not exist
+        """
+        try:
+            session = self._sessions[token]
+        except KeyError:
+            return False
+        session[1] = max(session[1], lastvisit)
+        return True
+
+    def delete(self, token):
+        """
+        Removes session and returns its profile
+        (None - session does not exist)
+        """
+        try:
+            (profile, lastvisit) = self._sessions.pop(token)
+        except KeyError:
+            return None
+        del self._users[profile['name']]
+        return profile
+
+    def expire(self, treshold):
+        """
+        Removes sessions visited before given time.
+        Returns list of (token, profile) of removed sessions
+        """
+        expired = []
+        while self._expiry and self._expiry[0][0] < treshold:
+            (lastvisit, token) = heapq.heappop(self._expiry)
+            # session has been removed already
+            if token not in self._sessions:
+                continue
+            # session has been used since entry was pushed
+            lastvisit = self._sessions[token][1]
+            if lastvisit >= treshold:
+                heapq.heappush(self._expiry, (lastvisit, token))
+                continue
+            expired.append((token, self.delete(token)))
+        return expired
+
+
+class SQLiteSessionStore(object):
+    """
+    Sessions kept in SQLite database.
+
+    Database file may be shared by many processes (e.g. workers
+    of pre-forked server)
+    """
+
+    # store is visible to other processes
+    shared = True
+
+    def __init__(self, path, timeout=5):
+        """
+        Object initialization
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, timeout, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (' + \
+            'token TEXT PRIMARY KEY, name TEXT UNIQUE, profile TEXT, ' + \
+            'lastvisit REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_lastvisit ' + \
+            'ON sessions (lastvisit)')
+
+    def __len__(self):
+        """
+        Returns number of sessions
+        """
+        return self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def get(self, token):
+        """
+        Returns (profile, lastvisit) of session with given token
+        or None when session does not exist
+        """
+        row = self._db.execute('SELECT profile, lastvisit FROM sessions ' + \
+            'WHERE token = ?', (token,)).fetchone()
+        if row is None:
+            return None
+        return (json.loads(row[0]), row[1])
+
+    def create(self, token, profile, lastvisit):
+        """
+        Creates session. Returns False when user name is used already
+        """
+        try:
+            self._db.execute('INSERT INTO sessions VALUES (?, ?, ?, ?)', \
+                (token, profile['name'], json.dumps(profile), lastvisit))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def touch(self, token, lastvisit):
+        """
+        Updates lastvisit time of session.
+        Returns False when session does not exist
+        """
+        return 1 == self._db.execute('UPDATE sessions SET lastvisit = ' + \
+            'MAX(lastvisit, ?) WHERE token = ?', (lastvisit, token)).rowcount
+
+    def delete(self, token):
+        """
+        Removes session and returns its profile
+        (None - session does not exist)
+        """
+        session = self.get(token)
+        if session is None:
+            return None
+        if 0 == self._db.execute('DELETE FROM sessions WHERE token = ?', \
+                (token,)).rowcount:
+            # removed by other process in the meantime
+            return None
+        return session[0]
+
+    def expire(self, treshold):
+        """
+        Removes sessions visited before given time.
+        Returns list of (token, profile) of removed sessions
+        """
+        rows = self._db.execute('SELECT token, profile FROM sessions ' + \
+            'WHERE lastvisit < ?', (treshold,)).fetchall()
+        expired = []
+        for (token, profile) in rows:
+            # session might have been used or removed in the meantime
+            if 0 == self._db.execute('DELETE FROM sessions WHERE ' + \
+                    'token = ? AND lastvisit < ?', (token, treshold)).rowcount:
+                continue
+            expired.append((str(token), json.loads(profile)))
+        return expired
+
+    def close(self):
+        """
+        Closes database
+        """
+        self._db.close()
@@ -4,13 +4,136 @@
 ##
 # python stdlib
 import copy
+import hmac
+import json
 import uuid
 import time
+import base64
+import hashlib
+from collections import OrderedDict
 
 ##
 # event module
 from event import Event, Listener, synchronous
 
+##
+# campfire modules
+from sessions import MemorySessionStore
+
+
+def trigger(*conditions):
+    """
+    Declares which messages 'message.received' listener is interested in.
+    Condition is either text prefix or callable that takes message text
+    and returns bool (listener without conditions gets every message)
+    """
+    def decorator(listener):
+        listener.triggers = conditions
+        return listener
+    return decorator
+
+
+def compile_trigger(conditions):
+    """
+    Returns function that checks whether message text meets any of given
+    conditions (None - no conditions, every text is accepted)
+    """
+    if not conditions:
+        return None
+    prefixes = tuple(c for c in conditions if isinstance(c, basestring))
+    predicates = tuple(c for c in conditions if callable(c))
+    if not predicates:
+        return lambda text: text.startswith(prefixes)
+    if not prefixes and 1 == len(predicates):
+        return predicates[0]
+    return lambda text: text.startswith(prefixes) or \
+        any(p(text) for p in predicates)
+
+
+def get_uid(user):
+    """
+    Fetches user ID for given user: ID of account, name of logged user
+    or IP address of guest
+    """
+    if user is None:
+        return None
+    if user.get('hasAccount'):
+        return user['id']
+    if user.get('logged'):
+        return user['name']
+    return user.get('ip')
+
+
+class LazyRepr(object):
+    """
+    Printable representation of object computed only when it is printed
+    (e.g. argument of log record that may be skipped)
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        """
+        Object initialization
+        """
+        self.obj = obj
+
+    def __str__(self):
+        """
+        Returns representation of object
+        """
+        return repr(self.obj)
+
+    __repr__ = __str__
+
+
+class ListenerStats(object):
+    """
+    Call counts, cumulative and max wall time of plugin listeners
+    per (plugin, event name)
+    """
+
+    def __init__(self):
+        """
+        Object initialization
+        """
+        self._stats = {} # map (plugin, event name) to [calls, total, max]
+
+    def wrap(self, plugin, name, listener):
+        """
+        Returns listener that records time of each call
+        """
+        stats = self._stats.setdefault((plugin, name), [0, 0.0, 0.0])
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return listener(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+        timed.listener = listener
+        return timed
+
+    def snapshot(self):
+        """
+        Returns list of stats (slowest listeners first, times in seconds)
+        """
+        out = [{'plugin': plugin, 'event': name, 'calls': calls, \
+            'total': total, 'max': max_time, 'avg': total / (calls or 1)} \
+            for ((plugin, name), (calls, total, max_time)) \
+            in self._stats.iteritems()]
+        out.sort(key=lambda s: s['total'], reverse=True)
+        return out
+
+    def reset(self):
+        """
+        Zeroes stats (listeners stay instrumented)
+        """
+        for stats in self._stats.itervalues():
+            stats[:] = [0, 0.0, 0.0]
+
 
 class Plugin(Listener):
     """
@@ -19,6 +142,24 @@ class Plugin(Listener):
     user_attrs = ['id', 'ip', 'name']
     log = None
 
+    # ListenerStats timing listeners of plugins; set it before plugins are
+    # registered and chat is initialized (None - listeners are attached
+    # as they are, without any overhead)
+    listener_stats = None
+
+    # user attributes that 'message.read.*' listeners depend on
+    # (None - plugin can not tell, so each poller must be checked separately)
+    audience_attrs = None
+
+
+    def register(self, dispatcher):
+        """
+        Attaches listeners of plugin to dispatcher. Plugin registered after
+        chat has been initialized is initialized right away (see Api.init)
+        """
+        Listener.register(self, dispatcher)
+        dispatcher.notify(Event(self, 'plugin.registered', {'plugin': self}))
+        return self
 
     def match_user(self, user, possibilities):
         """
@@ -32,15 +173,23 @@ class Plugin(Listener):
         """
         Fetches user ID for given user
         """
-        if user is None:
+        return get_uid(user)
+
+    def audience(self, user, message):
+        """
+        Returns key describing how given user sees given message.
+        Users with equal keys are treated by 'message.read.*' listeners
+        in the same way. None means that user can not be classified
+        """
+        if self.audience_attrs is None or user is None:
             return None
-        if user['hasAccount']:
-            return user['id']
-        if user['logged']:
-            return user['name']
-        if 'ip' in user:
-            return user['ip']
-        return None
+        return tuple(user.get(k) for k in self.audience_attrs)
+
+    def reads_messages(self):
+        """
+        Checks whether plugin listens to 'message.read.*' events
+        """
+        return any(m[0].startswith('message.read.') for m in self.mapping())
 
     @synchronous
     def init(self, event):
@@ -50,6 +199,17 @@ class Plugin(Listener):
         self.log = event['log']
         self.log.debug('msg=initializing plugin; plugin=%s', \
             self.__class__.__name__)
+        # declare audience of plugins that filter messages for readers
+        try:
+            if self.reads_messages():
+                event['audience'].append(self.audience)
+        except KeyError:
+            pass
+        # join pipeline of 'message.received' listeners
+        try:
+            event['pipeline'].extend(self.pipeline())
+        except KeyError:
+            pass
         return self._init(event)
 
     def _init(self, event):
@@ -77,6 +237,38 @@ class Plugin(Listener):
         """
         Returns list of listeners to be attached to dispatcher.
         [(event name, listener, priority), (event name, listener, priority)]
+
+        'message.received' listeners are not attached - Api calls them
+        directly (see Plugin.pipeline)
+        """
+        return [self._instrument(m) for m in self._listeners() \
+            if 'message.received' != m[0]]
+
+    def pipeline(self):
+        """
+        Returns list of 'message.received' listeners
+        [(priority, listener, trigger), (priority, listener, trigger)]
+        where trigger is a function that checks message text
+        (None - listener is called for every message)
+        """
+        return [((m[2:] or (100,))[0], self._instrument(m)[1], \
+            compile_trigger(getattr(m[1], 'triggers', None))) \
+            for m in self._listeners() if 'message.received' == m[0]]
+
+    def _instrument(self, mapping):
+        """
+        Wraps listener of given mapping with timing (when stats are enabled)
+        """
+        if self.listener_stats is None:
+            return mapping
+        return (mapping[0], self.listener_stats.wrap(\
+            self.__class__.__name__, mapping[0], mapping[1])) + \
+            tuple(mapping[2:])
+
+    def _listeners(self):
+        """
+        Returns list of all listeners of plugin
+        [(event name, listener, priority), (event name, listener, priority)]
         """
         return [('chat.init', self.init), ('chat.shutdown', self.shutdown)] + \
             self._mapping()
@@ -89,23 +281,102 @@ class Plugin(Listener):
         return []
 
 
-class AuthHelper(object):
+class Signer(object):
     """
-    Helper that provides basic auth mechanism
+    Signs values (HMAC-SHA256), so they can be given to clients
+    and verified without any server-side state
     """
-    profiles = {} # list of profiles
-    tokens = {}   # map token to profile
 
+    def __init__(self, secret):
+        """
+        Object initialization
+        """
+        self.secret = secret
+
+    def sign(self, value):
+        """
+        Returns signed, URL-safe representation of given (JSON) value
+        """
+        payload = base64.urlsafe_b64encode(json.dumps(value, \
+            separators=(',', ':')))
+        return payload + '.' + self._signature(payload)
+
+    def unsign(self, signed):
+        """
+        Returns value of signed representation
+        or None when signature is invalid
+        """
+        try:
+            (payload, sep, signature) = str(signed).rpartition('.')
+        except UnicodeError:
+            return None
+        if not hmac.compare_digest(self._signature(payload), signature):
+            return None
+        try:
+            return json.loads(base64.urlsafe_b64decode(payload))
+        except (TypeError, ValueError):
+            return None
+
+    def _signature(self, payload):
+        """
+        Returns signature of given payload
+        """
+        return base64.urlsafe_b64encode(hmac.new(self.secret, payload, \
+            hashlib.sha256).digest()).rstrip('=')
+
+
+class AuthHelper(object):
+    """
+    Helper that provides basic auth mechanism.
+
+    Sessions are kept in session store (see campfire.sessions). Recently
+    used sessions are cached in process, lastvisit time is written
+    to the store every share_interval seconds.
+
+    When secret is given, clients may also be given signed tickets
+    (session token, profile and expiry time). Ticket is verified without
+    looking session up, visits are written to store in batches.
+
+    Session is valid for session_time minutes since last visit. Store
+    removes it (and 'auth.logged.out' is sent) share_interval seconds
+    later, because visit in any process may be written to the store
+    up to share_interval seconds late
+    """
     session_time = 30 # minutes
 
-    def __init__(self, api, dispatcher, log):
+    # how often lastvisit time is written to store (and shared with other
+    # processes)
+    share_interval = 60 # seconds
+
+    # number of sessions cached in process
+    cache_size = 1024
+
+    # how long signed ticket is valid
+    ticket_time = 5 # minutes
+
+    def __init__(self, api, dispatcher, log, store=None, secret=None, \
+            clock=time.time):
         """
         Object initializtion
         """
         self.log = log
+        self.clock = clock # returns current time (replaced in tests)
         self.user_struct = api.user_struct
         self.dispatcher = dispatcher
         dispatcher.attach('chat.periodic', self.periodic)
+        self.store = store or MemorySessionStore()
+        self._cache = OrderedDict() # map token to session (least recently
+                                    # used first)
+        self.signer = None
+        if secret is not None:
+            self.signer = Signer(secret)
+        self._visits = {}  # map token to time of last visit with ticket
+        self._revoked = OrderedDict() # map token of logged out session
+                                      # to time its tickets expire
+                                      # (the earliest first)
+        # share sessions with other processes using the same bus
+        self.bus = api.bus
+        self.bus.subscribe('session', self._on_bus_session)
 
     @synchronous
     def periodic(self, event):
@@ -119,18 +390,32 @@ class AuthHelper(object):
         """
         Calculates max lastvisit time that makes session valid
         """
-        return time.time() - self.session_time * 60
+        return self.clock() - self.session_time * 60
 
     def cleanup(self):
         """
         Method cleans up old session
         """
-        treshold = self.session_max_age
-        tokens = self.tokens.copy()
-        for (token, data) in tokens.iteritems():
-            if data['lastvisit'] >= treshold:
-                continue
-            self.logout(token)
+        self._flush_visits()
+        now = self.clock()
+        # tokens are revoked in order of expiry
+        while self._revoked:
+            token = next(iter(self._revoked))
+            if self._revoked[token] >= now:
+                break
+            del self._revoked[token]
+        # lastvisit time in store may be up to share_interval older than
+        # real one (visits in this or other processes are not written yet),
+        # so sessions are kept in store share_interval longer than they
+        # are valid (get_current_user rejects them already)
+        treshold = self.session_max_age - self.share_interval
+        for (token, profile) in self.store.expire(treshold):
+            self._forget(token)
+            self._logged_out(token, profile)
+            # other processes expire sessions of their own stores
+            if self.store.shared:
+                self.bus.publish('session', {'action': 'logout', \
+                    'token': token, 'profile': profile})
 
     def login(self, user, ip):
         """
@@ -138,10 +423,6 @@ class AuthHelper(object):
         """
         self.cleanup()
 
-        # login has been used already
-        if user in self.profiles:
-            raise RuntimeError("Login used")
-
         # check whether login is allowed
         e = self.dispatcher.notify_until(Event(self, 'auth.login.reject', \
             {'login': user}))
@@ -162,8 +443,12 @@ class AuthHelper(object):
 
         # create token
         token = str(uuid.uuid4())
-        self.profiles[user] = profile
-        self.tokens[token] = {'user': user, 'lastvisit': time.time()}
+        lastvisit = self.clock()
+        # login has been used already
+        if not self.store.create(token, profile, lastvisit):
+            raise RuntimeError("Login used")
+        self.bus.publish('session', {'action': 'login', 'token': token, \
+            'profile': profile, 'lastvisit': lastvisit})
 
         # notify plugin that user has been logged in
         e = self.dispatcher.notify(Event(self, 'auth.logged.in', \
@@ -176,24 +461,151 @@ class AuthHelper(object):
         """
         Logs user out
         """
-        # notify plugin that user has been logged out
-        e = self.dispatcher.notify(Event(self, 'auth.logged.out', \
-            {'profile': self.profiles[self.tokens[token]['user']], \
-            'token': token}))
-        del self.profiles[self.tokens[token]['user']]
-        del self.tokens[token]
+        self._forget(token)
+        profile = self.store.delete(token)
+        if profile is None:
+            return
+        self._logged_out(token, profile)
+        self.bus.publish('session', {'action': 'logout', 'token': token, \
+            'profile': profile})
+
+    def _forget(self, token):
+        """
+        Forgets cached session and rejects its tickets
+        """
+        self._cache.pop(token, None)
+        self._visits.pop(token, None)
+        if self.signer is not None:
+            # keep tokens ordered by expiry time
+            self._revoked.pop(token, None)
+            self._revoked[token] = self.clock() + self.ticket_time * 60
+
+    def _logged_out(self, token, profile):
+        """
+        Notifies plugins that user has been logged out
+        """
+        self.dispatcher.notify(Event(self, 'auth.logged.out', \
+            {'profile': profile, 'token': token}))
+
+    def _on_bus_session(self, data):
+        """
+        Handles login, visit or logout made in other process
+        """
+        token = data['token']
+        if 'logout' == data['action']:
+            self._forget(token)
+            # shared store has been updated by other process already
+            profile = data['profile']
+            if not self.store.shared:
+                profile = self.store.delete(token)
+            if profile is not None:
+                self._logged_out(token, profile)
+        elif self.store.shared:
+            return
+        elif 'login' == data['action']:
+            self.store.create(token, data['profile'], data['lastvisit'])
+        elif 'touch' == data['action']:
+            self.store.touch(token, data['lastvisit'])
+            if token in self._cache:
+                session = self._cache[token]
+                session['lastvisit'] = max(session['lastvisit'], \
+                    data['lastvisit'])
+                session['shared'] = session['lastvisit']
 
     def get_current_user(self, token):
         """
         Fetches current user profile
         """
+        session = self._session(token)
+        if session is None:
+            return None
+        now = self.clock()
+        treshold = self.session_max_age
+        if session['lastvisit'] <= treshold:
+            # session might have been used in other process
+            del self._cache[token]
+            session = self._session(token)
+            if session is None or session['lastvisit'] <= treshold:
+                return None
         # bump lastvisit time
+        session['lastvisit'] = now
+        if now - session['shared'] >= self.share_interval:
+            session['shared'] = now
+            self._share_lastvisit(token, now)
+        return session['profile']
+
+    def ticket(self, token):
+        """
+        Returns signed ticket of session with given token
+        (None - session is not valid)
+        """
+        profile = self.get_current_user(token)
+        if profile is None:
+            return None
+        return self.signer.sign([token, profile, \
+            int(self.clock() + self.ticket_time * 60)])
+
+    def get_ticket_user(self, ticket):
+        """
+        Fetches user profile from signed ticket.
+        Returns None when ticket is invalid or expired (new ticket
+        should be issued using session token then)
+        """
+        if not ticket:
+            return None
+        value = self.signer.unsign(ticket)
+        if value is None:
+            return None
+        (token, profile, expires) = value
+        now = self.clock()
+        if expires < now or token in self._revoked:
+            return None
+        # lastvisit time is written later (see cleanup)
+        self._visits[token] = now
+        return profile
+
+    def _flush_visits(self):
+        """
+        Writes lastvisit times of sessions used with tickets
+        """
+        visits = self._visits
+        self._visits = {}
+        for (token, lastvisit) in visits.iteritems():
+            if token in self._cache:
+                session = self._cache[token]
+                session['lastvisit'] = max(session['lastvisit'], lastvisit)
+                session['shared'] = session['lastvisit']
+            self._share_lastvisit(token, lastvisit)
+
+    def _session(self, token):
+        """
+        Returns cached session (session is loaded from store when
+        necessary)
+        """
         try:
-            if self.tokens[token]['lastvisit'] <= self.session_max_age:
-                return None
-            self.tokens[token]['lastvisit'] = time.time()
-            return self.profiles[self.tokens[token]['user']]
+            session = self._cache.pop(token)
         except KeyError:
-            if token in self.tokens:
-                del self.tokens[token]
-            return None
+            if token is None:
+                return None
+            stored = self.store.get(token)
+            if stored is None:
+                return None
+            session = {'profile': stored[0], 'lastvisit': stored[1], \
+                'shared': stored[1]}
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(False)
+        self._cache[token] = session
+        return session
+
+    def _share_lastvisit(self, token, lastvisit):
+        """
+        Writes lastvisit time to store and tells other processes
+        that session is still in use (so they do not expire it)
+        """
+        if not self.store.touch(token, lastvisit):
+            # session has been removed in other process
+            self._cache.pop(token, None)
+            return
+        if not self.store.shared:
+            self.bus.publish('session', {'action': 'touch', 'token': token, \
+                'lastvisit': lastvisit})
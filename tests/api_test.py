@@ -21,7 +21,9 @@ from event import Dispatcher, Event
 # campfire api modules
 #
 from campfire.api import Api, ChatReinitializationForbiddenError, \
-    UninitializedChatError, AuthError
+    UninitializedChatError, AuthError, InvalidCursorError, InvalidLimitError
+from campfire.utils import Plugin, trigger
+from campfire.plugins import Console, Dice, Direct, Me, NoAuth
 
 
 class ApiTestCase(unittest.TestCase):
@@ -32,6 +34,7 @@ class ApiTestCase(unittest.TestCase):
         self.mox = mox.Mox()
         self.listeners = self.mox.CreateMock(Dispatcher)
         # called when initializing object
+        self.listeners.attach('plugin.registered', mox.IgnoreArg())
         self.listeners.notify(mox.IsA(Event))
         self.api = Api(self.log, self.listeners)
 
@@ -200,7 +203,7 @@ class ApiTestCase(unittest.TestCase):
             
             p = self.mox.CreateMockAnything()
             p([{'tmp': i, 'text': 'a', 'args': 'c', 'date': mox.IsA(int), \
-                'from': 'b', 'id': mox.IsA(str)}])
+                'from': 'b', 'id': mox.IsA(str), 'cursor': mox.IsA(str)}])
             pollers.append(p)
 
         self.mox.ReplayAll()
@@ -346,7 +349,8 @@ class ApiTestCase(unittest.TestCase):
         p = self.mox.CreateMockAnything()
         i = 'usr'
         p([{'tmp': i, 'text': 'a', 'args': 'c', 'date': mox.IsA(int), \
-            'from': 'b', 'id': mox.IsA(str)}]).WithSideEffects(side_effect3)
+            'from': 'b', 'id': mox.IsA(str), 'cursor': mox.IsA(str)}]\
+            ).WithSideEffects(side_effect3)
         pollers.append(p)
 
         p1 = self.mox.CreateMockAnything()
@@ -372,6 +376,30 @@ class ApiTestCase(unittest.TestCase):
         # verify
         self.mox.VerifyAll()
 
+    def test_attach_poller_reports_expired_cursor(self):
+        # prepare
+        msgs = []
+
+        def side_effect(m):
+            msgs.extend(m)
+
+        p = self.mox.CreateMockAnything()
+        p(mox.IsA(list)).WithSideEffects(side_effect)
+
+        self.mox.ReplayAll()
+        self.api.init()
+
+        # test
+        self.api.attach_poller('usr', p, 'expired')
+
+        # verify
+        self.mox.VerifyAll()
+        self.assertEqual(1, len(msgs))
+        self.assertEqual('resync', msgs[0]['text'])
+        self.assertEqual({'cursor': 'expired'}, msgs[0]['args'])
+        self.assertIsNone(msgs[0]['id'])
+        self.assertFalse(p in [c for (c, u) in self.api.pollers if c == p])
+
     def test_attach_poller_does_not_check_callback_type(self):
         err = False
         self.api.init()
@@ -633,7 +661,7 @@ class ApiTestCase(unittest.TestCase):
             
             p = self.mox.CreateMockAnything()
             p([{'tmp': i, 'text': 'a', 'args': 'c', 'date': mox.IsA(int), \
-                'from': 'b', 'id': mox.IsA(str)}])
+                'from': 'b', 'id': mox.IsA(str), 'cursor': mox.IsA(str)}])
             pollers.append(p)
         # called when preparing response to request
         e1 = self.mox.CreateMock(Event)
@@ -656,6 +684,175 @@ class ApiTestCase(unittest.TestCase):
         # verify
         self.mox.VerifyAll()
     
+    def test_grouped_pollers_share_filtered_message(self):
+        # prepare
+        pollers = []
+        
+        def side_effect(e, a, b):
+            e.return_value = b
+
+        # called when message is received
+        e = self.mox.CreateMock(Event)
+        e.processed = True
+        e.return_value = None
+        e.__getitem__('response').AndReturn({})
+        self.listeners.notify_until(mox.IsA(Event)).AndReturn(e)
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect, e)).AndReturn(e)
+
+        # called once for whole group of pollers
+        e2 = self.mox.CreateMock(Event)
+        e2.processed = False
+        e2.return_value = None
+        self.listeners.notify_until(mox.IsA(Event)).AndReturn(e2)
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)\
+            ).WithSideEffects(partial(side_effect, e2)).AndReturn(e2)
+        for i in xrange(0, 2):
+            p = self.mox.CreateMockAnything()
+            p([{'text': 'a', 'args': 'c', 'date': mox.IsA(int), \
+                'from': 'b', 'id': mox.IsA(str), 'cursor': mox.IsA(str)}])
+            pollers.append(p)
+
+        # called when preparing response to request
+        e1 = self.mox.CreateMock(Event)
+        e1.processed = True
+        e1.return_value = None
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect, e1)).AndReturn(e1)
+
+        self.mox.ReplayAll()
+        
+        self.api.group_pollers = True
+        self.api.init()
+        self.api._audience.append(lambda user, message: ())
+        for (i, p) in enumerate(pollers):
+            self.api.attach_poller(i, p)
+
+        # test
+        self.api.recv('a', 'b', 'c')
+
+        # verify
+        self.mox.VerifyAll()
+    
+    def test_pollers_receiving_equal_messages_share_batch(self):
+        # prepare
+        batches = []
+        
+        def side_effect(e, a, b):
+            e.return_value = b
+
+        # called when message is received
+        e = self.mox.CreateMock(Event)
+        e.processed = True
+        e.return_value = None
+        e.__getitem__('response').AndReturn({})
+        self.listeners.notify_until(mox.IsA(Event)).AndReturn(e)
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect, e)).AndReturn(e)
+
+        # called when notifying pollers
+        for i in xrange(0, 2):
+            e2 = self.mox.CreateMock(Event)
+            e2.processed = False
+            e2.return_value = None
+            self.listeners.notify_until(mox.IsA(Event)).AndReturn(e2)
+            self.listeners.filter(mox.IsA(Event), mox.IsA(dict)\
+                ).WithSideEffects(partial(side_effect, e2)).AndReturn(e2)
+
+        # called when preparing response to request
+        e1 = self.mox.CreateMock(Event)
+        e1.processed = True
+        e1.return_value = None
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect, e1)).AndReturn(e1)
+
+        self.mox.ReplayAll()
+        
+        self.api.init()
+        for i in xrange(0, 2):
+            self.api.attach_poller(i, batches.append)
+
+        # test
+        self.api.recv('a', 'b', 'c')
+
+        # verify
+        self.mox.VerifyAll()
+        self.assertEqual(2, len(batches))
+        self.assertTrue(batches[0] is batches[1])
+    
+    def test_addressed_message_is_delivered_to_recipients_only(self):
+        # prepare
+        bob = {'id': 1, 'name': 'Bob', 'ip': '127.0.0.1', 'logged': True, \
+            'hasAccount': True}
+        carol = {'id': 2, 'name': 'Carol', 'ip': '127.0.0.2', \
+            'logged': True, 'hasAccount': True}
+        
+        def side_effect(e, a, b):
+            e.return_value = b
+
+        def side_effect1(e, a, b):
+            a['audience'].add('Bob')
+            e.return_value = b
+
+        # called when message is received
+        e = self.mox.CreateMock(Event)
+        e.processed = True
+        e.return_value = None
+        e.__getitem__('response').AndReturn({})
+        self.listeners.notify_until(mox.IsA(Event)).AndReturn(e)
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect1, e)).AndReturn(e)
+
+        # called for recipient only
+        e2 = self.mox.CreateMock(Event)
+        e2.processed = False
+        e2.return_value = None
+        self.listeners.notify_until(mox.IsA(Event)).AndReturn(e2)
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)\
+            ).WithSideEffects(partial(side_effect, e2)).AndReturn(e2)
+        p1 = self.mox.CreateMockAnything()
+        p1(mox.IsA(list))
+        p2 = self.mox.CreateMockAnything()
+
+        # called when preparing response to request
+        e1 = self.mox.CreateMock(Event)
+        e1.processed = True
+        e1.return_value = None
+        self.listeners.filter(mox.IsA(Event), mox.IsA(dict)).WithSideEffects(\
+            partial(side_effect, e1)).AndReturn(e1)
+
+        self.mox.ReplayAll()
+        
+        self.api.init()
+        self.api.attach_poller(bob, p1)
+        self.api.attach_poller(carol, p2)
+
+        # test
+        self.api.recv('a', 'b', 'c')
+
+        # verify
+        self.mox.VerifyAll()
+        self.assertTrue(p2 in self.api.pollers)
+    
+    def test_rooms_have_separate_pollers(self):
+        self.api.init()
+        self.api.attach_poller(None, 'a', None, 'room1')
+        self.api.attach_poller(None, 'b')
+        self.assertTrue('a' in self.api.rooms.get('room1').pollers)
+        self.assertFalse('a' in self.api.pollers)
+        self.assertTrue('b' in self.api.pollers)
+        self.api.detach_poller('a')
+        self.assertTrue('a' in self.api.rooms.get('room1').pollers)
+        self.api.detach_poller('a', 'room1')
+        self.assertFalse('a' in self.api.rooms.get('room1').pollers)
+
+    def test_rooms_are_not_evicted_without_persistent_journal(self):
+        self.api.rooms.max_rooms = 3
+        self.api.init()
+        for i in xrange(1, 5):
+            self.api.rooms.get('room%u' % i)
+        self.assertEqual(5, len(self.api.rooms))
+
     def test_init_sends_chat_init_event(self):
         # prepare
         out = {'route': None}
@@ -663,6 +860,7 @@ class ApiTestCase(unittest.TestCase):
             out['route'] = e.name
 
         # called when initializing object
+        self.listeners.attach('plugin.registered', mox.IgnoreArg())
         self.listeners.notify(mox.IsA(Event)).WithSideEffects(side_effect)
 
         self.mox.ReplayAll()
@@ -722,5 +920,384 @@ class ApiTestCase(unittest.TestCase):
         self.assertTrue(err)
 
 
+class Recorder(Plugin):
+
+    def __init__(self):
+        self.calls = []
+
+    def _mapping(self):
+        return [('message.received', self.on_new_message, 50)]
+
+    @trigger('/rec', lambda text: text.endswith('!'))
+    def on_new_message(self, event, data):
+        self.calls.append(data['text'])
+        return data
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dispatcher = Dispatcher()
+        self.recorder = Recorder().register(self.dispatcher)
+        for plugin in (Console(), Dice(), Direct(), Me(), NoAuth()):
+            plugin.register(self.dispatcher)
+        self.api = Api(logging.getLogger(), self.dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+
+    def test_received_listeners_are_not_attached_to_dispatcher(self):
+        self.assertEqual([], \
+            [m for m in Me().mapping() if 'message.received' == m[0]])
+        self.assertEqual(1, len(Me().pipeline()))
+
+    def test_pipeline_is_sorted_by_priority(self):
+        priorities = [stage[0] for stage in self.api._pipeline]
+        self.assertEqual(sorted(priorities), priorities)
+        self.assertEqual(Console, self.api._pipeline[0][1].im_class)
+
+    def test_listener_is_called_when_trigger_matches(self):
+        self.api.recv('plain text', self.user, {})
+        self.api.recv('/rec foo', self.user, {})
+        self.api.recv('bar!', self.user, {})
+        self.assertEqual(['/rec foo', 'bar!'], self.recorder.calls)
+
+    def test_plugins_still_transform_messages(self):
+        self.api.recv('/me waves', self.user, {})
+        msg = self.api.rooms.get(None).cache.newer(0).next()
+        self.assertTrue(msg['me'])
+        self.assertEqual('waves', msg['text'])
+        self.api.recv('>bar:hi', self.user, {})
+        msg = self.api.rooms.get(None).cache.newer(0).next()
+        self.assertEqual('bar', msg['to'])
+        self.assertEqual('hi', msg['text'])
+
+    def test_plugin_registered_after_init_joins_pipeline(self):
+        recorder = Recorder().register(self.dispatcher)
+        self.api.recv('/rec foo', self.user, {})
+        self.assertEqual(['/rec foo'], recorder.calls)
+        self.assertEqual(['/rec foo'], self.recorder.calls)
+        priorities = [stage[0] for stage in self.api._pipeline]
+        self.assertEqual(sorted(priorities), priorities)
+
+    def test_pipeline_stops_when_message_is_rejected(self):
+        self.api.recv('$Console allowed Console grant!', self.user, {})
+        self.assertEqual([], self.recorder.calls)
+        self.assertEqual(0, len(self.api.rooms.get(None).cache))
+
+
+class History(Plugin):
+
+    def __init__(self, messages):
+        self.messages = messages # newest first
+        self.requests = []
+
+    def _mapping(self):
+        return [('message.history', self.history)]
+
+    def history(self, event):
+        self.requests.append((event['date'], event['cursor']))
+        older = [m for m in self.messages if m['date'] < event['date']]
+        event.return_value = older[:event['limit']]
+        return True
+
+
+class HistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dispatcher = Dispatcher()
+        NoAuth().register(self.dispatcher)
+        Direct().register(self.dispatcher)
+        self.archive = History([{'id': str(i), 'date': i, 'text': str(i), \
+            'from': {'id': 2}} for i in xrange(10, 0, -1)])
+        self.archive.register(self.dispatcher)
+        self.api = Api(logging.getLogger(), self.dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+        for i in xrange(0, 5):
+            self.api.recv('msg%u' % i, self.user, {})
+
+    def texts(self, messages):
+        return [m['text'] for m in messages]
+
+    def test_cached_messages_are_returned_first(self):
+        (messages, cursor) = self.api.fetch_history(self.user, limit=3)
+        self.assertEqual(['msg2', 'msg3', 'msg4'], self.texts(messages))
+        self.assertEqual('%u:%s' % (messages[0]['date'], messages[0]['id']), \
+            cursor)
+        (messages, cursor) = self.api.fetch_history(self.user, cursor, 2)
+        self.assertEqual(['msg0', 'msg1'], self.texts(messages))
+        self.assertEqual([], self.archive.requests)
+
+    def test_older_messages_are_fetched_from_listeners(self):
+        (messages, cursor) = self.api.fetch_history(self.user, limit=7)
+        self.assertEqual(['9', '10', 'msg0', 'msg1', 'msg2', 'msg3', 'msg4'], \
+            self.texts(messages))
+        self.assertEqual('9:9', cursor)
+        (messages, cursor) = self.api.fetch_history(self.user, cursor, 100)
+        self.assertEqual([str(i) for i in xrange(1, 9)], self.texts(messages))
+        self.assertIsNone(cursor)
+
+    def test_read_rules_are_applied(self):
+        self.api.recv('>bar:secret', self.user, {})
+        other = {'id': 3, 'name': 'baz', 'ip': '127.0.0.2', \
+            'logged': True, 'hasAccount': True}
+        (messages, cursor) = self.api.fetch_history(other, limit=1)
+        self.assertEqual(['msg4'], self.texts(messages))
+        (messages, cursor) = self.api.fetch_history(self.user, limit=1)
+        self.assertEqual(['secret'], self.texts(messages))
+
+    def test_invalid_cursor_raises_exception(self):
+        self.assertRaises(InvalidCursorError, self.api.fetch_history, \
+            self.user, 'foo')
+        self.assertRaises(InvalidCursorError, self.api.fetch_history, \
+            self.user, 'foo:bar')
+
+    def test_invalid_limit_raises_exception(self):
+        self.assertRaises(InvalidLimitError, self.api.fetch_history, \
+            self.user, None, 'abc')
+
+    def test_pages_do_not_depend_on_order_of_arrival(self):
+        room = self.api.rooms.get(None)
+        date = list(room.cache)[-1]['date']
+        # message accepted earlier by other process arrives late
+        self.api._on_bus_message({'room': None, 'readers': None, \
+            'message': {'id': '0.1', 'date': date, 'text': 'late', \
+            'from': {'id': 2}}})
+        (messages, cursor) = self.api.fetch_history(self.user, limit=3)
+        (older, cursor) = self.api.fetch_history(self.user, cursor, 3)
+        self.assertEqual(6, len(set(m['id'] for m in older + messages)))
+        self.assertEqual('late', older[0]['text'])
+
+
+
+class SubscriptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dispatcher = Dispatcher()
+        NoAuth().register(self.dispatcher)
+        self.api = Api(logging.getLogger(), self.dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+        self.batches = []
+
+    def poller(self, messages):
+        self.batches.append([m['text'] for m in messages])
+
+    def send(self, count):
+        for i in xrange(count):
+            self.api.recv('msg%u' % i, self.user, {})
+        # cache iterates from the newest message
+        return [m['id'] for m in self.api.rooms.get(None).cache][::-1]
+
+    def test_subscription_stays_attached(self):
+        self.api.subscribe(self.user, self.poller)
+        ids = self.send(3)
+        self.assertEqual([['msg0'], ['msg1'], ['msg2']], self.batches)
+        self.assertTrue(self.api.subscribed(self.poller))
+        self.assertEqual(ids[-1], self.api.pollers.cursor(self.poller))
+
+    def test_messages_newer_than_cursor_are_sent_on_subscribe(self):
+        ids = self.send(3)
+        self.api.subscribe(self.user, self.poller, ids[0])
+        self.assertEqual([['msg1', 'msg2']], self.batches)
+        self.assertEqual(ids[-1], self.api.pollers.cursor(self.poller))
+        self.api.recv('msg3', self.user, {})
+        self.assertEqual(['msg3'], self.batches[-1])
+
+    def test_detached_subscription_is_not_notified(self):
+        self.api.subscribe(self.user, self.poller)
+        self.api.detach_poller(self.poller)
+        self.api.recv('msg', self.user, {})
+        self.assertFalse(self.api.subscribed(self.poller))
+        self.assertEqual([], self.batches)
+
+    def test_shutdown_ends_subscription(self):
+        self.api.subscribe(self.user, self.poller)
+        self.api.shutdown()
+        self.assertEqual([['shutdown']], self.batches)
+        self.assertFalse(self.api.subscribed(self.poller))
+
+
+
+class BatchWindowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dispatcher = Dispatcher()
+        NoAuth().register(self.dispatcher)
+        Direct().register(self.dispatcher)
+        self.api = Api(logging.getLogger(), self.dispatcher)
+        self.api.batch_window = 20
+        self.timers = []
+        self.api.call_later = lambda delay, callback: \
+            self.timers.append(callback)
+        self.api.init()
+        self.users = [{'id': i, 'name': 'user%u' % i, 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True} for i in xrange(3)]
+        self.batches = []
+
+    def poller(self, messages):
+        self.batches.append(messages)
+
+    def other_poller(self, messages):
+        self.batches.append(messages)
+
+    def flush(self):
+        self.assertEqual(1, len(self.timers))
+        self.timers.pop()()
+
+    def test_messages_within_window_are_sent_as_one_batch(self):
+        self.api.attach_poller(self.users[1], self.poller)
+        self.api.attach_poller(self.users[2], self.other_poller)
+        for text in ('foo', 'bar', 'baz'):
+            self.api.recv(text, self.users[0], {})
+        self.assertEqual([], self.batches)
+        self.flush()
+        self.assertEqual(2, len(self.batches))
+        self.assertEqual(['foo', 'bar', 'baz'], \
+            [m['text'] for m in self.batches[0]])
+        # pollers see messages in the same way - batch is shared
+        self.assertIs(self.batches[0], self.batches[1])
+        self.assertEqual(0, len(self.api.pollers))
+
+    def test_addressed_messages_are_sent_to_readers_only(self):
+        self.api.attach_poller(self.users[1], self.poller)
+        self.api.attach_poller(self.users[2], self.other_poller)
+        self.api.recv('foo', self.users[0], {})
+        self.api.recv('>user1: bar', self.users[0], {})
+        self.flush()
+        self.assertEqual([2, 1], [len(batch) for batch in self.batches])
+
+    def test_poller_attached_within_window_does_not_get_message_twice(self):
+        self.api.recv('foo', self.users[0], {})
+        cursor = self.api.rooms.get(None).cache.newer(0).next()['id']
+        self.api.attach_poller(self.users[1], self.poller, cursor)
+        self.api.recv('bar', self.users[0], {})
+        self.flush()
+        self.assertEqual([['bar']], \
+            [[m['text'] for m in batch] for batch in self.batches])
+
+    def test_pending_messages_are_sent_on_shutdown(self):
+        self.api.attach_poller(self.users[1], self.poller)
+        self.api.recv('foo', self.users[0], {})
+        self.api.shutdown()
+        self.assertEqual(['foo'], [m['text'] for m in self.batches[0]])
+
+
+
+class AddressedMessageTargetingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        dispatcher = Dispatcher()
+        NoAuth().register(dispatcher)
+        Direct().register(dispatcher)
+        self.api = Api(logging.getLogger(), dispatcher).init()
+        # guests and logged users without account share ID -1, users
+        # behind NAT share IP address
+        guest = dict(Api.user_struct, ip='10.0.0.1')
+        self.users = {'guest': guest, \
+            'other guest': dict(guest, ip='10.0.0.2'), \
+            'alice': dict(guest, name='Alice', logged=True), \
+            'bob': dict(guest, name='Bob', logged=True), \
+            'carol': dict(guest, id=3, name='Carol', logged=True, \
+                hasAccount=True)}
+        self.filtered = []
+        filter_output = self.api._filter_output
+        def recording_filter(user, message, poller, room=None):
+            self.filtered.append(user['name'])
+            return filter_output(user, message, poller, room)
+        self.api._filter_output = recording_filter
+        self.received = {}
+        for (name, user) in self.users.iteritems():
+            self.api.attach_poller(user, partial(self.poller, name))
+
+    def poller(self, name, messages):
+        self.received[name] = [m['text'] for m in messages]
+
+    def test_direct_message_is_checked_for_sender_and_recipient_only(self):
+        self.api.recv('>Bob:foo', self.users['alice'], {})
+        self.assertEqual(['Alice', 'Bob'], sorted(self.filtered))
+        self.assertEqual({'alice': ['foo'], 'bob': ['foo']}, self.received)
+
+    def test_direct_message_reaches_account_user_by_name(self):
+        self.api.recv('>Carol:foo', self.users['bob'], {})
+        self.assertEqual(['Bob', 'Carol'], sorted(self.filtered))
+        self.assertEqual({'bob': ['foo'], 'carol': ['foo']}, self.received)
+
+
+class Poller(object):
+
+    def __init__(self):
+        self.reprs = 0
+
+    def __call__(self, messages):
+        pass
+
+    def __repr__(self):
+        self.reprs += 1
+        return '<poller>'
+
+
+class Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class HotPathLoggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logging.getLogger('campfire.test.hotpath')
+        self.log.propagate = False
+        self.records = Records()
+        self.log.addHandler(self.records)
+        dispatcher = Dispatcher()
+        NoAuth().register(dispatcher)
+        self.api = Api(self.log, dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+        self.pollers = [Poller() for i in xrange(3)]
+
+    def tearDown(self):
+        self.log.removeHandler(self.records)
+
+    def notify(self):
+        for poller in self.pollers:
+            self.api.attach_poller(self.user, poller)
+        self.api.recv('foo', self.user, {})
+
+    def test_callbacks_are_not_printed_when_debug_is_disabled(self):
+        self.log.setLevel(logging.WARNING)
+        self.notify()
+        self.assertEqual([0, 0, 0], [p.reprs for p in self.pollers])
+        self.assertEqual([], self.records.records)
+
+    def test_callbacks_are_printed_when_debug_is_enabled(self):
+        self.log.setLevel(logging.DEBUG)
+        self.notify()
+        self.assertTrue(all(p.reprs > 0 for p in self.pollers))
+
+    def test_sampled_records_are_logged_at_info_level(self):
+        self.log.setLevel(logging.INFO)
+        self.api.debug_sample = 2
+        self.notify()
+        sampled = [m for (level, m) in self.records.records \
+            if logging.INFO == level and 'poller' in m.split(';')[0]]
+        # every second operation is sampled: the second of 3 attaches
+        # and notification (one summary record instead of one per poller)
+        self.assertEqual(['msg=processing new poller', \
+            'msg=new messages not found, attaching new poller', \
+            'msg=message sent to pollers'], [m.split(';')[0] for m in sampled])
+        self.assertTrue('numpollers=3' in sampled[-1])
+        self.assertEqual([0, 2, 0], [p.reprs for p in self.pollers])
+
 if "__main__" == __name__:
     unittest.main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire.archive import ArchiveWriter, CsvBackend, BlockBackend, \
+    BlockReader, read_archive
+from campfire.api import Api
+from campfire.plugins import Archive, NoAuth
+from campfire.utils import ListenerStats, Plugin
+
+# event modules
+from event import Dispatcher, Event
+
+
+class ArchiveWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.path, 'archive.%Y%m%d.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self):
+        files = os.listdir(self.path)
+        self.assertEqual(1, len(files))
+        with open(os.path.join(self.path, files[0])) as f:
+            return f.read()
+
+    def test_lines_are_written_on_stop(self):
+        writer = ArchiveWriter(CsvBackend(self.pattern), \
+            logging.getLogger(), flush_interval=60)
+        writer.start()
+        self.assertEqual(2, writer.submit([(1, 'foo', ['a', 'b c']), \
+            (2, 'bar', ['d', 'e'])]))
+        writer.stop()
+        self.assertEqual('a "b c"\r\nd e\r\n', self.read())
+        self.assertEqual(2, writer.written)
+        self.assertEqual(0, writer.stats()['queued'])
+
+    def test_lines_are_written_in_batches(self):
+        writer = ArchiveWriter(CsvBackend(self.pattern), \
+            logging.getLogger(), flush_size=2, flush_interval=60)
+        writer.start()
+        writer.submit([(1, 'foo', ['a']), (2, 'foo', ['b']), \
+            (3, 'foo', ['c'])])
+        writer.stop()
+        self.assertEqual(2, writer.flushes)
+        self.assertEqual('a\r\nb\r\nc\r\n', self.read())
+
+    def test_full_queue_rejects_lines(self):
+        writer = ArchiveWriter(CsvBackend(self.pattern), \
+            logging.getLogger(), queue_size=2)
+        # writer is not started, so nothing is consumed
+        self.assertEqual(2, writer.submit([(1, 'foo', ['a']), \
+            (2, 'foo', ['b']), (3, 'foo', ['c'])]))
+        self.assertEqual(1, writer.rejected)
+        self.assertEqual(2, writer.stats()['queued'])
+
+    def test_file_is_rotated_when_path_changes(self):
+        backend = CsvBackend(self.pattern)
+        backend.write([(1, 'foo', ['a'])])
+        first = backend._file
+        backend.path = os.path.join(self.path, 'other.csv')
+        backend.write([(2, 'foo', ['b'])])
+        self.assertTrue(first.closed)
+        backend.close()
+        self.assertEqual(['b\r\n'], open(backend.path).readlines())
+
+
+class BlockBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.archive = os.path.join(self.path, 'archive.blk')
+        backend = BlockBackend(self.archive, block_size=2)
+        backend.write([(10, 'foo', ['a']), (20, 'bar', ['b']), \
+            (30, 'foo', ['c'])])
+        backend.write([(40, 'baz', ['d'])])
+        backend.close()
+        self.reader = BlockReader(self.archive)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_blocks_are_indexed(self):
+        self.assertEqual(3, len(self.reader.blocks()))
+        self.assertEqual([10, 20, 2, ['bar', 'foo']], \
+            self.reader.blocks()[0][2:])
+
+    def test_blocks_are_selected_by_time_and_user(self):
+        self.assertEqual(2, len(self.reader.blocks(25, 50)))
+        self.assertEqual(1, len(self.reader.blocks(user='baz')))
+        self.assertEqual([], self.reader.blocks(user='qux'))
+
+    def test_messages_are_read_for_time_range(self):
+        self.assertEqual([[20, 'bar', ['b']], [30, 'foo', ['c']]], \
+            list(self.reader.messages(15, 35)))
+
+    def test_messages_are_read_for_user(self):
+        self.assertEqual([[10, 'foo', ['a']], [30, 'foo', ['c']]], \
+            list(self.reader.messages(user='foo')))
+
+    def test_missing_archive_is_empty(self):
+        self.assertEqual([], list(BlockReader(self.archive + '.x').messages()))
+
+    def test_archive_of_many_days_is_read(self):
+        self.assertEqual([[40, 'baz', ['d']]], \
+            list(read_archive(self.archive, 35, 86400 * 3)))
+
+
+class ArchiveHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        backend = BlockBackend(os.path.join(self.path, 'archive.blk'))
+        backend.write([(i // 2, 'foo', [], {'id': str(i), 'date': i // 2}) \
+            for i in xrange(0, 10)])
+        backend.write([(5, 'foo', [], {'id': 'r', 'date': 5, 'room': 'x'})])
+        self.plugin = Archive(None, None, backend=backend)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def history(self, date, cursor, limit=3, room=None):
+        event = Event(None, 'message.history', {'date': date, \
+            'cursor': cursor, 'limit': limit, 'room': room})
+        self.assertTrue(self.plugin.history(event))
+        return [m['id'] for m in event.return_value]
+
+    def test_messages_older_than_cursor_are_returned(self):
+        self.assertEqual(['6', '5', '4'], self.history(3, '7'))
+        self.assertEqual(['5', '4', '3'], self.history(3, '6'))
+        self.assertEqual(['1', '0'], self.history(1, '2'))
+
+    def test_cursor_does_not_have_to_be_written(self):
+        # message "8" has not been flushed yet
+        self.assertEqual(['7', '6', '5'], self.history(4, '8'))
+
+    def test_archives_of_many_processes_are_merged(self):
+        for (origin, dates) in (('a', (1, 4, 5)), ('b', (2, 3, 5))):
+            backend = BlockBackend(os.path.join(self.path, \
+                'merged.%s.blk' % origin), block_size=2)
+            backend.write([(date, 'foo', [], {'id': '%s.%u' % (origin, date), \
+                'date': date}) for date in dates])
+            backend.close()
+        backend = BlockBackend(os.path.join(self.path, 'merged.a.blk'), \
+            read_path=os.path.join(self.path, 'merged.*.blk'))
+        self.plugin.backend = backend
+        self.assertEqual(['b.5', 'a.5', 'a.4', 'b.3'], self.history(6, None, 4))
+        self.assertEqual(['a.4', 'b.3', 'b.2', 'a.1'], \
+            self.history(5, 'a.5', 10))
+        self.assertEqual(['a.1', 'b.2', 'b.3', 'a.4', 'a.5', 'b.5'], \
+            [r[3]['id'] for r in read_archive(backend.read_path, 0, 6)])
+
+    def test_messages_are_filtered_by_room(self):
+        self.assertEqual(['r'], self.history(6, None, room='x'))
+
+    def test_csv_backend_does_not_serve_history(self):
+        plugin = Archive(os.path.join(self.path, 'a.csv'), None)
+        self.assertFalse(plugin.history(Event(None, 'message.history', {})))
+
+
+class ArchiveRegisterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Plugin.listener_stats = None
+        shutil.rmtree(self.path)
+
+    def chat(self):
+        dispatcher = Dispatcher()
+        NoAuth().register(dispatcher)
+        Archive(os.path.join(self.path, 'archive.csv'), \
+            lambda data: [data['date'], data['text']]).register(dispatcher)
+        api = Api(logging.getLogger(), dispatcher).init()
+        api.recv('foo', {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}, {})
+        api.shutdown()
+
+    def test_archive_is_registered_without_profiler(self):
+        self.chat()
+        self.assertEqual(1, len(os.listdir(self.path)))
+
+    def test_archive_is_registered_with_profiler(self):
+        stats = ListenerStats()
+        Plugin.listener_stats = stats
+        self.chat()
+        self.assertEqual(1, len(os.listdir(self.path)))
+        self.assertTrue(('Archive', 'message.received') in \
+            [(s['plugin'], s['event']) for s in stats.snapshot()])
+
+
+if "__main__" == __name__:
+    unittest.main()
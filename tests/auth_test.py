@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import os
+import select
+import shutil
+import logging
+import tempfile
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.bus import UnixSocketBus
+from campfire.utils import AuthHelper, Signer
+from campfire.sessions import SQLiteSessionStore
+
+
+class SharedSessionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.helpers = [self.create_helper(i) for i in xrange(0, 2)]
+
+    def tearDown(self):
+        for helper in self.helpers:
+            helper.bus.close()
+        shutil.rmtree(self.path)
+
+    def create_store(self, worker_id):
+        return None
+
+    def create_helper(self, worker_id):
+        log = logging.getLogger()
+        dispatcher = Dispatcher()
+        api = Api(log, dispatcher)
+        api.bus = UnixSocketBus(self.path, worker_id)
+        return AuthHelper(api, dispatcher, log, self.create_store(worker_id))
+
+    def wait(self, helper):
+        select.select([helper.bus.fileno()], [], [], 1)
+        helper.bus.receive()
+
+    def test_login_is_known_in_other_processes(self):
+        token = self.helpers[0].login('foo', '127.0.0.1')
+        self.wait(self.helpers[1])
+        self.assertEqual('foo', self.helpers[1].get_current_user(token)['name'])
+        self.assertRaises(RuntimeError, self.helpers[1].login, 'foo', \
+            '127.0.0.1')
+
+    def test_logout_is_shared(self):
+        token = self.helpers[0].login('foo', '127.0.0.1')
+        self.wait(self.helpers[1])
+        self.helpers[0].get_current_user(token)
+        self.helpers[1].logout(token)
+        self.wait(self.helpers[0])
+        self.assertIsNone(self.helpers[0].get_current_user(token))
+        self.assertEqual(0, len(self.helpers[0].store))
+
+    def test_lastvisit_is_shared(self):
+        token = self.helpers[0].login('foo', '127.0.0.1')
+        self.wait(self.helpers[1])
+        self.helpers[0].get_current_user(token)
+        self.helpers[0]._cache[token]['shared'] -= \
+            self.helpers[0].share_interval
+        self.helpers[0].get_current_user(token)
+        self.wait(self.helpers[1])
+        self.assertEqual(self.helpers[0]._cache[token]['lastvisit'], \
+            self.helpers[1].store.get(token)[1])
+
+
+class SQLiteSharedSessionsTestCase(SharedSessionsTestCase):
+
+    def create_store(self, worker_id):
+        return SQLiteSessionStore(os.path.join(self.path, 'sessions.db'))
+
+    def wait(self, helper):
+        # logins and visits are not published (store is shared)
+        if helper.bus.fileno() in select.select([helper.bus.fileno()], [], \
+                [], 0.1)[0]:
+            helper.bus.receive()
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SessionExpiryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        log = logging.getLogger()
+        dispatcher = Dispatcher()
+        self.out = []
+        dispatcher.attach('auth.logged.out', self.out.append)
+        self.clock = Clock(1000.0)
+        self.helper = AuthHelper(Api(log, dispatcher), dispatcher, log, \
+            clock=self.clock)
+        self.tokens = [self.helper.login(name, '127.0.0.1') \
+            for name in ('foo', 'bar', 'baz')]
+        self.session_time = self.helper.session_time * 60
+
+    def test_expired_sessions_are_removed(self):
+        self.clock.now += self.session_time - 1
+        for token in self.tokens[1:]:
+            self.helper.get_current_user(token)
+        self.clock.now += self.helper.share_interval + 2
+        self.helper.cleanup()
+        self.assertIsNone(self.helper.store.get(self.tokens[0]))
+        self.assertIsNone(self.helper.get_current_user(self.tokens[0]))
+        self.assertEqual('bar', \
+            self.helper.get_current_user(self.tokens[1])['name'])
+        self.assertEqual(['foo'], [e['profile']['name'] for e in self.out])
+
+    def test_expired_session_is_removed_after_share_interval(self):
+        self.clock.now += self.session_time + 1
+        self.helper.cleanup()
+        # session is not valid, but visit in other process might
+        # have not been written to store yet
+        self.assertIsNone(self.helper.get_current_user(self.tokens[0]))
+        self.assertIsNotNone(self.helper.store.get(self.tokens[0]))
+        self.assertEqual([], self.out)
+        self.clock.now += self.helper.share_interval
+        self.helper.cleanup()
+        self.assertIsNone(self.helper.store.get(self.tokens[0]))
+        self.assertEqual(['bar', 'baz', 'foo'], \
+            sorted(e['profile']['name'] for e in self.out))
+
+    def test_expired_user_is_not_returned(self):
+        start = self.clock.now
+        self.helper.get_current_user(self.tokens[0])
+        # session has been used in other process
+        self.helper.store.touch(self.tokens[0], start + 10)
+        self.clock.now = start + self.session_time + 5
+        self.assertIsNotNone(self.helper.get_current_user(self.tokens[0]))
+        self.clock.now += self.session_time
+        self.assertIsNone(self.helper.get_current_user(self.tokens[0]))
+
+    def test_cache_is_bounded(self):
+        self.helper.cache_size = 2
+        for token in self.tokens:
+            self.helper.get_current_user(token)
+        self.assertEqual(self.tokens[1:], list(self.helper._cache))
+        self.assertEqual('foo', \
+            self.helper.get_current_user(self.tokens[0])['name'])
+
+    def test_login_used_is_rejected(self):
+        self.assertRaises(RuntimeError, self.helper.login, 'foo', '127.0.0.1')
+
+    def test_unknown_token_is_rejected(self):
+        self.assertIsNone(self.helper.get_current_user('qux'))
+        self.assertIsNone(self.helper.get_current_user(None))
+
+
+class TicketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        log = logging.getLogger()
+        dispatcher = Dispatcher()
+        self.helper = AuthHelper(Api(log, dispatcher), dispatcher, log, \
+            secret='secret')
+        self.token = self.helper.login('foo', '127.0.0.1')
+        self.ticket = self.helper.ticket(self.token)
+
+    def test_signed_value_is_verified(self):
+        signer = Signer('secret')
+        signed = signer.sign(['foo', {'bar': 1}])
+        self.assertEqual(['foo', {'bar': 1}], signer.unsign(signed))
+        self.assertIsNone(Signer('other').unsign(signed))
+        self.assertIsNone(signer.unsign(signed[1:]))
+        self.assertIsNone(signer.unsign('foo'))
+
+    def test_ticket_user_is_returned_without_lookup(self):
+        self.helper.store = None
+        self.assertEqual('foo', \
+            self.helper.get_ticket_user(self.ticket)['name'])
+        self.assertIsNone(self.helper.get_ticket_user(None))
+        self.assertIsNone(self.helper.get_ticket_user(self.ticket + 'x'))
+
+    def test_ticket_of_invalid_session_is_not_issued(self):
+        self.assertIsNone(self.helper.ticket('bar'))
+
+    def test_expired_ticket_is_rejected(self):
+        self.helper.ticket_time = -1
+        ticket = self.helper.ticket(self.token)
+        self.assertIsNone(self.helper.get_ticket_user(ticket))
+
+    def test_tickets_of_logged_out_session_are_rejected(self):
+        self.helper.logout(self.token)
+        self.assertIsNone(self.helper.get_ticket_user(self.ticket))
+
+    def test_revoked_tokens_are_dropped_once_tickets_expire(self):
+        clock = Clock(1000.0)
+        self.helper.clock = clock
+        tokens = [self.helper.login(name, '127.0.0.1') \
+            for name in ('bar', 'baz')]
+        for token in tokens:
+            self.helper.logout(token)
+            clock.now += 60
+        self.helper.logout(self.token)
+        self.assertEqual(tokens + [self.token], list(self.helper._revoked))
+        clock.now += self.helper.ticket_time * 60 - 90
+        self.helper.cleanup()
+        self.assertEqual(tokens[1:] + [self.token], \
+            list(self.helper._revoked))
+        self.assertIsNone(self.helper.get_ticket_user(self.ticket))
+
+    def test_visits_are_written_in_batches(self):
+        self.helper._cache.clear()
+        self.helper.get_ticket_user(self.ticket)
+        visit = self.helper._visits[self.token]
+        self.helper.cleanup()
+        self.assertEqual(visit, self.helper.store.get(self.token)[1])
+        self.assertEqual({}, self.helper._visits)
+
+
+if "__main__" == __name__:
+    unittest.main()
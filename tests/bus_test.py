@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import os
+import json
+import logging
+import select
+import shutil
+import tempfile
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.bus import LocalBus, UnixSocketBus
+from campfire.plugins import NoAuth
+
+# event modules
+from event import Dispatcher
+
+
+class LocalBusTestCase(unittest.TestCase):
+
+    def test_publish_does_not_call_local_handlers(self):
+        out = []
+        bus = LocalBus()
+        bus.subscribe('foo', out.append)
+        bus.publish('foo', 'bar')
+        bus.receive()
+        self.assertEqual([], out)
+        self.assertIsNone(bus.fileno())
+
+
+class UnixSocketBusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.buses = [UnixSocketBus(self.path, i) for i in xrange(0, 3)]
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+        shutil.rmtree(self.path)
+
+    def wait(self, bus):
+        select.select([bus.fileno()], [], [], 1)
+        bus.receive()
+
+    def test_published_data_is_received_by_other_processes(self):
+        out = []
+        for bus in self.buses:
+            bus.subscribe('foo', out.append)
+        self.buses[0].publish('foo', {'bar': [1, 2]})
+        self.wait(self.buses[1])
+        self.wait(self.buses[2])
+        self.assertEqual([{'bar': [1, 2]}, {'bar': [1, 2]}], out)
+        # publisher does not receive own data
+        self.buses[0].receive()
+        self.assertEqual(2, len(out))
+
+    def test_handlers_receive_data_of_subscribed_channel_only(self):
+        out = []
+        self.buses[1].subscribe('foo', out.append)
+        self.buses[0].publish('bar', 1)
+        self.buses[0].publish('foo', 2)
+        self.wait(self.buses[1])
+        self.assertEqual([2], out)
+
+    def test_stale_peers_are_forgotten(self):
+        self.buses[2]._socket.close()
+        self.buses[0].publish('foo', 1)
+        self.assertEqual(1, self.buses[0].dropped)
+        self.assertFalse(os.path.exists(self.buses[2].address))
+
+    def test_data_that_does_not_fit_is_sent_later(self):
+        out = []
+        self.buses[1].subscribe('foo', out.append)
+        # publish until receive queue of peer is full
+        count = 0
+        while count < 10 or not self.buses[0].pending():
+            self.buses[0].publish('foo', count)
+            count += 1
+        for i in xrange(0, 1000):
+            if not self.buses[0].pending():
+                break
+            self.buses[1].receive()
+            self.buses[2].receive()
+            self.buses[0].flush()
+        self.buses[1].receive()
+        self.assertEqual(range(0, count), out)
+        self.assertEqual(0, self.buses[0].dropped)
+
+
+class QueueBus(LocalBus):
+
+    def __init__(self):
+        super(QueueBus, self).__init__()
+        self.queue = []
+
+    def publish(self, channel, data):
+        self.queue.append((channel, json.loads(json.dumps(data))))
+
+    def deliver(self, other):
+        for (channel, data) in self.queue:
+            other.bus._dispatch(channel, data)
+        self.queue = []
+
+
+class SharedChatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.apis = []
+        for i in xrange(0, 2):
+            dispatcher = Dispatcher()
+            NoAuth().register(dispatcher)
+            api = Api(logging.getLogger(), dispatcher)
+            api.bus = QueueBus()
+            self.apis.append(api.init())
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+        self.received = []
+
+    def poller(self, messages):
+        self.received.extend(messages)
+
+    def poll(self, api, cursor):
+        self.received = []
+        api.attach_poller(self.user, self.poller, cursor)
+        return [m['text'] for m in self.received]
+
+    def test_messages_arriving_in_different_order_are_not_lost(self):
+        (a, b) = self.apis
+        b.recv('foo', self.user, {})
+        a.recv('bar', self.user, {})
+        # "bar" is seen in process A before "foo" arrives
+        self.assertEqual(['bar'], self.poll(a, None))
+        cursor = self.received[-1]['cursor']
+        a.bus.deliver(b)
+        b.bus.deliver(a)
+        self.assertEqual(['foo'], self.poll(b, cursor))
+        self.assertEqual(['foo'], self.poll(a, cursor))
+
+    def test_cursor_of_message_not_arrived_yet_does_not_cause_resync(self):
+        (a, b) = self.apis
+        a.recv('foo', self.user, {})
+        self.assertEqual(['foo'], self.poll(a, None))
+        cursor = self.received[-1]['cursor']
+        # poller waits instead of getting resync message
+        self.assertEqual([], self.poll(b, cursor))
+        # message seen already is not sent again when it arrives
+        a.bus.deliver(b)
+        self.assertEqual([], self.received)
+        b.recv('bar', self.user, {})
+        self.assertEqual(['bar'], [m['text'] for m in self.received])
+
+    def test_message_id_is_accepted_as_cursor(self):
+        (a, b) = self.apis
+        a.recv('foo', self.user, {})
+        a.recv('bar', self.user, {})
+        self.poll(a, None)
+        self.assertEqual(['bar'], self.poll(a, self.received[0]['id']))
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire import cache
+from campfire.cache import MessageCache, parse_cursor
+
+
+class MessageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MessageCache(3)
+
+    def test_init_expects_size_to_be_int(self):
+        err = False
+        try:
+            MessageCache('a')
+        except TypeError:
+            err = True
+        self.assertTrue(err)
+
+    def test_append_returns_increasing_sequence_numbers(self):
+        self.assertEqual(1, self.cache.append({'id': 'a'}))
+        self.assertEqual(2, self.cache.append({'id': 'b'}))
+        self.assertEqual(2, self.cache.seq)
+
+    def test_iteration_starts_from_newest_message(self):
+        self.cache.append({'id': 'a'})
+        self.cache.append({'id': 'b'})
+        self.assertEqual(['b', 'a'], [m['id'] for m in self.cache])
+
+    def test_position_resolves_cursor(self):
+        self.cache.append({'id': 'a'})
+        self.cache.append({'id': 'b'})
+        self.assertEqual(1, self.cache.position('a'))
+        self.assertEqual(2, self.cache.position('b'))
+        self.assertIsNone(self.cache.position('c'))
+
+    def test_evicted_messages_can_not_be_resolved(self):
+        for i in 'abcd':
+            self.cache.append({'id': i})
+        self.assertEqual(3, len(self.cache))
+        self.assertIsNone(self.cache.position('a'))
+        self.assertEqual(4, self.cache.position('d'))
+
+    def test_newer_returns_messages_after_given_sequence_number(self):
+        for i in 'abcd':
+            self.cache.append({'id': i})
+        self.assertEqual(['d', 'c'], [m['id'] for m in \
+            self.cache.newer(self.cache.position('b'))])
+        self.assertEqual([], list(self.cache.newer(self.cache.seq)))
+
+    def test_readers_of_addressed_messages_are_stored(self):
+        self.cache.append({'id': 'a'})
+        self.cache.append({'id': 'b'}, ['foo', 'bar'])
+        self.assertIsNone(self.cache.readers('a'))
+        self.assertEqual(frozenset(['foo', 'bar']), self.cache.readers('b'))
+        for i in 'cde':
+            self.cache.append({'id': i})
+        self.assertIsNone(self.cache.readers('b'))
+
+    def test_unbounded_cache(self):
+        cache = MessageCache(None)
+        for i in xrange(0, 200):
+            cache.append({'id': i})
+        self.assertEqual(200, len(cache))
+        self.assertEqual(1, cache.position(0))
+
+    def test_load_restores_sequence(self):
+        cache = MessageCache(2)
+        cache.load([(7, {'id': 'a'}, None), (8, {'id': 'b'}, set(['1']))])
+        self.assertEqual(8, cache.seq)
+        self.assertEqual(7, cache.position('a'))
+        self.assertEqual(frozenset(['1']), cache.readers('b'))
+
+    def append(self, *ids):
+        for i in ids:
+            self.cache.append(self.cache.stamp({'id': i}))
+
+    def test_cursor_holds_newest_message_of_each_cached_origin(self):
+        self.append('a.1', 'b.1', 'a.2')
+        self.assertEqual('a.2,b.1', iter(self.cache).next()['cursor'])
+        # the only message of origin "b" is evicted
+        self.append('a.3', 'a.4')
+        self.assertEqual('a.4', iter(self.cache).next()['cursor'])
+        self.assertEqual({'a': 3, 'b': 1}, parse_cursor('a.3,b.1'))
+        self.assertIsNone(parse_cursor('a'))
+
+    def test_after_does_not_depend_on_order_of_arrival(self):
+        self.append('b.1', 'a.1', 'a.2')
+        self.assertEqual(['a.2', 'b.1'], \
+            [m['id'] for m in self.cache.after('a.1')])
+        self.assertEqual(['a.2'], \
+            [m['id'] for m in self.cache.after('a.1,b.1')])
+        self.assertEqual([], self.cache.after('a.2,b.1'))
+
+    def test_after_detects_evicted_messages(self):
+        self.append('a.1', 'a.2', 'b.1', 'a.3')
+        self.assertIsNone(self.cache.after('a.0,b.1'))
+        self.assertEqual(['a.3'], \
+            [m['id'] for m in self.cache.after('a.2,b.1')])
+        # message ID without origin is resolved by position
+        cache = MessageCache(2)
+        for i in 'abc':
+            cache.append({'id': i})
+        self.assertEqual(['c'], [m['id'] for m in cache.after('b')])
+        self.assertIsNone(cache.after('a'))
+
+    def test_after_does_not_scan_cached_messages(self):
+        self.cache = MessageCache(1000)
+        self.append('b.1', *['a.%u' % i for i in xrange(1, 999)])
+        calls = []
+        parse_id = cache.parse_id
+        cache.parse_id = lambda message_id: calls.append(message_id) or \
+            parse_id(message_id)
+        try:
+            self.assertEqual(['a.998'], \
+                [m['id'] for m in self.cache.after('a.997,b.1')])
+            self.assertEqual(['a.998', 'a.997'], \
+                [m['id'] for m in self.cache.after('a.996')][:2])
+        finally:
+            cache.parse_id = parse_id
+        self.assertEqual(['a.997', 'b.1', 'a.996'], calls)
+
+    def test_ahead_returns_origins_of_messages_not_arrived_yet(self):
+        self.append('a.1', 'b.2')
+        self.assertIsNone(self.cache.ahead('a.1,b.2'))
+        self.assertEqual({'b': 3, 'c': 1}, self.cache.ahead('a.1,b.3,c.1'))
+        self.assertIsNone(self.cache.ahead(None))
+
+
+if "__main__" == __name__:
+    unittest.main()
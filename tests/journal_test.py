@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.journal import FileJournal
+from campfire.plugins import NoAuth
+
+
+class FileJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fill(self, journal, count, room=None):
+        for i in xrange(1, count + 1):
+            journal.append(room, i, {'id': str(i), 'text': 'foo'})
+
+    def test_recent_messages_survive_reopening(self):
+        journal = FileJournal(self.path, keep=3)
+        self.fill(journal, 5)
+        journal.append('room', 1, {'id': 'x'}, set(['1']))
+        journal.close()
+        journal = FileJournal(self.path, keep=3)
+        self.assertEqual([3, 4, 5], [r[0] for r in journal.recent(None)])
+        self.assertEqual([(1, {'id': 'x'}, set(['1']))], \
+            journal.recent('room'))
+        self.assertEqual([], journal.recent('other'))
+
+    def test_messages_appended_after_opening_are_readable(self):
+        journal = FileJournal(self.path, keep=3)
+        self.fill(journal, 1)
+        journal.close()
+        journal = FileJournal(self.path, keep=3)
+        journal.append(None, 2, {'id': '2'})
+        self.assertEqual(['1', '2'], \
+            [r[1]['id'] for r in journal.recent(None)])
+
+    def test_incomplete_record_is_truncated(self):
+        journal = FileJournal(self.path, keep=3)
+        self.fill(journal, 2)
+        journal.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as f:
+            f.write('\x00\x00')
+        journal = FileJournal(self.path, keep=3)
+        self.assertEqual(size, os.path.getsize(self.path))
+        self.assertEqual(2, len(journal.recent(None)))
+
+    def test_journal_is_compacted(self):
+        journal = FileJournal(self.path, keep=2)
+        journal.max_size = 200
+        journal._limit = 200
+        self.fill(journal, 20)
+        self.assertEqual([19, 20], [r[0] for r in journal.recent(None)])
+        # records are written (and file compacted) by writer thread
+        journal.close()
+        self.assertTrue(os.path.getsize(self.path) <= 200)
+        journal = FileJournal(self.path, keep=2)
+        self.assertEqual([19, 20], [r[0] for r in journal.recent(None)])
+
+    def test_message_that_can_not_be_encoded_is_skipped(self):
+        journal = FileJournal(self.path, keep=3)
+        self.fill(journal, 1)
+        journal.append(None, 2, {'id': '2', 'text': '\xff'})
+        self.assertEqual(1, journal.rejected)
+        self.assertEqual(['1'], [r[1]['id'] for r in journal.recent(None)])
+        journal.close()
+        journal = FileJournal(self.path, keep=3)
+        self.assertEqual(['1'], [r[1]['id'] for r in journal.recent(None)])
+
+
+class ApiRestoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def api(self):
+        dispatcher = Dispatcher()
+        NoAuth().register(dispatcher)
+        api = Api(logging.getLogger(), dispatcher)
+        api.journal = FileJournal(self.path)
+        return api.init()
+
+    def test_cache_is_restored_on_init(self):
+        api = self.api()
+        api.recv('foo', {'id': 1}, {})
+        api.recv('bar', {'id': 1}, {}, 'room')
+        cursor = api.rooms.get(None).cache.newer(0).next()['id']
+        api.journal.close()
+        api = self.api()
+        cache = api.rooms.get(None).cache
+        self.assertEqual(cursor, cache.newer(0).next()['id'])
+        self.assertEqual(1, cache.position(cursor))
+        self.assertEqual(1, len(api.rooms.get('room').cache))
+
+    def test_idle_rooms_are_evicted(self):
+        api = self.api()
+        api.rooms.max_rooms = 3
+        api.attach_poller(None, 'a', None, 'room1')
+        for i in xrange(2, 5):
+            api.rooms.get('room%u' % i)
+        self.assertEqual(3, len(api.rooms))
+        self.assertIsNotNone(api.rooms.find('room1'))
+        self.assertIsNone(api.rooms.find('room2'))
+        self.assertIsNotNone(api.rooms.find('room4'))
+
+    def test_evicted_room_is_restored(self):
+        api = self.api()
+        api.rooms.max_rooms = 2
+        api.recv('foo', {'id': 1}, {}, 'room')
+        cursor = api.rooms.get('room').cache.newer(0).next()['cursor']
+        api.recv('bar', {'id': 1}, {}, 'room')
+        # the least recently used room is evicted
+        api.rooms.get(None)
+        api.rooms.get('other')
+        self.assertIsNone(api.rooms.find('room'))
+        received = []
+        api.attach_poller({'id': 1}, received.append, cursor, 'room')
+        self.assertEqual(['bar'], [m['text'] for m in received[0]])
+
+
+if "__main__" == __name__:
+    unittest.main()
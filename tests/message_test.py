@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import copy
+import json
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire.message import FrozenDict, Batch, freeze
+
+
+class FreezeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.msg = freeze({'id': 'a', 'text': 'foo', 'from': {'name': 'bar'}, \
+            'args': {'as_puppet': [1]}})
+
+    def test_freeze_converts_nested_dicts(self):
+        self.assertTrue(isinstance(self.msg, FrozenDict))
+        self.assertTrue(isinstance(self.msg['from'], FrozenDict))
+        self.assertEqual((1,), self.msg['args']['as_puppet'])
+
+    def test_frozen_dict_can_not_be_modified(self):
+        for f in [lambda m: m.__setitem__('text', 'baz'), \
+                lambda m: m.__delitem__('text'), lambda m: m.pop('text'), \
+                lambda m: m.update({}), lambda m: m.clear(), \
+                lambda m: m['from'].__setitem__('name', 'baz')]:
+            self.assertRaises(TypeError, f, self.msg)
+
+    def test_frozen_dict_is_equal_to_dict(self):
+        self.assertEqual({'name': 'bar'}, self.msg['from'])
+
+    def test_shallow_copy_is_modifiable(self):
+        tmp = dict(self.msg)
+        tmp['text'] = 'baz'
+        self.assertEqual('foo', self.msg['text'])
+
+    def test_deep_copy_is_modifiable(self):
+        tmp = copy.deepcopy(self.msg)
+        tmp['from']['name'] = 'baz'
+        self.assertEqual('bar', self.msg['from']['name'])
+
+    def test_frozen_dict_is_serializable(self):
+        self.assertEqual({'name': 'bar'}, \
+            json.loads(json.dumps(self.msg))['from'])
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def test_batch_is_a_list(self):
+        self.assertEqual([{'id': 'a'}], Batch([{'id': 'a'}]))
+
+    def test_encode_caches_result(self):
+        calls = []
+        def encoder(batch):
+            calls.append(batch)
+            return json.dumps(batch)
+        batch = Batch([{'id': 'a'}])
+        self.assertEqual('[{"id": "a"}]', batch.encode('json', encoder))
+        self.assertEqual('[{"id": "a"}]', batch.encode('json', encoder))
+        self.assertEqual(1, len(calls))
+
+
+if "__main__" == __name__:
+    unittest.main()
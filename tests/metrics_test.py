@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import logging
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.metrics import Registry
+from campfire.plugins import NoAuth
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_metric_is_identified_by_name_and_labels(self):
+        counter = self.registry.counter('foo_total', 'Foo', a='1')
+        self.assertIs(counter, self.registry.counter('foo_total', 'Foo', a='1'))
+        self.assertIsNot(counter, self.registry.counter('foo_total', 'Foo'))
+        self.assertRaises(ValueError, self.registry.gauge, 'foo_total', 'Foo')
+
+    def test_metrics_are_rendered_in_text_format(self):
+        self.registry.counter('foo_total', 'Foo', kind='a"b').inc(2)
+        self.registry.gauge('bar', 'Bar', lambda: 1.5)
+        histogram = self.registry.histogram('baz_seconds', 'Baz', (0.1, 1))
+        histogram.observe(0.1)
+        histogram.observe(5)
+        self.assertEqual('\n'.join([
+            '# HELP foo_total Foo',
+            '# TYPE foo_total counter',
+            'foo_total{kind="a\\"b"} 2',
+            '# HELP bar Bar',
+            '# TYPE bar gauge',
+            'bar 1.5',
+            '# HELP baz_seconds Baz',
+            '# TYPE baz_seconds histogram',
+            'baz_seconds_bucket{le="0.1"} 1',
+            'baz_seconds_bucket{le="1"} 1',
+            'baz_seconds_bucket{le="+Inf"} 2',
+            'baz_seconds_sum 5.1',
+            'baz_seconds_count 2']) + '\n', self.registry.render())
+
+
+class ApiMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        dispatcher = Dispatcher()
+        NoAuth().register(dispatcher)
+        self.api = Api(logging.getLogger(), dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+
+    def samples(self):
+        return dict((name, value) for (name, labels, value) \
+            in self.api.metrics.collect() if not labels)
+
+    def test_delivery_is_counted(self):
+        pollers = [lambda messages: None, lambda messages: None]
+        for poller in pollers:
+            self.api.attach_poller(self.user, poller)
+        self.assertEqual(2, self.samples()['campfire_pollers'])
+        self.api.recv('foo', self.user, {})
+        samples = self.samples()
+        self.assertEqual(1, samples['campfire_messages_received_total'])
+        self.assertEqual(1, samples['campfire_messages_stored_total'])
+        self.assertEqual(2, samples['campfire_messages_sent_total'])
+        self.assertEqual(2, samples['campfire_poller_releases_total'])
+        self.assertEqual(1, samples['campfire_fanout_seconds_count'])
+        self.assertEqual(1, samples['campfire_cache_messages'])
+        self.assertEqual(0, samples['campfire_pollers'])
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import logging
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+# event modules
+from event import Dispatcher
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.plugins import Console, Me, NoAuth, Profiler
+from campfire.utils import ListenerStats, Plugin
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.stats = ListenerStats()
+        Plugin.listener_stats = self.stats
+        self.dispatcher = Dispatcher()
+        self.profiler = Profiler(self.stats)
+        for plugin in (Console(), Me(), NoAuth(), self.profiler):
+            plugin.register(self.dispatcher)
+        self.api = Api(logging.getLogger(), self.dispatcher).init()
+        self.user = {'id': 1, 'name': 'foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+
+    def tearDown(self):
+        Plugin.listener_stats = None
+
+    def calls(self):
+        return dict(((s['plugin'], s['event']), s['calls']) \
+            for s in self.stats.snapshot())
+
+    def test_listeners_are_timed(self):
+        self.api.recv('/me foo', self.user, {})
+        self.api.recv('bar', self.user, {})
+        calls = self.calls()
+        self.assertEqual(2, calls[('NoAuth', 'auth.check')])
+        self.assertEqual(2, calls[('Me', 'message.received')])
+        self.assertEqual(1, calls[('Console', 'chat.init')])
+
+    def test_listeners_are_not_timed_when_stats_are_disabled(self):
+        Plugin.listener_stats = None
+        me = Me()
+        self.assertEqual(me.on_new_message, me.pipeline()[0][1])
+
+    def test_stats_are_reported_by_console_command(self):
+        self.api.recv('foo', self.user, {})
+        self.assertEqual(1, len([s for s in self.profiler.cmd_stats(None, 100) \
+            if ('NoAuth', 'auth.check') == (s['plugin'], s['event'])]))
+        self.profiler.cmd_reset(None)
+        self.assertEqual(0, self.calls()[('NoAuth', 'auth.check')])
+
+
+if "__main__" == __name__:
+    unittest.main()
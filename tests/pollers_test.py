@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire.api import Api
+from campfire.pollers import PollerRegistry, user_keys
+
+
+class Poller(object):
+    def poller(self, msg):
+        pass
+
+
+class PollerRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = PollerRegistry()
+        self.user = {'id': 1, 'name': 'Foo', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True}
+
+    def test_user_keys_ignores_non_dict_users(self):
+        self.assertEqual(set(), user_keys(None))
+        self.assertEqual(set(), user_keys(1))
+        self.assertEqual(set(['1', 'Foo']), user_keys(self.user))
+
+    def test_user_keys_are_built_of_user_id(self):
+        guest = dict(Api.user_struct, ip='127.0.0.2')
+        self.assertEqual(set(['127.0.0.2']), user_keys(guest))
+        logged = dict(guest, name='Bar', logged=True)
+        self.assertEqual(set(['Bar']), user_keys(logged))
+
+    def test_add_keeps_order(self):
+        self.registry.add('a', None)
+        self.registry.add('b', None)
+        self.assertEqual([('a', None), ('b', None)], list(self.registry))
+
+    def test_add_replaces_poller(self):
+        self.registry.add('a', None)
+        self.registry.add('a', self.user)
+        self.assertEqual([('a', self.user)], list(self.registry))
+
+    def test_bound_methods_of_the_same_object_are_identical(self):
+        p = Poller()
+        self.registry.add(p.poller, None)
+        self.assertTrue(p.poller in self.registry)
+        self.assertFalse(Poller().poller in self.registry)
+        self.registry.remove(p.poller)
+        self.assertEqual(0, len(self.registry))
+
+    def test_remove_returns_user(self):
+        self.registry.add('a', self.user)
+        self.assertEqual(self.user, self.registry.remove('a'))
+        self.assertIsNone(self.registry.remove('a'))
+
+    def test_by_user_finds_pollers_by_user_identifiers(self):
+        self.registry.add('a', self.user)
+        self.registry.add('b', {'id': 2, 'name': 'Bar', 'ip': '127.0.0.1', \
+            'logged': True, 'hasAccount': True})
+        self.assertEqual([('a', self.user)], self.registry.by_user(['Foo']))
+        self.assertEqual([('a', self.user)], self.registry.by_user([1]))
+        self.assertEqual([], self.registry.by_user(['Baz']))
+        self.assertEqual([], self.registry.by_user(['127.0.0.1']))
+        self.registry.remove('a')
+        self.assertEqual([], self.registry.by_user(['Foo']))
+
+    def test_clear_returns_pollers(self):
+        self.registry.add('a', self.user)
+        self.assertEqual([('a', self.user)], self.registry.clear())
+        self.assertEqual(0, len(self.registry))
+        self.assertEqual([], self.registry.by_user(['Foo']))
+
+
+    def test_subscription_cursor_is_tracked(self):
+        self.registry.add('a', self.user, True, 'x')
+        self.registry.add('b', self.user)
+        self.assertTrue(self.registry.persistent('a'))
+        self.assertFalse(self.registry.persistent('b'))
+        self.registry.advance('a', 'y')
+        self.registry.advance('b', 'y')
+        self.assertEqual('y', self.registry.cursor('a'))
+        self.assertIsNone(self.registry.cursor('b'))
+        self.registry.remove('a')
+        self.assertFalse(self.registry.persistent('a'))
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -8,7 +8,10 @@ import unittest
 import _path
 _path.fix()
 
-TEST_MODULES = ['api_test', 'plugins.Me_test']
+TEST_MODULES = ['api_test', 'archive_test', 'auth_test', 'bus_test', \
+    'cache_test', 'journal_test', 'message_test', 'metrics_test', \
+    'pollers_test', 'sessions_test', 'plugins.Me_test', \
+    'plugins.Profiler_test']
 
 
 def all():
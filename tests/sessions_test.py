@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# python standard library
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+# hack for loading modules
+import _path
+_path.fix()
+
+##
+# campfire modules
+#
+from campfire.sessions import MemorySessionStore, SQLiteSessionStore
+
+
+class MemorySessionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = self.create_store()
+        self.store.create('a', {'name': 'foo'}, 10)
+        self.store.create('b', {'name': 'bar'}, 20)
+
+    def create_store(self):
+        return MemorySessionStore()
+
+    def test_session_is_created(self):
+        self.assertEqual(({'name': 'foo'}, 10), self.store.get('a'))
+        self.assertIsNone(self.store.get('c'))
+        self.assertEqual(2, len(self.store))
+
+    def test_user_name_is_unique(self):
+        self.assertFalse(self.store.create('c', {'name': 'foo'}, 30))
+        self.assertIsNone(self.store.get('c'))
+
+    def test_session_is_touched(self):
+        self.assertTrue(self.store.touch('a', 30))
+        self.assertEqual(30, self.store.get('a')[1])
+        # lastvisit time is never moved back
+        self.assertTrue(self.store.touch('a', 25))
+        self.assertEqual(30, self.store.get('a')[1])
+        self.assertFalse(self.store.touch('c', 30))
+
+    def test_session_is_deleted(self):
+        self.assertEqual({'name': 'foo'}, self.store.delete('a'))
+        self.assertIsNone(self.store.delete('a'))
+        # user name can be used again
+        self.assertTrue(self.store.create('c', {'name': 'foo'}, 30))
+
+    def test_old_sessions_expire(self):
+        self.store.touch('a', 30)
+        self.assertEqual([('b', {'name': 'bar'})], self.store.expire(25))
+        self.assertEqual([], self.store.expire(25))
+        self.assertEqual(1, len(self.store))
+        self.assertEqual([('a', {'name': 'foo'})], self.store.expire(31))
+
+
+class SQLiteSessionStoreTestCase(MemorySessionStoreTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        super(SQLiteSessionStoreTestCase, self).setUp()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def create_store(self):
+        return SQLiteSessionStore(os.path.join(self.path, 'sessions.db'))
+
+    def test_store_is_shared(self):
+        other = self.create_store()
+        self.assertEqual(({'name': 'foo'}, 10), other.get('a'))
+        other.delete('a')
+        self.assertIsNone(self.store.get('a'))
+        other.close()
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -18,8 +18,6 @@
 # python std library
 import logging
 import os
-import sys
-import signal
 import time
 
 # hack for loading modules
@@ -28,8 +26,6 @@ _path.fix()
 
 # tornado modules
 import tornado.auth
-import tornado.httpserver
-import tornado.ioloop
 import tornado.web
 from tornado.autoreload import add_reload_hook
 from tornado.options import define, options, parse_command_line
@@ -39,15 +35,42 @@ from tornado.escape import json_encode
 import campfire
 import campfire.platform.tornadoweb as chat
 import campfire.plugins as plugins
-from campfire.utils import AuthHelper
+from campfire.utils import AuthHelper, ListenerStats, Plugin
+from campfire.bus import UnixSocketBus
+from campfire.archive import BlockBackend
+from campfire.journal import FileJournal
+from campfire.sessions import SQLiteSessionStore
 
 # EventDispatcher modules
 from event import Dispatcher
 
 # args
 define('port', default=21777, help="run on the given port", type=int)
+define('internal_port', default=21778, help="serve unauthenticated " + \
+    "/chat/metrics and /chat/stats on the given port of loopback " + \
+    "interface (0 - not served); worker N serves its own metrics " + \
+    "on internal_port + N", type=int)
 define('debug', default=False, help="run in debug mode", type=bool)
 define('f', default=False, help="fix Python PATH", type=bool)
+define('processes', default=1, help="number of worker processes " + \
+    "(0 - one per CPU)", type=int)
+define('bus', default=os.path.abspath('./bus'), help="directory for " + \
+    "sockets of worker processes", type=str)
+define('journal', default='', help="directory for journals of recent " + \
+    "messages (kept between restarts)", type=str)
+define('sessions', default='', help="SQLite database of sessions " + \
+    "(shared by worker processes)", type=str)
+define('tickets', default=False, help="authenticate requests with " + \
+    "signed tickets", type=bool)
+define('compress', default=False, help="compress long-poll responses " + \
+    "and WebSocket messages (WebSocket messages require Tornado 4.0+)", \
+    type=bool)
+define('batch_window', default=0, help="milliseconds messages are " + \
+    "collected for before they are sent to pollers", type=int)
+define('profile', default=False, help="time plugin listeners " + \
+    "(stats served at /chat/stats of internal port)", type=bool)
+define('archive_blocks', default=False, help="write compressed, indexed " + \
+    "archive", type=bool)
 
 def archive_formatter(data):
     if 'typing' in data and data['typing']:
@@ -66,11 +89,18 @@ def archive_formatter(data):
         data['text']
     ]
 
+def archive_path(worker_id):
+    # each worker writes its own archive (history reads all of them,
+    # see worker_id '*' below)
+    if 1 == options.processes:
+        return './archive.%Y%m%d.csv'
+    return './archive.%%Y%%m%%d.%s.csv' % worker_id
+
 class ChatServer(tornado.web.Application):
     """
     Main serwer class
     """
-    def __init__(self, log):
+    def __init__(self, log, worker_id=0):
         # logging
         if options.debug:
             log.setLevel(logging.DEBUG)
@@ -78,11 +108,23 @@ class ChatServer(tornado.web.Application):
         # prepare config manager
         config = plugins.Config(os.path.abspath('./config.cfg'))
 
+        # time listeners of plugins registered below
+        stats = None
+        if options.profile:
+            stats = ListenerStats()
+            Plugin.listener_stats = stats
+
         # prepare dispatcher and listeners (plugins)
         dispatcher = Dispatcher()
         plugins.AntiFlood().register(dispatcher)
-        plugins.Archive(os.path.abspath('./archive.%Y%m%d.csv'), \
-            archive_formatter).register(dispatcher)
+        path = os.path.abspath(archive_path(worker_id))
+        backend = None
+        if options.archive_blocks:
+            backend = BlockBackend(path.replace('.csv', '.blk'), \
+                read_path=os.path.abspath(archive_path('*')).replace(\
+                '.csv', '.blk'))
+        plugins.Archive(path, archive_formatter, backend=backend).register(\
+            dispatcher)
         plugins.Ban(config.get('ban', {})).register(dispatcher)
         plugins.Colors(config.get('colors', {})).register(dispatcher)
         plugins.Console().register(dispatcher)
@@ -99,13 +141,25 @@ class ChatServer(tornado.web.Application):
         plugins.ValidateLogin(config.get('stopwords', [])).register(dispatcher)
         plugins.Voices(config.get('voices', {})).register(dispatcher)
         plugins.Whoami().register(dispatcher)
+        if stats is not None:
+            plugins.Profiler(stats).register(dispatcher)
 
-        # prepare API instance and run chat
+        # prepare API instance (workers share messages over the bus)
         api = campfire.Api(log, dispatcher)
-        api.init()
+        if 1 != options.processes:
+            api.bus = UnixSocketBus(options.bus, worker_id, log)
+        if options.journal:
+            api.journal = FileJournal(os.path.join(options.journal, \
+                'journal.%u' % worker_id), log=log)
+        self.api = api
 
         # prepare auth handler
-        auth = AuthHelper(api, dispatcher, log)
+        store = None
+        if options.sessions:
+            store = SQLiteSessionStore(options.sessions)
+        secret = "6s3oEoTlzJKX^OGa=dko5gwmGgJJnuY@7Emup0XdrP13/Vka"
+        auth = AuthHelper(api, dispatcher, log, store, \
+            secret if options.tickets else None)
 
         args = {'log': log, 'api': api, 'auth': auth}
 
@@ -115,6 +169,8 @@ class ChatServer(tornado.web.Application):
             (r"/chat/logout", chat.AuthHandler, args),
             (r"/chat/reply", chat.HttpHandler, args),
             (r"/chat/poll", chat.HttpHandler, args),
+            (r"/chat/history", chat.HistoryHandler, args),
+            (r"/chat/events", chat.EventStreamHandler, args),
             (r"/chat/socket", chat.SocketHandler, args),
             (r"/", tornado.web.RedirectHandler, {"url": \
                 '/example/index.html'}),
@@ -122,42 +178,52 @@ class ChatServer(tornado.web.Application):
                 os.path.abspath('../vendors/js-campfire/')})
         ]
         settings = dict(
-            cookie_secret = "6s3oEoTlzJKX^OGa=dko5gwmGgJJnuY@7Emup0XdrP13/Vka",
+            cookie_secret = secret,
             debug = options.debug
         )
 
-        # signal handlers
-        def _shutdown(signum, stack_frame):
-            api.shutdown()
-            sys.exit(1)
-        
-        signal.signal(signal.SIGTERM, _shutdown)
-        signal.signal(signal.SIGINT, _shutdown)
-
         if options.debug:
             add_reload_hook(api.shutdown)
 
-        # periodic callback
-        p = tornado.ioloop.PeriodicCallback(api.periodic_notification, \
-            1 * 60 * 1000) # 1 minute
-        p.start()
-
         # start app
         tornado.web.Application.__init__(self, handlers, **settings)
 
+        # metrics and stats are not authenticated (internal port only)
+        internal_handlers = [
+            (r"/chat/metrics", chat.MetricsHandler, args)
+        ]
+        if stats is not None:
+            internal_handlers.append((r"/chat/stats", chat.StatsHandler, \
+                dict(args, stats=stats)))
+        self.internal = tornado.web.Application(internal_handlers)
+
 
 def main():
     parse_command_line()
 
     log = logging.getLogger('chat')
-    log.info('msg=starting server; port=%u; debug=%s', options.port, \
-        options.debug)
-
-    http_server = tornado.httpserver.HTTPServer(ChatServer(log), \
+    log.info('msg=starting server; port=%u; debug=%s; processes=%u', \
+        options.port, options.debug, options.processes)
+
+    if 1 != options.processes and not os.path.isdir(options.bus):
+        os.makedirs(options.bus)
+
+    campfire.Api.batch_window = options.batch_window
+    chat.HttpHandler.compress = options.compress
+    chat.SocketHandler.compress = options.compress
+    if options.compress and not chat.WEBSOCKET_COMPRESSION:
+        log.warning('msg=WebSocket messages are not compressed; ' + \
+            'tornado=%s', tornado.version)
+
+    def factory(worker_id):
+        application = ChatServer(log, worker_id)
+        if options.internal_port:
+            return (application, application.api, application.internal)
+        return (application, application.api)
+
+    chat.fork_server(factory, options.port, options.processes or None, \
+        periodic_interval=60, internal_port=options.internal_port, \
         xheaders=True, no_keep_alive=True)
-    http_server.listen(options.port)
-
-    tornado.ioloop.IOLoop.instance().start()
 
 
 if __name__ == "__main__":